@@ -84,27 +84,108 @@ function trackEvent({action, category, label, value}) {
 // ===============================
 // Infinite Scroll State
 // ===============================
+// imagesData is indexed by ordinal (position in display order); with a
+// sharded images.json it fills in shard by shard
 let imagesData = [];
-let imagesLoadedCount = 0;
+let imagesTotal = 0;
+let imagesLoadedCount = 0; // Rendered so far from the current view
 const IMAGES_BATCH_SIZE = 20;
 let msnry;
+// Sharded images.json: [{src, hash, count, offset, request}] in display order
+let shards = [];
+let batchPending = false;
+let viewGeneration = 0;
+
+// ===============================
+// Filter State
+// ===============================
+const FACETS_URL = 'images.facets.json';
+const FILTER_CATEGORIES = [
+  { key: 'dates', label: 'Dates', chipClass: 'chip-date' },
+  { key: 'places', label: 'Places', chipClass: 'chip-place' },
+  { key: 'tags', label: 'Tags', chipClass: 'chip-tag' }
+];
+let facetIndex = null;
+const selectedFilters = { dates: new Set(), places: new Set(), tags: new Set() };
+let filteredOrdinals = null; // null shows everything
 
 // ===============================
 // Masonry Grid & Gallery Rendering
 // ===============================
+// Preferred first; the <img> fallback uses the last type an entry has
+const THUMB_TYPES = ['image/avif', 'image/webp', 'image/jpeg'];
+const THUMB_EXTENSIONS = { 'image/avif': 'avif', 'image/webp': 'webp', 'image/jpeg': 'jpg' };
+
+function getThumbVariants(imgObj, type) {
+  const thumbs = imgObj.thumbs;
+  if (thumbs && thumbs.base) {
+    // Compact entry: every listed width exists in every listed format,
+    // named {base}_{width}.{ext}
+    const ext = THUMB_EXTENSIONS[type];
+    if (!thumbs.formats.includes(ext)) return [];
+    return thumbs.widths
+      .slice()
+      .sort((a, b) => a - b)
+      .map(width => ({ src: `${thumbs.base}_${width}.${ext}`, width, type }));
+  }
+  if (!Array.isArray(thumbs)) return [];
+  return thumbs
+    .filter(v => v.type === type)
+    .sort((a, b) => a.width - b.width);
+}
+
+function getFallbackVariants(imgObj) {
+  for (const type of THUMB_TYPES.slice().reverse()) {
+    const variants = getThumbVariants(imgObj, type);
+    if (variants.length) return variants;
+  }
+  return [];
+}
+
 function getThumbPath(imgObj, size) {
-  // Assume original_path is images/{filename}
+  // Smallest fallback variant at least `size` wide (or the largest there is)
+  const variants = getFallbackVariants(imgObj);
+  if (variants.length) return (variants.find(v => v.width >= size) || variants[variants.length - 1]).src;
+  if (imgObj.thumbs && imgObj.thumbs[size]) return imgObj.thumbs[size];
+  // Legacy entries: assume original_path is images/{filename}
   const filename = imgObj.original_path.split('/').pop().replace(/\.[^/.]+$/, "");
   return `thumbs/${filename}_${size}.webp`;
 }
 
+function getSrcset(variants) {
+  return variants.map(v => `${encodeURI(v.src)} ${v.width}w`).join(', ');
+}
+
+function renderPicture(imgObj, imageElem, size, sizes) {
+  // <picture> with one <source> per format the indexer produced, so the
+  // browser picks the best format it supports and the width it needs
+  const picture = document.createElement('picture');
+  const fallback = getFallbackVariants(imgObj);
+  const fallbackType = fallback.length ? fallback[0].type : null;
+  THUMB_TYPES.forEach(type => {
+    const variants = getThumbVariants(imgObj, type);
+    if (!variants.length || type === fallbackType) return;
+    const source = document.createElement('source');
+    source.type = type;
+    source.srcset = getSrcset(variants);
+    source.sizes = sizes;
+    picture.appendChild(source);
+  });
+  imageElem.src = getThumbPath(imgObj, size);
+  if (fallback.length) {
+    imageElem.srcset = getSrcset(fallback);
+    imageElem.sizes = sizes;
+  }
+  picture.appendChild(imageElem);
+  return picture;
+}
+
 function renderGalleryImage(imgObj) {
   const div = document.createElement('div');
   div.className = 'grid-item';
   div.tabIndex = 0;
 
   const imageElem = document.createElement('img');
-  imageElem.src = getThumbPath(imgObj, 320);
   imageElem.alt = getImageDisplayTitle(imgObj);
   imageElem.loading = 'lazy';
 
@@ -116,7 +197,19 @@ function renderGalleryImage(imgObj) {
     div.style.aspectRatio = `${imgObj.width}/${imgObj.height}`;
   }
 
-  div.appendChild(imageElem);
+  // Paint the reserved box straight away: dominant colour behind a blurred
+  // inline preview, both dropped once the real thumbnail has loaded
+  if (imgObj.color) div.style.backgroundColor = imgObj.color;
+  if (imgObj.placeholder) {
+    imageElem.style.backgroundImage = `url("${imgObj.placeholder}")`;
+    imageElem.style.backgroundSize = 'cover';
+    imageElem.onload = () => {
+      imageElem.style.backgroundImage = '';
+      div.style.backgroundColor = '';
+    };
+  }
+
+  div.appendChild(renderPicture(imgObj, imageElem, 320, '320px'));
   div.appendChild(renderOverlayTop('gallery', imgObj));
   div.appendChild(renderOverlayBottom('gallery', imgObj));
 
@@ -152,40 +245,267 @@ function initMasonryGrid() {
   });
 }
 
-function loadNextBatch() {
+function getViewLength() {
+  return filteredOrdinals ? filteredOrdinals.length : imagesTotal;
+}
+
+function getViewOrdinals(start, end) {
+  if (filteredOrdinals) return filteredOrdinals.slice(start, end);
+  const ordinals = [];
+  for (let i = start; i < Math.min(end, imagesTotal); i++) ordinals.push(i);
+  return ordinals;
+}
+
+function loadNextBatch(ordinals) {
   const grid = document.getElementById('grid');
-  const nextImages = imagesData.slice(imagesLoadedCount, imagesLoadedCount + IMAGES_BATCH_SIZE);
+  const nextImages = ordinals.map(ordinal => imagesData[ordinal]).filter(Boolean);
   let newDivs = [];
   nextImages.forEach((img) => {
     const div = renderGalleryImage(img);
     grid.appendChild(div);
     newDivs.push(div);
   });
-  imagesLoadedCount += nextImages.length;
+  imagesLoadedCount += ordinals.length;
 
-  // Only initialize Masonry after first batch is loaded
-  if (!msnry) {
-    imagesLoaded(grid, function() {
-      initMasonryGrid();
-      msnry.appended(newDivs);
-      msnry.layout();
-    });
+  const layout = function() {
+    if (!msnry) initMasonryGrid();
+    msnry.appended(newDivs);
+    msnry.layout();
+  };
+  // Boxes sized from the indexed width/height can be placed right away;
+  // only batches with entries missing them wait for the images to load
+  if (nextImages.every(img => img.width && img.height)) {
+    layout();
   } else {
-    imagesLoaded(newDivs, function() {
-      msnry.appended(newDivs);
-      msnry.layout();
-    });
+    imagesLoaded(newDivs, layout);
   }
 }
 
+function withOriginalPath(images) {
+  return images.map(img => ({ ...img, original_path: img.path }));
+}
+
+function fetchShard(shard) {
+  // Each shard is fetched once; the hash busts caches only for changed shards
+  if (!shard.request) {
+    shard.request = fetch(`${shard.src}?v=${shard.hash}`)
+      .then(response => response.json())
+      .then(data => {
+        withOriginalPath(data.images).forEach((img, i) => { imagesData[shard.offset + i] = img; });
+      })
+      .catch(err => {
+        shard.request = null;
+        throw err;
+      });
+  }
+  return shard.request;
+}
+
+function ensureOrdinalsLoaded(ordinals) {
+  const needed = new Set();
+  ordinals.forEach(ordinal => {
+    if (imagesData[ordinal]) return;
+    const shard = shards.find(s => ordinal >= s.offset && ordinal < s.offset + s.count);
+    if (shard) needed.add(shard);
+  });
+  return Promise.all([...needed].map(fetchShard));
+}
+
+function requestNextBatch() {
+  if (batchPending || imagesLoadedCount >= getViewLength()) return;
+  batchPending = true;
+  const generation = viewGeneration;
+  const ordinals = getViewOrdinals(imagesLoadedCount, imagesLoadedCount + IMAGES_BATCH_SIZE);
+  ensureOrdinalsLoaded(ordinals)
+    .then(() => {
+      // Drop batches for a view that a filter change has replaced
+      if (generation === viewGeneration) loadNextBatch(ordinals);
+    })
+    .catch(err => console.error(err))
+    .finally(() => { batchPending = false; });
+}
+
+function resetGallery() {
+  viewGeneration++;
+  batchPending = false;
+  imagesLoadedCount = 0;
+  if (msnry) {
+    msnry.destroy();
+    msnry = null;
+  }
+  document.getElementById('grid').innerHTML = '';
+  initMasonryGrid();
+  requestNextBatch();
+}
+
 function handleScroll() {
   if ((window.innerHeight + window.scrollY) >= document.body.offsetHeight - 500) {
-    if (imagesLoadedCount < imagesData.length) {
-      loadNextBatch();
+    if (imagesLoadedCount < getViewLength()) {
+      requestNextBatch();
     }
   }
 }
 
+// ===============================
+// Filtering (postings from images.facets.json)
+// ===============================
+function buildFacetIndex(images) {
+  // Fallback when images.facets.json is missing: same postings, built client-side
+  const index = { count: images.length, dates: {}, places: {}, tags: {} };
+  const add = (facet, value, ordinal) => {
+    const posting = index[facet][value] || (index[facet][value] = { count: 0, ids: [] });
+    if (posting.ids[posting.ids.length - 1] === ordinal) return;
+    posting.ids.push(ordinal);
+    posting.count++;
+  };
+  images.forEach((img, ordinal) => {
+    if (img.taken && img.taken.length >= 7) add('dates', img.taken.slice(0, 7), ordinal);
+    if (img.location) add('places', img.location, ordinal);
+    (img.tags || []).slice().sort().forEach(tag => add('tags', tag, ordinal));
+  });
+  return index;
+}
+
+function unionPostings(lists) {
+  // Merge of sorted ordinal lists, without duplicates
+  const seen = new Set();
+  lists.forEach(list => list.forEach(ordinal => seen.add(ordinal)));
+  return [...seen].sort((a, b) => a - b);
+}
+
+function intersectPostings(a, b) {
+  const result = [];
+  let i = 0, j = 0;
+  while (i < a.length && j < b.length) {
+    if (a[i] === b[j]) { result.push(a[i]); i++; j++; }
+    else if (a[i] < b[j]) i++;
+    else j++;
+  }
+  return result;
+}
+
+function applyFilters() {
+  // OR within a category, AND across categories
+  let result = null;
+  FILTER_CATEGORIES.forEach(({ key }) => {
+    if (!selectedFilters[key].size) return;
+    const postings = [...selectedFilters[key]].map(value => (facetIndex[key][value] || { ids: [] }).ids);
+    const matches = postings.length === 1 ? postings[0] : unionPostings(postings);
+    result = result ? intersectPostings(result, matches) : matches;
+  });
+  filteredOrdinals = result;
+  renderFilterRow();
+  resetGallery();
+}
+
+function formatFacetValue(category, value) {
+  if (category !== 'dates') return value;
+  const [year, month] = value.split('-').map(Number);
+  return new Date(year, month - 1).toLocaleString('en-US', { month: 'long', year: 'numeric' });
+}
+
+function renderFilterRow() {
+  const row = document.getElementById('filter-row');
+  if (!row) return;
+  row.innerHTML = '';
+  FILTER_CATEGORIES.forEach(({ key, label, chipClass }) => {
+    const button = document.createElement('button');
+    const count = selectedFilters[key].size;
+    button.className = `chip ${chipClass}${count ? ' selected' : ''}`;
+    button.textContent = count ? `${label} (${count})` : label;
+    button.disabled = !facetIndex;
+    button.onclick = () => showFilterOverlay(key);
+    row.appendChild(button);
+  });
+}
+
+function showFilterOverlay(category) {
+  const { label, chipClass } = FILTER_CATEGORIES.find(c => c.key === category);
+  const overlay = document.getElementById('filter-overlay');
+  const chips = Object.entries(facetIndex[category]).map(([value, posting]) => {
+    const selected = selectedFilters[category].has(value) ? ' selected' : '';
+    return `<span class="chip ${chipClass}${selected}" tabindex="0" data-value="${encodeURIComponent(value)}">${formatFacetValue(category, value)} (${posting.count})</span>`;
+  }).join('');
+  overlay.innerHTML = `
+    <div class="filter-overlay" id="filter-overlay-backdrop">
+      <div class="filter-overlay-content">
+        <div class="filter-overlay-header">
+          <span class="filter-overlay-title">${label}</span>
+          <button class="chip" id="filter-clear">Clear</button>
+          <button class="chip" id="filter-clear-all">Clear All</button>
+          <button class="lightbox-close" id="filter-close" title="Close">&times;</button>
+        </div>
+        <div class="filter-chips-list">${chips}</div>
+      </div>
+    </div>
+  `;
+  overlay.style.display = 'block';
+  document.body.style.overflow = 'hidden';
+
+  const toggle = (chip) => {
+    const value = decodeURIComponent(chip.dataset.value);
+    if (selectedFilters[category].has(value)) selectedFilters[category].delete(value);
+    else selectedFilters[category].add(value);
+    chip.classList.toggle('selected');
+    trackEvent({ action: 'toggle_filter', category: 'Filter', label: `${category}:${value}` });
+    applyFilters();
+  };
+  overlay.querySelectorAll('.filter-chips-list .chip').forEach(chip => {
+    chip.onclick = () => toggle(chip);
+    chip.onkeydown = (e) => {
+      if (e.key === "Enter" || e.key === " ") {
+        e.preventDefault();
+        toggle(chip);
+      }
+    };
+  });
+  document.getElementById('filter-clear').onclick = () => {
+    selectedFilters[category].clear();
+    overlay.querySelectorAll('.filter-chips-list .chip.selected').forEach(chip => chip.classList.remove('selected'));
+    applyFilters();
+  };
+  document.getElementById('filter-clear-all').onclick = () => {
+    FILTER_CATEGORIES.forEach(({ key }) => selectedFilters[key].clear());
+    overlay.querySelectorAll('.filter-chips-list .chip.selected').forEach(chip => chip.classList.remove('selected'));
+    applyFilters();
+  };
+  document.getElementById('filter-close').onclick = closeFilterOverlay;
+  document.getElementById('filter-overlay-backdrop').onclick = (e) => {
+    if (e.target.id === 'filter-overlay-backdrop') closeFilterOverlay();
+  };
+  document.addEventListener('keydown', onFilterOverlayKey);
+}
+
+function closeFilterOverlay() {
+  const overlay = document.getElementById('filter-overlay');
+  overlay.style.display = 'none';
+  overlay.innerHTML = '';
+  document.body.style.overflow = '';
+  document.removeEventListener('keydown', onFilterOverlayKey);
+}
+
+function onFilterOverlayKey(e) {
+  if (e.key === "Escape") closeFilterOverlay();
+}
+
+function loadFacetIndex() {
+  // Postings precomputed by the indexer; built here only for a single-file
+  // images.json without them (a sharded gallery then simply has no filters)
+  return fetch(FACETS_URL)
+    .then(response => {
+      if (!response.ok) throw new Error(`${FACETS_URL}: ${response.status}`);
+      return response.json();
+    })
+    .then(index => {
+      if (index.count !== imagesTotal) throw new Error(`${FACETS_URL} is out of date`);
+      facetIndex = index;
+    })
+    .catch(() => {
+      facetIndex = shards.length ? null : buildFacetIndex(imagesData);
+    })
+    .then(renderFilterRow);
+}
+
 // ===============================
 // Overlay Rendering (Shared)
 // ===============================
@@ -218,12 +538,16 @@ function renderOverlayBottom(context, imgObj) {
 // ===============================
 function showLightbox(imgObj) {
   const lightbox = document.getElementById('lightbox');
+  const imageElem = document.createElement('img');
+  imageElem.className = 'lightbox-img';
+  imageElem.alt = getImageDisplayTitle(imgObj);
+  const picture = renderPicture(imgObj, imageElem, 1600, '(max-width: 1600px) 100vw, 1600px');
     lightbox.innerHTML = `
       <div class="lightbox-overlay" id="lightbox-overlay">
         <div class="lightbox-content">
           <button class="lightbox-close" id="lightbox-close" title="Close">&times;</button>
           ${renderOverlayTop('lightbox', imgObj).outerHTML}
-          <img class="lightbox-img" src="${getThumbPath(imgObj, 1600)}" alt="${getImageDisplayTitle(imgObj)}">
+          ${picture.outerHTML}
           ${renderOverlayBottom('lightbox', imgObj).outerHTML}
           <div class="lightbox-scroll-cue"></div>
         </div>
@@ -309,11 +633,23 @@ function initPortfolioApp() {
     .then(response => response.json())
     .then(data => {
       // For each image, ensure original_path is set
-      imagesData = Array.isArray(data)
-        ? data.map(img => ({ ...img, original_path: img.path })) // fallback for legacy
-        : data.images.map(img => ({ ...img, original_path: img.path }));
+      if (Array.isArray(data)) {
+        imagesData = withOriginalPath(data); // fallback for legacy
+      } else if (data.shards) {
+        // Sharded index: entries arrive shard by shard as the user scrolls
+        let offset = 0;
+        shards = data.shards.map(shard => {
+          const entry = { ...shard, offset, request: null };
+          offset += shard.count;
+          return entry;
+        });
+      } else {
+        imagesData = withOriginalPath(data.images);
+      }
+      imagesTotal = shards.length ? data.count : imagesData.length;
       initMasonryGrid();
-      loadNextBatch(); // Load first batch
+      requestNextBatch(); // Load first batch
+      loadFacetIndex();
     })
     .catch(err => {
       document.getElementById('grid').innerHTML = '<p style="color:red;text-align:center;">Could not load images.json.</p>';
@@ -0,0 +1,281 @@
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import argparse
+import datetime
+import resource
+import tracemalloc
+import contextlib
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
+import piexif
+from PIL import Image
+
+# The city table paths are relative to the repo root; it is loaded there
+# before each scale moves into its own workspace. Blocking geopy keeps every
+# run offline: places come from the city table or raw coordinates.
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+sys.modules["geopy"] = None
+import index_and_enrich as iae
+
+DEFAULT_SCALES = "100,1000,10000"
+DEFAULT_WORKDIR = ".bench_cache"
+DEFAULT_IMAGE_SIZE = "160x120"
+DEFAULT_DAYS = 30
+DEFAULT_GPX_INTERVAL = 10    # Seconds between synthetic track points
+DEFAULT_GPS_FRACTION = 0.2   # Photos that already carry a GPS position
+DEFAULT_UNDATED_FRACTION = 0.05
+START_TIME = datetime.datetime(2024, 5, 1)
+FILES_PER_DIR = 1000
+STARTUP_RUNS = 5
+BENCHMARKS = ["startup", "get_city_country", "find_nearest_gpx_point", "get_all_gpx_points", "generate_thumbnails_for_all", "integrate_index_and_geotag"]
+
+# --------- SYNTHETIC LIBRARY ---------
+def city_coords(rng, n):
+    # Points within a few km of real cities, so offline lookups resolve
+    cities = iae.get_city_index()
+    rows = rng.choices(range(len(cities.lats)), k=n)
+    return [(float(cities.lats[r]) + rng.uniform(-0.03, 0.03), float(cities.lons[r]) + rng.uniform(-0.03, 0.03)) for r in rows]
+
+def day_anchor(seed, day):
+    rng = random.Random(f"{seed}:day:{day}")
+    return city_coords(rng, 1)[0]
+
+def photo_spec(seed, i, days, gps_fraction, undated_fraction):
+    # (taken datetime or None, (lat, lon) or None), deterministic per photo
+    rng = random.Random(f"{seed}:photo:{i}")
+    if rng.random() < undated_fraction:
+        return None, None
+    taken = START_TIME + datetime.timedelta(seconds=rng.randrange(days * 86400))
+    gps = None
+    if rng.random() < gps_fraction:
+        lat, lon = day_anchor(seed, (taken - START_TIME).days)
+        gps = (lat + rng.uniform(-0.01, 0.01), lon + rng.uniform(-0.01, 0.01))
+    return taken, gps
+
+def make_photo(args):
+    path, size, seed, i, days, gps_fraction, undated_fraction = args
+    taken, gps = photo_spec(seed, i, days, gps_fraction, undated_fraction)
+    rng = random.Random(f"{seed}:pixels:{i}")
+    img = Image.new("RGB", size, tuple(rng.randrange(256) for _ in range(3)))
+    # A few blocks so the encoder has some detail to work with
+    for _ in range(4):
+        x, y = rng.randrange(size[0]), rng.randrange(size[1])
+        img.paste(tuple(rng.randrange(256) for _ in range(3)), (x, y, min(size[0], x + size[0] // 3), min(size[1], y + size[1] // 3)))
+    exif = iae.empty_exif()
+    if taken:
+        exif["Exif"][piexif.ExifIFD.DateTimeOriginal] = taken.strftime("%Y:%m:%d %H:%M:%S")
+    if gps:
+        exif["GPS"].update(iae.gps_ifd(*gps))
+    img.save(path, "JPEG", quality=80, exif=piexif.dump(exif))
+
+def make_library(root, n, size, seed, days, gps_fraction, undated_fraction, gpx_interval, workers=None):
+    # Reused across runs when a library with the same parameters exists
+    marker = os.path.join(root, "complete")
+    if os.path.exists(marker):
+        return
+    shutil.rmtree(root, ignore_errors=True)
+    tasks = []
+    for i in range(n):
+        subdir = os.path.join(root, "images", f"d{i // FILES_PER_DIR:03d}")
+        if i % FILES_PER_DIR == 0:
+            os.makedirs(subdir, exist_ok=True)
+        tasks.append((os.path.join(subdir, f"IMG_{i:06d}.jpg"), size, seed, i, days, gps_fraction, undated_fraction))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(make_photo, tasks, chunksize=256))
+    make_gpx(os.path.join(root, "gpx"), seed, days, gpx_interval)
+    with open(marker, "w") as f:
+        f.write(f"{n}\n")
+
+def make_gpx(gpx_dir, seed, days, interval):
+    # One GPX file per day: a slow random walk around that day's city
+    os.makedirs(gpx_dir, exist_ok=True)
+    for day in range(days):
+        rng = random.Random(f"{seed}:gpx:{day}")
+        lat, lon = day_anchor(seed, day)
+        start = START_TIME + datetime.timedelta(days=day)
+        with open(os.path.join(gpx_dir, f"track_{day:03d}.gpx"), "w", encoding="utf-8") as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n<gpx version="1.1" creator="benchmark" xmlns="http://www.topografix.com/GPX/1/1">\n<trk><trkseg>\n')
+            for t in range(0, 86400, interval):
+                lat += rng.uniform(-1e-4, 1e-4)
+                lon += rng.uniform(-1e-4, 1e-4)
+                stamp = (start + datetime.timedelta(seconds=t)).strftime("%Y-%m-%dT%H:%M:%SZ")
+                f.write(f'<trkpt lat="{lat:.6f}" lon="{lon:.6f}"><time>{stamp}</time></trkpt>\n')
+            f.write("</trkseg></trk>\n</gpx>\n")
+
+# --------- MEASUREMENT ---------
+# Every case runs in a fresh interpreter (this script with --case), so its
+# peak RSS is its own rather than the high-water mark of every case before
+# it. Cases still run in order and share the workspace on disk, which is what
+# the warm/incremental cases measure.
+def max_rss_mb(who=resource.RUSAGE_SELF):
+    # Peak resident size (KB on Linux, bytes on macOS)
+    rss = resource.getrusage(who).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+def measure(name, scale, items, func, memory=False, who=resource.RUSAGE_SELF):
+    # Runs func once and returns a result row; items is what throughput counts
+    if memory:
+        tracemalloc.start()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        wall0, cpu0 = time.perf_counter(), time.process_time()
+        func()
+        wall, cpu = time.perf_counter() - wall0, time.process_time() - cpu0
+    row = {
+        "benchmark": name,
+        "scale": scale,
+        "items": items,
+        "wall": round(wall, 4),
+        "cpu": round(cpu, 4),
+        "per_second": round(items / wall, 1) if wall else None,
+        "max_rss_mb": round(max_rss_mb(who), 1)
+    }
+    if memory:
+        row["peak_traced_mb"] = round(tracemalloc.get_traced_memory()[1] / (1024 * 1024), 2)
+        tracemalloc.stop()
+    return row
+
+def print_row(row):
+    traced = f"  traced {row['peak_traced_mb']:.1f} MB" if "peak_traced_mb" in row else ""
+    print(f"{row['benchmark']:<42} {row['scale']:>7} {row['wall']:>9.3f}s {row['per_second'] or 0:>11.1f}/s  rss {row['max_rss_mb']:.0f} MB{traced}")
+
+def run_case(name, scale):
+    # Measures one case in a child interpreter and returns its row
+    cmd = [sys.executable, os.path.abspath(__file__)] + sys.argv[1:] + ["--scales", str(scale), "--case", name]
+    out = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, text=True).stdout
+    row = json.loads(out.splitlines()[-1])
+    print_row(row)
+    return row
+
+# A case is (benchmark, name, setup); setup runs untimed in the child and
+# returns (items, func) or (items, func, rusage target)
+def startup_cases(args):
+    # Scale-independent: fresh interpreters importing the indexer and running
+    # --help (their peak RSS, not the harness's), then loading the compiled
+    # city table versus compiling the CSV
+    python = sys.executable
+    cases = []
+    for name, cmd in (("startup: import", [python, "-c", "import index_and_enrich"]),
+                      ("startup: --help", [python, "index_and_enrich.py", "--help"])):
+        cases.append(("startup", name, lambda cmd=cmd: (
+            args.startup_runs,
+            lambda: [subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL) for _ in range(args.startup_runs)],
+            resource.RUSAGE_CHILDREN)))
+    cases.append(("startup", "city table: load compiled", lambda: (
+        len(iae.CityIndex.load(iae.DEFAULT_CITY_TABLE).labels), lambda: iae.CityIndex.load(iae.DEFAULT_CITY_TABLE))))
+    if os.path.exists(iae.WORLDCITIES_CSV):
+        cases.append(("startup", "city table: compile from CSV", lambda: (
+            len(iae.CityIndex.load(iae.DEFAULT_CITY_TABLE).labels), lambda: iae.CityIndex.from_csv(iae.WORLDCITIES_CSV))))
+    return cases
+
+def scale_workspace(n, args, size):
+    name = f"lib-{n}-{size[0]}x{size[1]}-{args.seed}-{args.days}-{args.gpx_interval}-{args.gps_fraction}-{args.undated_fraction}"
+    return os.path.join(args.workdir, name)
+
+def scale_cases(n, args, root):
+    images_dir, gpx_dir = os.path.join(root, "images"), os.path.join(root, "gpx")
+    run_dir = os.path.join(root, "run")
+
+    def city_lookups():
+        coords = city_coords(random.Random(f"{args.seed}:lookups"), n)
+        return n, lambda: [iae.get_city_country(lat, lon) for lat, lon in coords]
+
+    def gpx_points_count():
+        return len(iae.gpx_files_in(gpx_dir)) * (86400 // args.gpx_interval)
+
+    def gpx_cold():
+        shutil.rmtree(iae.DEFAULT_GPX_CACHE_DIR, ignore_errors=True)
+        return gpx_points_count(), lambda: iae.get_all_gpx_points(gpx_dir)
+
+    def nearest_points():
+        track = iae.load_gpx_track(gpx_dir)
+        rng = random.Random(f"{args.seed}:times")
+        times = [START_TIME + datetime.timedelta(seconds=rng.randrange(args.days * 86400)) for _ in range(n)]
+        return n, lambda: [iae.find_nearest_gpx_point(t, track) for t in times]
+
+    def thumbnails():
+        return n, lambda: iae.generate_thumbnails_for_all(images_dir, os.path.join(run_dir, "thumbs-bench"), workers=args.workers)
+
+    def integrate():
+        # Test mode: the synthetic photos are reused across runs, so they must not be geotagged
+        return n, lambda: iae.integrate_index_and_geotag(gpx_dir, images_dir, "images.json", test_mode=True, geocoder=None,
+                                                         workers=args.workers, thumbs_dir="thumbs")
+
+    return [
+        ("get_city_country", "get_city_country", city_lookups),
+        ("get_all_gpx_points", "get_all_gpx_points (cold)", gpx_cold),
+        ("get_all_gpx_points", "get_all_gpx_points (compiled cache)", lambda: (gpx_points_count(), lambda: iae.get_all_gpx_points(gpx_dir))),
+        ("find_nearest_gpx_point", "find_nearest_gpx_point", nearest_points),
+        ("generate_thumbnails_for_all", "generate_thumbnails_for_all (cold)", thumbnails),
+        ("generate_thumbnails_for_all", "generate_thumbnails_for_all (up to date)", thumbnails),
+        ("integrate_index_and_geotag", "integrate_index_and_geotag (cold)", integrate),
+        ("integrate_index_and_geotag", "integrate_index_and_geotag (incremental)", integrate),
+    ]
+
+def run_scale(n, args, size, selected):
+    root = scale_workspace(n, args, size)
+    print(f"\nPreparing {n} photos in {root} ...")
+    make_library(root, n, size, args.seed, args.days, args.gps_fraction, args.undated_fraction, args.gpx_interval, workers=args.workers)
+    run_dir = os.path.join(root, "run")
+    shutil.rmtree(run_dir, ignore_errors=True)
+    os.makedirs(run_dir)
+    return [run_case(name, n) for benchmark, name, _ in scale_cases(n, args, root) if benchmark in selected]
+
+def measure_case(args, size):
+    # Child side of run_case: set the case up, time it, print its row as JSON
+    n = int(args.scales)
+    if args.case in {name for _, name, _ in startup_cases(args)}:
+        cases, scale = startup_cases(args), 1
+    else:
+        root = scale_workspace(n, args, size)
+        cases, scale = scale_cases(n, args, root), n
+        iae.get_city_index()
+        os.chdir(os.path.join(root, "run"))  # Keeps the indexer's relative caches inside the workspace
+    setup = next(setup for _, name, setup in cases if name == args.case)
+    items, func, *who = setup()
+    print(json.dumps(measure(args.case, scale, items, func, args.memory, *who)))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark index_and_enrich on synthetic photo libraries and GPX tracks (fully offline)")
+    parser.add_argument("--scales", type=str, default=DEFAULT_SCALES, help="Comma-separated photo counts, e.g. 100,1000,10000,100000")
+    parser.add_argument("--only", type=str, default=",".join(BENCHMARKS), help="Comma-separated benchmarks to run")
+    parser.add_argument("--workdir", type=str, default=DEFAULT_WORKDIR, help="Where synthetic libraries are generated and kept between runs")
+    parser.add_argument("--size", type=str, default=DEFAULT_IMAGE_SIZE, help="Synthetic photo size, WIDTHxHEIGHT")
+    parser.add_argument("--days", type=int, default=DEFAULT_DAYS, help="Days spanned by photo timestamps and GPX tracks")
+    parser.add_argument("--gpx-interval", type=int, default=DEFAULT_GPX_INTERVAL, help="Seconds between GPX track points (track density)")
+    parser.add_argument("--gps-fraction", type=float, default=DEFAULT_GPS_FRACTION, help="Share of photos that already carry GPS")
+    parser.add_argument("--undated-fraction", type=float, default=DEFAULT_UNDATED_FRACTION, help="Share of photos without DateTimeOriginal")
+    parser.add_argument("--seed", type=int, default=1, help="Seed for the synthetic data")
+    parser.add_argument("--workers", type=int, default=None, help="Processes for library generation and thumbnails (default: CPU count)")
+    parser.add_argument("--memory", action="store_true", help="Also trace peak Python allocations per benchmark (slower)")
+    parser.add_argument("--startup-runs", type=int, default=STARTUP_RUNS, help="Interpreter launches timed by the startup benchmark")
+    parser.add_argument("--json", type=str, default=None, help="Write all result rows to this JSON file")
+    parser.add_argument("--case", type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    args.workdir = os.path.abspath(args.workdir)
+    size = tuple(int(v) for v in args.size.lower().split("x"))
+    selected = set(args.only.split(","))
+    unknown = selected - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(sorted(unknown))}")
+    if args.case:
+        measure_case(args, size)
+        sys.exit(0)
+
+    t0 = time.perf_counter()
+    if iae.get_city_index() is None:
+        sys.exit(f"The benchmark places photos near real cities and needs {iae.WORLDCITIES_CSV} or a compiled {iae.DEFAULT_CITY_TABLE}")
+    print(f"City index ready in {time.perf_counter() - t0:.3f}s")
+    print(f"{'benchmark':<42} {'scale':>7} {'wall':>10} {'throughput':>13}")
+    results = [run_case(name, 1) for _, name, _ in startup_cases(args)] if "startup" in selected else []
+    for n in (int(v) for v in args.scales.split(",")):
+        results.extend(run_scale(n, args, size, selected))
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
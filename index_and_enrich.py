@@ -1,32 +1,95 @@
 import os
+import io
 import json
+import base64
+import csv
 import piexif
-from PIL import Image, ExifTags
-import gpxpy
-import math
+from PIL import Image
 import datetime
 import argparse
-from collections import defaultdict
-import pandas as pd
+import cProfile
+import pstats
+import tracemalloc
+import sqlite3
+import hashlib
+import shutil
+import tempfile
+import xml.etree.ElementTree as ET
+import threading
+import queue
+import time
+import urllib.parse
+from collections import OrderedDict, defaultdict, deque
+from contextlib import contextmanager
+from email.utils import formatdate, parsedate_to_datetime
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import Future, CancelledError, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FutureTimeoutError
+import numpy as np
+
+# geopy and gpxpy are imported where they are first needed, see
+# get_geolocator and iter_gpx_points_gpxpy, to keep startup fast.
 
 try:
-    from geopy.geocoders import Nominatim
-    geolocator = Nominatim(user_agent="photo_portfolio_indexer")
+    import pillow_avif  # noqa: F401  Registers AVIF with Pillow releases that lack it
 except ImportError:
-    geolocator = None
-
-worldcities_df = pd.read_csv("assets/worldcities.csv")  # columns: city, country, lat, lng
+    pass
 
 PHOTO_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp', '.tiff'}
 DEFAULT_IMAGE_DIR = "images"
 DEFAULT_JSON_PATH = "images.json"
 DEFAULT_GPX_DIR = "GPX_Output"
 DEFAULT_THUMBS_DIR = "thumbs"
+DEFAULT_SHARD_DIR = "shards"       # Relative to the images.json directory
+DEFAULT_IO_WORKERS = 8             # Threads reading image headers ahead of the indexing loop
+DEFAULT_SHARD_SIZE = 0             # Images per shard; 0 writes a single images.json
+DEFAULT_CACHE_DIR = ".index_cache"
+DEFAULT_GEOCODE_CACHE = os.path.join(DEFAULT_CACHE_DIR, "geocode.sqlite")
+DEFAULT_GPX_CACHE_DIR = os.path.join(DEFAULT_CACHE_DIR, "gpx")
+DEFAULT_MANIFEST = os.path.join(DEFAULT_CACHE_DIR, "manifest.json")
+DEFAULT_JOURNAL_DIR = os.path.join(DEFAULT_CACHE_DIR, "journal")
+DEFAULT_METRICS = os.path.join(DEFAULT_CACHE_DIR, "metrics.jsonl")  # One JSON line per run
+DEFAULT_REPORT = os.path.join(DEFAULT_CACHE_DIR, "report.jsonl")    # One JSON line per image, rewritten each run
+DEFAULT_CITY_TABLE = os.path.join(DEFAULT_CACHE_DIR, "worldcities")  # Compiled from WORLDCITIES_CSV
+WORLDCITIES_CSV = os.path.join("assets", "worldcities.csv")  # columns: city, country, lat, lng
+CITY_TABLE_VERSION = 1
+GEOPY_USER_AGENT = "photo_portfolio_indexer"
+GEOTAG_MODES = ("exif", "xmp")     # Write GPS into the JPEG, or into an XMP sidecar beside it
+SIDECAR_NAMINGS = ("file", "stem")  # IMG_0001.jpg.xmp or IMG_0001.xmp, see xmp_sidecar_path
+GPX_STREAM_THRESHOLD = 32 * 1024 * 1024  # Bytes; larger GPX files are parsed with iterparse
+DEFAULT_GEOCODE_PRECISION = 4      # Decimal places kept in cache keys (~11 m)
+DEFAULT_GEOCODE_TTL_DAYS = 180
+DEFAULT_GEOCODE_MAX_ENTRIES = 200000
+DEFAULT_GEOCODE_BUDGET = 60        # Seconds to wait on geopy before falling back to coordinates
+NOMINATIM_MIN_INTERVAL = 1.0       # Nominatim usage policy: at most 1 request per second
+DEFAULT_INTERP_MAX_GAP = 3600      # Seconds between bracketing GPX points to still interpolate
+DEFAULT_INTERP_MAX_SPEED = 250     # km/h; faster implied movement means the track has a hole
+DEFAULT_WATCH_DEBOUNCE = 2.0       # Seconds without new changes before a burst is indexed
+DEFAULT_WATCH_MAX_DELAY = 30.0     # Seconds a steady stream of changes can hold back a run
+DEFAULT_WATCH_POLL = 2.0           # Seconds between directory scans when inotify is unavailable
+DEFAULT_PREVIEW_PORT = 8000
+DEFAULT_PREVIEW_CACHE_MB = 64      # Rendered thumbnails the preview server keeps in memory
+
+EARTH_RADIUS_KM = 6371.0
+OFFLINE_MATCH_KM = 25  # Max distance to accept the nearest SimpleMaps city
 
 THUMB_SIZES = [
     ("320", 320),      # Gallery thumbnail
     ("1600", 1600)     # Lightbox thumbnail
-]
+]  # Legacy fixed names, see thumb_path
+THUMB_WIDTHS = [320, 640, 1024, 1600]        # srcset width ladder (--thumb-widths)
+THUMB_FORMATS = ["AVIF", "WEBP", "JPEG"]     # Best first (--thumb-formats); ones Pillow can't write are skipped
+THUMB_QUALITY = {"AVIF": 60, "WEBP": 85, "JPEG": 82}
+THUMB_EXTENSIONS = {"AVIF": "avif", "WEBP": "webp", "JPEG": "jpg"}
+THUMB_MIME_TYPES = {"AVIF": "image/avif", "WEBP": "image/webp", "JPEG": "image/jpeg"}
+THUMB_CACHE_EXTENSIONS = {".avif", ".webp", ".jpg", ".tmp"}
+THUMB_REDUCING_GAP = 3.0  # Pillow box-reduces first when shrinking by more than this factor
+PLACEHOLDER_WIDTH = 16     # Pixels across the inline blurred preview
+PLACEHOLDER_QUALITY = 40
+DHASH_SIZE = 8             # Bits per side of the perceptual hash (64 bits)
+DEFAULT_DUPLICATE_DISTANCE = 6  # Max differing dHash bits for two images to count as near-duplicates
+THUMB_RENDER_VERSION = 2  # Bump when rendering changes so cached thumbnails are regenerated
 
 def norm_path(p):
     p = os.path.normpath(p)
@@ -38,48 +101,548 @@ def norm_path(p):
     return p
 
 def haversine(lat1, lon1, lat2, lon2):
-    R = 6371.0  # Earth radius in km
-    phi1, phi2 = math.radians(lat1), math.radians(lat2)
-    d_phi = math.radians(lat2 - lat1)
-    d_lambda = math.radians(lon2 - lon1)
-    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+    # Accepts scalars or numpy arrays
+    R = EARTH_RADIUS_KM
+    phi1, phi2 = np.radians(lat1), np.radians(lat2)
+    d_phi = np.radians(np.subtract(lat2, lat1))
+    d_lambda = np.radians(np.subtract(lon2, lon1))
+    a = np.sin(d_phi / 2) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin(d_lambda / 2) ** 2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
     return R * c
 
+# --------- INSTRUMENTATION ---------
+def cpu_seconds():
+    # User + system time of this process and its reaped children (the
+    # thumbnail pool's workers are reaped when the pool shuts down)
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+class Metrics:
+    # Per-run stage timings and counters. Stages accumulate across calls;
+    # per-item stages timed on worker threads ("exif_read") sum thread time,
+    # so they can exceed the wall time of the stage that contains them.
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.running = {}
+        self.counters = defaultdict(int)
+        self.extra = {}
+        self.started = time.time()
+
+    def add_time(self, name, wall, cpu):
+        with self.lock:
+            stage = self.stages.setdefault(name, {"wall": 0.0, "cpu": 0.0, "calls": 0})
+            stage["wall"] += wall
+            stage["cpu"] += cpu
+            stage["calls"] += 1
+
+    @contextmanager
+    def stage(self, name, per_thread=False):
+        cpu_clock = time.thread_time if per_thread else cpu_seconds
+        wall0, cpu0 = time.perf_counter(), cpu_clock()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - wall0, cpu_clock() - cpu0)
+
+    def start(self, name):
+        # For main-thread spans too long to wrap in a with-block
+        self.running[name] = (time.perf_counter(), cpu_seconds())
+
+    def stop(self, name):
+        wall0, cpu0 = self.running.pop(name)
+        self.add_time(name, time.perf_counter() - wall0, cpu_seconds() - cpu0)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def to_dict(self):
+        return {
+            "started": datetime.datetime.fromtimestamp(self.started, datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            "wall": round(time.time() - self.started, 6),
+            "stages": {name: {k: round(v, 6) for k, v in stage.items()} for name, stage in self.stages.items()},
+            "counters": dict(sorted(self.counters.items())),
+            **self.extra
+        }
+
+    def save(self, path):
+        # Appends one line per run, so CI can keep the file as a history
+        if os.path.dirname(path):
+            ensure_dir(os.path.dirname(path))
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(self.to_dict(), separators=(',', ':')) + "\n")
+
+    def summary_lines(self):
+        lines = []
+        for name, stage in self.stages.items():
+            lines.append(f"  {name}: {stage['wall']:.3f}s wall, {stage['cpu']:.3f}s CPU ({stage['calls']} calls)")
+        return lines
+
+metrics = Metrics()
+
+# --------- OFFLINE REVERSE GEOCODING ---------
+def latlon_to_unit(lat, lon):
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    lon = np.radians(np.asarray(lon, dtype=np.float64))
+    cos_lat = np.cos(lat)
+    return np.stack([cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)], axis=-1)
+
+def chord_to_km(chord):
+    # Straight-line distance between two points on the unit sphere -> great-circle km
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.clip(np.asarray(chord) / 2, 0.0, 1.0))
+
+CITY_NODE_DTYPE = np.dtype([("start", "<i4"), ("end", "<i4"), ("dim", "<i1"), ("split", "<f8"), ("left", "<i4"), ("right", "<i4")])
+
+class CityLabels:
+    # "City, Country" per row, formatted on access from an interned string
+    # table rather than kept as tens of thousands of separate strings
+    def __init__(self, strings, city_ids, country_ids):
+        self.strings = strings
+        self.city_ids = city_ids
+        self.country_ids = country_ids
+
+    def __len__(self):
+        return len(self.city_ids)
+
+    def __getitem__(self, i):
+        return f"{self.strings[self.city_ids[i]]}, {self.strings[self.country_ids[i]]}"
+
+class CityIndex:
+    # Static k-d tree over the unit-sphere positions of every city. The chord
+    # between two points on the sphere grows monotonically with their
+    # great-circle distance, so the nearest point in 3D is the nearest city.
+    LEAF_SIZE = 16
+
+    def __init__(self, lats, lons, labels):
+        self.lats = np.asarray(lats, dtype=np.float64)
+        self.lons = np.asarray(lons, dtype=np.float64)
+        self.labels = labels
+        self._build(latlon_to_unit(self.lats, self.lons))
+
+    @classmethod
+    def from_csv(cls, csv_path):
+        strings, interned = [], {}
+        lats, lons, city_ids, country_ids = [], [], [], []
+        with open(csv_path, "r", newline="", encoding="utf-8-sig") as f:
+            for row in csv.DictReader(f):
+                lats.append(float(row["lat"]))
+                lons.append(float(row["lng"]))
+                for name, ids in ((row["city"], city_ids), (row["country"], country_ids)):
+                    name = " ".join(name.splitlines())
+                    if name not in interned:
+                        interned[name] = len(strings)
+                        strings.append(name)
+                    ids.append(interned[name])
+        labels = CityLabels(strings, np.array(city_ids, dtype=np.int32), np.array(country_ids, dtype=np.int32))
+        return cls(lats, lons, labels)
+
+    def save(self, table_dir, source):
+        # One .npy per array so load() can memory-map them; meta.json goes last
+        # and is what marks the table complete
+        ensure_dir(table_dir)
+        meta_path = os.path.join(table_dir, "meta.json")
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+        nodes = np.empty(len(self._starts), dtype=CITY_NODE_DTYPE)
+        nodes["start"], nodes["end"], nodes["dim"] = self._starts, self._ends, self._dims
+        nodes["split"], nodes["left"], nodes["right"] = self._splits, self._lefts, self._rights
+        arrays = {
+            "latlon": np.column_stack([self.lats, self.lons]),
+            "order": self.order.astype(np.int32),
+            "xyz": self.xyz,
+            "nodes": nodes,
+            "names": np.column_stack([self.labels.city_ids, self.labels.country_ids]).astype(np.int32)
+        }
+        for name, arr in arrays.items():
+            np.save(os.path.join(table_dir, name + ".npy"), arr)
+        with open(os.path.join(table_dir, "strings.txt"), "w", encoding="utf-8") as f:
+            f.write("\n".join(self.labels.strings))
+        meta = {"version": CITY_TABLE_VERSION, "count": len(self.order), "leaf_size": self.LEAF_SIZE, "source": source}
+        with open(meta_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(meta_path + ".tmp", meta_path)
+
+    @classmethod
+    def load(cls, table_dir, source=None):
+        # Raises ValueError when the table is from another version or, given
+        # the CSV's current size/hash as source, was compiled from another file
+        with open(os.path.join(table_dir, "meta.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("version") != CITY_TABLE_VERSION or meta.get("leaf_size") != cls.LEAF_SIZE:
+            raise ValueError("city table was compiled by another version")
+        if source is not None and meta.get("source") != source:
+            raise ValueError("city table is older than its CSV")
+
+        def array(name, mmap_mode="r"):
+            # Plain ndarray views of the mapping; np.memmap adds per-operation overhead
+            return np.asarray(np.load(os.path.join(table_dir, name + ".npy"), mmap_mode=mmap_mode))
+
+        self = cls.__new__(cls)
+        latlon = array("latlon")
+        self.lats, self.lons = latlon[:, 0], latlon[:, 1]
+        self.order = array("order")
+        self.xyz = array("xyz")
+        if len(self.order) != meta["count"]:
+            raise ValueError("city table is incomplete")
+        nodes = array("nodes", mmap_mode=None)
+        self._starts, self._ends = nodes["start"].tolist(), nodes["end"].tolist()
+        self._dims, self._splits = nodes["dim"].tolist(), nodes["split"].tolist()
+        self._lefts, self._rights = nodes["left"].tolist(), nodes["right"].tolist()
+        names = array("names")
+        with open(os.path.join(table_dir, "strings.txt"), "r", encoding="utf-8") as f:
+            strings = f.read().split("\n")
+        self.labels = CityLabels(strings, names[:, 0], names[:, 1])
+        return self
+
+    def _build(self, xyz):
+        order = np.arange(len(xyz))
+        starts, ends, dims, splits, lefts, rights = [], [], [], [], [], []
+        stack = [(0, len(xyz), -1, False)]
+        while stack:
+            start, end, parent, is_right = stack.pop()
+            node = len(starts)
+            if parent >= 0:
+                (rights if is_right else lefts)[parent] = node
+            starts.append(start)
+            ends.append(end)
+            dims.append(0)
+            splits.append(0.0)
+            lefts.append(-1)
+            rights.append(-1)
+            if end - start <= self.LEAF_SIZE:
+                continue
+            pts = xyz[order[start:end]]
+            dim = int(np.argmax(pts.max(axis=0) - pts.min(axis=0)))
+            mid = (end - start) // 2
+            part = np.argpartition(pts[:, dim], mid)
+            order[start:end] = order[start:end][part]
+            dims[node] = dim
+            splits[node] = float(xyz[order[start + mid], dim])
+            stack.append((start + mid, end, node, True))
+            stack.append((start, start + mid, node, False))
+        self.order = order
+        self.xyz = xyz[order]
+        # Plain lists are much faster than numpy scalars for the traversal loop
+        self._starts, self._ends = starts, ends
+        self._dims, self._splits = dims, splits
+        self._lefts, self._rights = lefts, rights
+
+    def _nearest_xyz(self, q):
+        best_d2, best_i = np.inf, -1
+        qs = (float(q[0]), float(q[1]), float(q[2]))
+        stack = [(0, 0.0)]
+        while stack:
+            node, bound = stack.pop()
+            if bound >= best_d2:
+                continue
+            left = self._lefts[node]
+            if left < 0:
+                start = self._starts[node]
+                diff = self.xyz[start:self._ends[node]] - q
+                d2 = np.einsum("ij,ij->i", diff, diff)
+                k = int(d2.argmin())
+                if d2[k] < best_d2:
+                    best_d2, best_i = float(d2[k]), start + k
+                continue
+            delta = qs[self._dims[node]] - self._splits[node]
+            if delta <= 0:
+                near, far = left, self._rights[node]
+            else:
+                near, far = self._rights[node], left
+            stack.append((far, delta * delta))
+            stack.append((near, 0.0))
+        return best_i, best_d2
+
+    def query(self, lats, lons):
+        # N coordinates in, N (city row, great-circle km) out. The unit vectors
+        # are computed together; each point then walks the tree on its own.
+        qs = latlon_to_unit(np.atleast_1d(lats), np.atleast_1d(lons))
+        idx = np.empty(len(qs), dtype=np.int64)
+        d2 = np.empty(len(qs), dtype=np.float64)
+        for i, q in enumerate(qs):
+            idx[i], d2[i] = self._nearest_xyz(q)
+        return self.order[idx], chord_to_km(np.sqrt(d2))
+
+    def nearest(self, lat, lon):
+        idx, dist_km = self.query(lat, lon)
+        return int(idx[0]), float(dist_km[0])
+
+    def lookup(self, lats, lons, max_km=OFFLINE_MATCH_KM):
+        # "City, Country" for every coordinate with a city within max_km, else None
+        idx, dist_km = self.query(lats, lons)
+        return [self.labels[i] if d < max_km else None for i, d in zip(idx, dist_km)]
+
+_city_index = None  # False once it is known there is no table to load
+
+def city_table_source(csv_path):
+    # By content, so a fresh checkout (new mtimes) keeps a cached table
+    return {"size": os.path.getsize(csv_path), "sha1": file_sha1(csv_path)}
+
+def build_city_table(csv_path=WORLDCITIES_CSV, table_dir=DEFAULT_CITY_TABLE):
+    city_index = CityIndex.from_csv(csv_path)
+    city_index.save(table_dir, city_table_source(csv_path))
+    return city_index
+
+def get_city_index(table_dir=DEFAULT_CITY_TABLE, csv_path=WORLDCITIES_CSV):
+    # Loaded on first lookup from the compiled table, which is rebuilt when
+    # the CSV changes. Without the CSV a previously compiled table is used;
+    # with neither this is None and every lookup goes to geopy.
+    global _city_index
+    if _city_index is None:
+        source = city_table_source(csv_path) if os.path.exists(csv_path) else None
+        try:
+            _city_index = CityIndex.load(table_dir, source)
+        except (OSError, ValueError, KeyError):
+            if source is None:
+                print(f"Warning: no city table ({csv_path} is missing and {table_dir} has not been compiled); "
+                      f"place names fall back to geopy")
+                _city_index = False
+                return None
+            try:
+                _city_index = build_city_table(csv_path, table_dir)
+            except OSError as e:
+                print(f"Warning: could not save compiled city table to {table_dir}: {e}")
+                _city_index = CityIndex.from_csv(csv_path)
+    return _city_index or None
+
 # City/country lookup uses SimpleMaps world cities database (https://simplemaps.com/data/world-cities)
 def get_city_country(lat, lon):
     # 1. Try offline lookup (SimpleMaps)
     # Find the closest city within 25km
-    subset = worldcities_df.copy()
-    subset["distance"] = ((subset["lat"] - lat)**2 + (subset["lng"] - lon)**2).pow(0.5)
-    closest = subset.loc[subset["distance"].idxmin()]
-    # Calculate haversine for accuracy
-    def haversine(lat1, lon1, lat2, lon2):
-        R = 6371.0
-        phi1, phi2 = math.radians(lat1), math.radians(lat2)
-        d_phi = math.radians(lat2 - lat1)
-        d_lambda = math.radians(lon2 - lon1)
-        a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
-        c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-        return R * c
-    dist_km = haversine(lat, lon, closest["lat"], closest["lng"])
-    if dist_km < 25:
-        return f"{closest['city']}, {closest['country']}"
+    city_index = get_city_index()
+    if city_index is not None:
+        idx, dist_km = city_index.nearest(lat, lon)
+        if dist_km < OFFLINE_MATCH_KM:
+            return city_index.labels[idx]
+    return reverse_geocode_remote(lat, lon)
+
+def geopy_place(geocoder, lat, lon):
+    location = geocoder.reverse((lat, lon), language='en', addressdetails=True, timeout=3)
+    address = location.raw.get('address', {})
+    city = address.get('city') or address.get('town') or address.get('village') or address.get('hamlet')
+    country = address.get('country')
+    if city and country:
+        return f"{city}, {country}"
+    elif country:
+        return country
+    return None
+
+def unknown_place(lat, lon):
+    return f"Unknown City/Country ({lat:.5f},{lon:.5f})"
+
+_geolocator = None
+_geolocator_loaded = False
+
+def get_geolocator():
+    # Nominatim client, or None without geopy; imported on first use
+    global _geolocator, _geolocator_loaded
+    if not _geolocator_loaded:
+        _geolocator_loaded = True
+        try:
+            from geopy.geocoders import Nominatim
+            _geolocator = Nominatim(user_agent=GEOPY_USER_AGENT)
+        except ImportError:
+            _geolocator = None
+    return _geolocator
+
+def reverse_geocode_remote(lat, lon):
     # 2. Fallback to geopy lookup
+    geolocator = get_geolocator()
     if geolocator:
         try:
-            location = geolocator.reverse((lat, lon), language='en', addressdetails=True, timeout=3)
-            address = location.raw.get('address', {})
-            city = address.get('city') or address.get('town') or address.get('village') or address.get('hamlet')
-            country = address.get('country')
-            if city and country:
-                return f"{city}, {country}"
-            elif country:
-                return country
+            place = geopy_place(geolocator, lat, lon)
+            if place:
+                return place
         except Exception as e:
             print(f"Warning: geopy failed for ({lat},{lon}): {e}")
     # 3. Fallback to raw coordinates
-    return f"Unknown City/Country ({lat:.5f},{lon:.5f})"
+    return unknown_place(lat, lon)
+
+def quantize_coord(lat, lon, precision=DEFAULT_GEOCODE_PRECISION):
+    scale = 10 ** precision
+    return (int(round(lat * scale)), int(round(lon * scale)))
+
+class GeocodeCache:
+    # Persistent {quantized (lat, lon): place} store shared by the offline and
+    # geopy lookups. Only real place names are cached; the raw-coordinate
+    # fallback is retried on the next run.
+    def __init__(self, path, precision=DEFAULT_GEOCODE_PRECISION, ttl_days=DEFAULT_GEOCODE_TTL_DAYS, max_entries=DEFAULT_GEOCODE_MAX_ENTRIES):
+        if os.path.dirname(path):
+            ensure_dir(os.path.dirname(path))
+        self.precision = precision
+        self.ttl_days = ttl_days
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS places ("
+            " precision INTEGER, lat_q INTEGER, lon_q INTEGER, place TEXT, source TEXT, updated REAL,"
+            " PRIMARY KEY (precision, lat_q, lon_q))"
+        )
+        self.conn.commit()
+
+    def key(self, lat, lon):
+        return quantize_coord(lat, lon, self.precision)
+
+    def get_many(self, coords):
+        found = {}
+        oldest = time.time() - self.ttl_days * 86400 if self.ttl_days else 0
+        with self.lock:
+            for coord in coords:
+                lat_q, lon_q = self.key(*coord)
+                row = self.conn.execute(
+                    "SELECT place FROM places WHERE precision = ? AND lat_q = ? AND lon_q = ? AND updated >= ?",
+                    (self.precision, lat_q, lon_q, oldest)
+                ).fetchone()
+                if row:
+                    found[coord] = row[0]
+                    self.hits += 1
+                else:
+                    self.misses += 1
+        return found
+
+    def put_many(self, items):
+        # items: iterable of ((lat, lon), place, source)
+        now = time.time()
+        rows = [(self.precision, *self.key(*coord), place, source, now) for coord, place, source in items]
+        if not rows:
+            return
+        with self.lock:
+            self.conn.executemany("INSERT OR REPLACE INTO places VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self.conn.commit()
+
+    def evict(self):
+        with self.lock:
+            if self.ttl_days:
+                self.conn.execute("DELETE FROM places WHERE updated < ?", (time.time() - self.ttl_days * 86400,))
+            if self.max_entries:
+                self.conn.execute(
+                    "DELETE FROM places WHERE rowid NOT IN (SELECT rowid FROM places ORDER BY updated DESC LIMIT ?)",
+                    (self.max_entries,)
+                )
+            self.conn.commit()
+
+    def close(self):
+        self.evict()
+        self.conn.close()
+
+class ReverseGeocodeQueue:
+    # Feeds a geopy-style geocoder from a background thread, one request at a
+    # time and never faster than min_interval (Nominatim allows 1 req/s).
+    # Requests for the same quantized coordinate share one lookup.
+    def __init__(self, geocoder, min_interval=NOMINATIM_MIN_INTERVAL, precision=DEFAULT_GEOCODE_PRECISION):
+        self.geocoder = geocoder
+        self.min_interval = min_interval
+        self.precision = precision
+        self.calls = 0
+        self._futures = {}
+        self._queue = queue.Queue()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, lat, lon):
+        key = quantize_coord(lat, lon, self.precision)
+        fut = self._futures.get(key)
+        if fut is None:
+            fut = Future()
+            self._futures[key] = fut
+            self._queue.put((lat, lon, fut))
+        return fut
+
+    def _run(self):
+        last = 0.0
+        while True:
+            item = self._queue.get()
+            if item is None or self._stopped:
+                break
+            lat, lon, fut = item
+            if not fut.set_running_or_notify_cancel():
+                continue
+            wait = last + self.min_interval - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            self.calls += 1
+            try:
+                fut.set_result(geopy_place(self.geocoder, lat, lon))
+            except Exception as e:
+                print(f"Warning: geopy failed for ({lat},{lon}): {e}")
+                fut.set_result(None)
+            last = time.monotonic()
+
+    def pending(self):
+        return sum(1 for fut in self._futures.values() if not fut.done())
+
+    def close(self):
+        self._stopped = True
+        for fut in self._futures.values():
+            fut.cancel()
+        self._queue.put(None)
+
+def resolve_places(coords, cache=None, remote=None, budget=None):
+    # Batch version of get_city_country: every coordinate the run needs is
+    # deduplicated, looked up in the persistent cache, and the rest matched
+    # against the city table in one call (a k-d tree walk per coordinate, no
+    # per-call setup or geopy round trips). Offline misses go to the
+    # rate-limited geopy queue; whatever it hasn't answered within `budget`
+    # seconds maps to None and is neither cached nor saved, so the next run
+    # asks again. `remote` may also be a function returning the queue, so
+    # geopy is only loaded when the city table actually misses something.
+    # Returns {(lat, lon): "City, Country" or None}.
+    unique = list(dict.fromkeys((float(lat), float(lon)) for lat, lon in coords))
+    if not unique:
+        return {}
+    places = cache.get_many(unique) if cache else {}
+    todo = [coord for coord in unique if coord not in places]
+    if not todo:
+        return places
+    city_index = get_city_index()
+    if city_index is not None:
+        lats, lons = np.array(todo, dtype=np.float64).T
+        labels = city_index.lookup(lats, lons)
+    else:
+        labels = [None] * len(todo)
+    resolved = []
+    misses = []
+    for coord, label in zip(todo, labels):
+        if label:
+            places[coord] = label
+            resolved.append((coord, label, "offline"))
+        else:
+            misses.append(coord)
+    if misses and callable(remote):
+        remote = remote()
+    if misses and remote is not None:
+        futures = [(coord, remote.submit(*coord)) for coord in misses]
+        deadline = None if budget is None else time.monotonic() + budget
+        for coord, fut in futures:
+            try:
+                timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+                place = fut.result(timeout=timeout)
+            except (FutureTimeoutError, CancelledError):
+                places[coord] = None
+                continue
+            if place:
+                places[coord] = place
+                resolved.append((coord, place, "geopy"))
+            else:
+                places[coord] = unknown_place(*coord)
+    elif city_index is None:
+        # Nothing to look places up in: left for a run that has the table
+        for coord in misses:
+            places[coord] = None
+    else:
+        for coord in misses:
+            places[coord] = reverse_geocode_remote(*coord)
+    if cache:
+        cache.put_many(resolved)
+    return places
 
 def dms_coordinates(val):
     deg = int(abs(val))
@@ -114,20 +677,46 @@ def extract_gps_from_exif(exif_dict):
     lon = convert_gps(gps.get(piexif.GPSIFD.GPSLongitude), gps.get(piexif.GPSIFD.GPSLongitudeRef))
     return lat, lon
 
-def get_image_metadata(img_path):
-    width, height = "", ""
-    date_taken, gps_info = "", None
+def empty_exif():
+    return {"0th": {}, "Exif": {}, "GPS": {}, "1st": {}, "thumbnail": None}
+
+def empty_image_record(img_path, error=None):
+    return {
+        "path": img_path,
+        "width": "",
+        "height": "",
+        "taken": "",
+        "gps": None,
+        "orientation": None,
+        "exif": None,
+        "error": error
+    }
+
+def read_image_record(img_path):
+    # Everything the indexer needs from one image, from a single open: PIL only
+    # parses the header (pixels are never decoded) and the raw EXIF block is
+    # parsed once with piexif. The parsed dict is kept for the geotag write.
+    record = empty_image_record(img_path)
     try:
         with Image.open(img_path) as img:
-            width, height = img.size
-            exif = img._getexif()
-            if exif:
-                exif_data = {ExifTags.TAGS.get(k, k): v for k, v in exif.items()}
-                date_taken = exif_data.get("DateTimeOriginal", "")
-                gps_info = exif_data.get("GPSInfo", None)
+            record["width"], record["height"] = img.size
+            exif_bytes = img.info.get("exif")
+        if exif_bytes:
+            exif = piexif.load(exif_bytes)
+            record["exif"] = exif
+            taken = exif.get("Exif", {}).get(piexif.ExifIFD.DateTimeOriginal, b"")
+            record["taken"] = taken.decode("ascii", "replace") if isinstance(taken, bytes) else taken
+            record["orientation"] = exif.get("0th", {}).get(piexif.ImageIFD.Orientation)
+            gps = exif.get("GPS", {})
+            if gps.get(piexif.GPSIFD.GPSLatitude) and gps.get(piexif.GPSIFD.GPSLongitude):
+                record["gps"] = gps
     except Exception as e:
-        return width, height, date_taken, gps_info, str(e)
-    return width, height, date_taken, gps_info, None
+        record["error"] = str(e)
+    return record
+
+def get_image_metadata(img_path):
+    record = read_image_record(img_path)
+    return record["width"], record["height"], record["taken"], record["gps"], record["error"]
 
 def get_lat_lon(gps_info):
     def get_if_exist(data, key):
@@ -142,9 +731,9 @@ def get_lat_lon(gps_info):
     try:
         lat = convert_to_degrees(get_if_exist(gps_info, 2))
         lon = convert_to_degrees(get_if_exist(gps_info, 4))
-        if get_if_exist(gps_info, 1) == 'S':
+        if get_if_exist(gps_info, 1) in ('S', b'S'):
             lat = -lat
-        if get_if_exist(gps_info, 3) == 'W':
+        if get_if_exist(gps_info, 3) in ('W', b'W'):
             lon = -lon
         return lat, lon
     except Exception:
@@ -183,15 +772,10 @@ def get_image_datetime(image_path, debug=False):
         return None
 
 def image_has_gps(image_path, debug=False):
-    try:
-        exif_dict = piexif.load(image_path)
-        gps = exif_dict.get("GPS", {})
-        has_gps = gps.get(piexif.GPSIFD.GPSLatitude) and gps.get(piexif.GPSIFD.GPSLongitude)
-        return bool(has_gps)
-    except Exception as e:
-        if debug:
-            print(f"[DEBUG] Error reading GPS from {image_path}: {e}")
-        return False
+    record = read_image_record(image_path)
+    if record["error"] and debug:
+        print(f"[DEBUG] Error reading GPS from {image_path}: {record['error']}")
+    return record["gps"] is not None
 
 def all_image_files(image_dir, debug=False):
     files_found = []
@@ -205,75 +789,417 @@ def all_image_files(image_dir, debug=False):
                     print(f"[DEBUG] Found image file: {path}")
     return files_found
 
+def read_ahead(func, items, workers=DEFAULT_IO_WORKERS, window=None):
+    # Yields (item, func(item)) in input order while a thread pool runs func
+    # on the items ahead. At most `window` results are in flight or waiting,
+    # so a slow consumer holds the readers back instead of buffering the
+    # whole directory. Exceptions surface when their item is reached.
+    # For I/O-bound work (stat, hashing, header reads on network storage),
+    # where threads overlap the round trips.
+    if workers <= 1:
+        for item in items:
+            yield item, func(item)
+        return
+    window = window or workers * 4
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        try:
+            for item in items:
+                pending.append((item, pool.submit(func, item)))
+                if len(pending) >= window:
+                    done, fut = pending.popleft()
+                    yield done, fut.result()
+            while pending:
+                done, fut = pending.popleft()
+                yield done, fut.result()
+        finally:
+            for _, fut in pending:
+                fut.cancel()
+
 def get_all_gpx_points(gpx_dir, debug=False):
-    points = []
-    for root, dirs, files in os.walk(gpx_dir):
-        for file in files:
-            ext = os.path.splitext(file)[1].lower()
-            if ext == '.gpx':
-                gpx_file = os.path.join(root, file)
-                try:
-                    with open(gpx_file, 'r', encoding='utf-8') as f:
-                        gpx = gpxpy.parse(f)
-                        for track in gpx.tracks:
-                            for segment in track.segments:
-                                for p in segment.points:
-                                    if p.time:
-                                        pt_time = p.time
-                                        if pt_time.tzinfo:
-                                            pt_time = pt_time.astimezone(datetime.timezone.utc)
-                                        points.append({
-                                            'lat': p.latitude,
-                                            'lon': p.longitude,
-                                            'time': pt_time
-                                        })
-                except Exception as e:
-                    if debug:
-                        print(f"[DEBUG] Error parsing GPX file {gpx_file}: {e}")
-    points.sort(key=lambda x: x['time'])
-    return points
-
-def format_time(dt):
-    return dt.strftime('%Y-%m-%d')
+    track = load_gpx_track(gpx_dir, debug=debug, cache_dir=DEFAULT_GPX_CACHE_DIR)
+    return [track.point(i) for i in range(len(track))]
 
-def time_difference_in_days_hours(photo_time, gpx_time):
-    delta = gpx_time - photo_time
-    seconds = abs(int(delta.total_seconds()))
+def format_offset(offset_seconds):
+    seconds = abs(int(offset_seconds))
     days = seconds // 86400
     hours = (seconds % 86400) // 3600
-    sign = "-" if delta.total_seconds() < 0 else "+"
+    sign = "-" if offset_seconds < 0 else "+"
     return f"{sign}{days}d {hours}h"
 
-def find_nearest_gpx_point(img_dt, gpx_points, window_seconds=3600):
-    img_dt_utc = img_dt
-    if img_dt_utc.tzinfo:
-        img_dt_utc = img_dt_utc.astimezone(datetime.timezone.utc)
+def time_difference_in_days_hours(photo_time, gpx_time):
+    return format_offset((gpx_time - photo_time).total_seconds())
+
+def to_epoch(dt):
+    # Naive datetimes are treated as UTC, like the EXIF/GPX times they come from
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+    return int(dt.timestamp())
+
+class TrackStore:
+    # All GPX points as parallel arrays sorted by UTC epoch seconds, so a photo
+    # is matched with a binary search instead of a scan over every point.
+    def __init__(self, epochs, lats, lons):
+        epochs = np.asarray(epochs, dtype=np.int64)
+        order = np.argsort(epochs, kind="stable")
+        self.epochs = epochs[order]
+        self.lats = np.asarray(lats, dtype=np.float64)[order]
+        self.lons = np.asarray(lons, dtype=np.float64)[order]
+
+    @classmethod
+    def from_points(cls, points):
+        return cls(
+            [to_epoch(p['time']) for p in points],
+            [p['lat'] for p in points],
+            [p['lon'] for p in points]
+        )
+
+    def __len__(self):
+        return len(self.epochs)
+
+    def point(self, i):
+        return {
+            'lat': float(self.lats[i]),
+            'lon': float(self.lons[i]),
+            'time': datetime.datetime.fromtimestamp(int(self.epochs[i]), datetime.timezone.utc)
+        }
+
+    def match_batch(self, epochs, window_seconds=3600):
+        # For every photo time: index of the closest point within the window,
+        # of the last point at or before it and of the first point after it
+        # (-1 where there is none). Ties go to the earlier point.
+        t = np.asarray(epochs, dtype=np.int64)
+        n = len(self.epochs)
+        none = np.full(len(t), -1, dtype=np.int64)
+        if n == 0:
+            return none, none.copy(), none.copy()
+        after = np.searchsorted(self.epochs, t, side="right")
+        last_before = after - 1
+        has_before = last_before >= 0
+        # First of any points sharing the before timestamp
+        before = np.where(has_before, np.searchsorted(self.epochs, self.epochs[np.maximum(last_before, 0)], side="left"), -1)
+        has_after = after < n
+        after = np.where(has_after, after, -1)
+        d_before = np.where(has_before, t - self.epochs[np.maximum(before, 0)], np.iinfo(np.int64).max)
+        d_after = np.where(has_after, self.epochs[np.maximum(after, 0)] - t, np.iinfo(np.int64).max)
+        best = np.where(d_before <= d_after, before, after)
+        best = np.where(np.minimum(d_before, d_after) < window_seconds, best, -1)
+        return best, before, after
+
+    def match(self, img_dt, window_seconds=3600):
+        best, before, after = (int(i[0]) for i in self.match_batch([to_epoch(img_dt)], window_seconds))
+        return tuple(self.point(i) if i >= 0 else None for i in (best, before, after))
+
+def interpolate_positions(track, epochs, before, after, max_gap=DEFAULT_INTERP_MAX_GAP, max_speed_kmh=DEFAULT_INTERP_MAX_SPEED):
+    # Position of every photo along the great circle between its bracketing
+    # points, linear in time. Returns (lats, lons, ok) where ok is False when
+    # a photo isn't bracketed, the fixes are more than max_gap seconds apart,
+    # or covering the distance would need more than max_speed_kmh.
+    t = np.asarray(epochs, dtype=np.int64)
+    before = np.asarray(before, dtype=np.int64)
+    after = np.asarray(after, dtype=np.int64)
+    ok = (before >= 0) & (after >= 0)
+    b, a = np.maximum(before, 0), np.maximum(after, 0)
+    if len(track) == 0:
+        b = a = np.zeros(len(t), dtype=np.int64)
+        track = TrackStore([0], [0.0], [0.0])
+    t0, t1 = track.epochs[b], track.epochs[a]
+    gap = np.maximum(t1 - t0, 1)
+    dist_km = haversine(track.lats[b], track.lons[b], track.lats[a], track.lons[a])
+    ok &= (t1 - t0 <= max_gap) & (dist_km / (gap / 3600.0) <= max_speed_kmh)
+    frac = np.clip((t - t0) / gap, 0.0, 1.0)[:, None]
+    p0 = latlon_to_unit(track.lats[b], track.lons[b])
+    p1 = latlon_to_unit(track.lats[a], track.lons[a])
+    omega = np.arccos(np.clip(np.einsum("ij,ij->i", p0, p1), -1.0, 1.0))[:, None]
+    sin_omega = np.sin(omega)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        slerp = (np.sin((1 - frac) * omega) * p0 + np.sin(frac * omega) * p1) / sin_omega
+    # Nearly coincident fixes: plain linear blend is exact enough
+    p = np.where(sin_omega > 1e-12, slerp, (1 - frac) * p0 + frac * p1)
+    p /= np.linalg.norm(p, axis=1)[:, None]
+    lats = np.degrees(np.arcsin(np.clip(p[:, 2], -1.0, 1.0)))
+    lons = np.degrees(np.arctan2(p[:, 1], p[:, 0]))
+    return lats, lons, ok
+
+# --------- COMPILED GPX CACHE ---------
+# Each .gpx file is parsed once into a .npy record array (epoch, lat, lon)
+# named after its content hash. Later runs memory-map the arrays and only
+# re-parse files whose size/mtime changed and whose content hash is new.
+GPX_POINT_DTYPE = np.dtype([("t", "<i8"), ("lat", "<f8"), ("lon", "<f8")])
+
+def gpx_local_name(tag):
+    return tag.rsplit("}", 1)[-1]
+
+def parse_gpx_time(text):
+    return datetime.datetime.fromisoformat(text.strip().replace("Z", "+00:00"))
+
+def iter_gpx_points_streaming(gpx_file):
+    # iterparse keeps peak memory flat for huge files: each <trkpt> is dropped
+    # from its segment as soon as it has been read.
+    segment = None
+    for event, elem in ET.iterparse(gpx_file, events=("start", "end")):
+        tag = gpx_local_name(elem.tag)
+        if event == "start":
+            if tag == "trkseg":
+                segment = elem
+            continue
+        if tag == "trkpt" and segment is not None:
+            time_text = None
+            for child in elem:
+                if gpx_local_name(child.tag) == "time":
+                    time_text = child.text
+                    break
+            if time_text:
+                try:
+                    yield to_epoch(parse_gpx_time(time_text)), float(elem.get("lat")), float(elem.get("lon"))
+                except ValueError:
+                    pass
+            del segment[:]
+        elif tag == "trkseg":
+            segment = None
+
+def iter_gpx_points_gpxpy(gpx_file):
+    import gpxpy
+    with open(gpx_file, 'r', encoding='utf-8') as f:
+        gpx = gpxpy.parse(f)
+    for track in gpx.tracks:
+        for segment in track.segments:
+            for p in segment.points:
+                if p.time:
+                    yield to_epoch(p.time), p.latitude, p.longitude
+
+def parse_gpx_file(gpx_file):
+    if os.path.getsize(gpx_file) >= GPX_STREAM_THRESHOLD:
+        points = iter_gpx_points_streaming(gpx_file)
     else:
-        img_dt_utc = img_dt_utc.replace(tzinfo=datetime.timezone.utc)
-    best_point = None
-    best_diff = window_seconds
-    before = None
-    after = None
-    for p in gpx_points:
-        pt_time = p['time']
-        pt_time_naive = pt_time.replace(tzinfo=None)
-        img_time_naive = img_dt_utc.replace(tzinfo=None)
-        if pt_time_naive <= img_time_naive:
-            if (before is None) or (pt_time_naive > before['time'].replace(tzinfo=None)):
-                before = p
-        if pt_time_naive > img_time_naive:
-            if (after is None) or (pt_time_naive < after['time'].replace(tzinfo=None)):
-                after = p
-        diff = abs((pt_time_naive - img_time_naive).total_seconds())
-        if diff < best_diff:
-            best_diff = diff
-            best_point = p
-    return best_point, before, after
+        points = iter_gpx_points_gpxpy(gpx_file)
+    return np.fromiter(points, dtype=GPX_POINT_DTYPE)
+
+def file_sha1(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def content_hash(path):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def load_compiled_gpx(gpx_files, cache_dir, debug=False):
+    index_path = os.path.join(cache_dir, "index.json")
+    try:
+        with open(index_path, "r", encoding="utf-8") as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        index = {}
+    ensure_dir(cache_dir)
+    new_index = {}
+    arrays = []
+    for gpx_file in gpx_files:
+        key = norm_path(gpx_file)
+        st = os.stat(gpx_file)
+        entry = index.get(key)
+        if not (entry and entry["size"] == st.st_size and entry["mtime_ns"] == st.st_mtime_ns):
+            entry = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha1": file_sha1(gpx_file)}
+        compiled = os.path.join(cache_dir, entry["sha1"] + ".npy")
+        try:
+            points = np.load(compiled, mmap_mode="r")
+        except (OSError, ValueError):
+            try:
+                points = parse_gpx_file(gpx_file)
+            except Exception as e:
+                if debug:
+                    print(f"[DEBUG] Error parsing GPX file {gpx_file}: {e}")
+                continue
+            tmp = compiled + ".tmp.npy"
+            np.save(tmp, points)
+            os.replace(tmp, compiled)
+            if debug:
+                print(f"[DEBUG] Compiled GPX file {gpx_file}: {len(points)} points")
+        new_index[key] = entry
+        arrays.append(points)
+    # Forget compiled tracks for GPX files that are gone or changed
+    live = {entry["sha1"] + ".npy" for entry in new_index.values()}
+    for name in os.listdir(cache_dir):
+        if name.endswith(".npy") and name not in live:
+            os.remove(os.path.join(cache_dir, name))
+    tmp_index = index_path + ".tmp"
+    with open(tmp_index, "w", encoding="utf-8") as f:
+        json.dump(new_index, f, indent=1, sort_keys=True)
+    os.replace(tmp_index, index_path)
+    return arrays
+
+def gpx_files_in(gpx_dir):
+    found = []
+    for root, dirs, files in os.walk(gpx_dir):
+        for file in files:
+            if os.path.splitext(file)[1].lower() == '.gpx':
+                found.append(os.path.join(root, file))
+    return sorted(found)
+
+def load_gpx_track(gpx_dir, debug=False, cache_dir=DEFAULT_GPX_CACHE_DIR):
+    gpx_files = gpx_files_in(gpx_dir)
+    if cache_dir:
+        arrays = load_compiled_gpx(gpx_files, cache_dir, debug=debug)
+    else:
+        arrays = []
+        for gpx_file in gpx_files:
+            try:
+                arrays.append(parse_gpx_file(gpx_file))
+            except Exception as e:
+                if debug:
+                    print(f"[DEBUG] Error parsing GPX file {gpx_file}: {e}")
+    points = np.concatenate(arrays) if arrays else np.empty(0, dtype=GPX_POINT_DTYPE)
+    return TrackStore(points["t"], points["lat"], points["lon"])
+
+def find_nearest_gpx_point(img_dt, gpx_points, window_seconds=3600):
+    if not isinstance(gpx_points, TrackStore):
+        gpx_points = TrackStore.from_points(gpx_points)
+    return gpx_points.match(img_dt, window_seconds=window_seconds)
+
+# --------- RUN REPORT ---------
+# Pass 3 writes one JSON record per image to a JSONL stream as it goes; the
+# summary keeps running totals, and the human-readable report is rendered
+# from the stream at the end instead of from strings held for every image.
+REPORT_TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+def report_point(img_dt, point, place_of, is_match=False, before=None):
+    # A GPX point as recorded for a photo: its offset from the photo time (in
+    # whole minutes, as reported), and for the point after the photo the
+    # distance from the point before it
+    offset = point['time'].replace(second=0, microsecond=0, tzinfo=None) - img_dt
+    record = {
+        "time": point['time'].strftime(REPORT_TIME_FORMAT),
+        "lat": point['lat'],
+        "lon": point['lon'],
+        "place": place_of(point),
+        "offset_s": int(offset.total_seconds()),
+        "different_day": point['time'].date() != img_dt.date(),
+        "is_match": is_match
+    }
+    if before is not None:
+        record["distance_km"] = float(haversine(before['lat'], before['lon'], point['lat'], point['lon']))
+    return record
+
+def closest_before_line(before):
+    warn = " (different day)" if before["different_day"] else ""
+    return f"  Closest Before: {before['time'][:10]} {before['place']} {format_offset(before['offset_s'])}{warn}"
+
+def closest_after_line(after):
+    dist_str = f"{after['distance_km']:.1f} km" if "distance_km" in after else ""
+    warn = " (different day)" if after["different_day"] else ""
+    return f"  Closest After: {after['time'][:10]} {after['place']} {format_offset(after['offset_s'])}{warn} {dist_str}"
+
+def report_lines(record):
+    # Detailed geotag output for one image record
+    path, status = record["path"], record["status"]
+    before, after = record.get("before"), record.get("after")
+    neighbours = [
+        closest_before_line(before) if before else "  No GPX point before photo.",
+        closest_after_line(after) if after else "  No GPX point after photo."
+    ]
+    if status == "missing_timestamp":
+        return [f"MISSING TIMESTAMP: {path}"]
+    if status == "geotag_error":
+        return [f"  Error reading geotag: {record['error']}"]
+    if status == "already_geotagged":
+        return [f"SKIP (already geotagged): {path}", f"  Photo geotag: {record['photo']['place']}"] + neighbours
+    if status == "no_match":
+        return [f"NO MATCH: {path}", f"  Photo Time: {record['taken'][:10]}"] + neighbours
+    if status == "rolled_back":
+        return [f"SKIP (geotag rolled back): {path}"] + neighbours
+    match = record["match"]
+    action = "WOULD UPDATE" if status == "would_update" else "UPDATED"
+    how = " (interpolated)" if match["interpolated"] else ""
+    lines = [f"{action}: {path} -> {match['place']} at {match['time'][:10]}{how}"]
+    if status == "geotag_failed":
+        lines.append(f"Error updating {path}: {record['error']}")
+    if before and not before["is_match"]:
+        lines.append(closest_before_line(before))
+    if after and not after["is_match"]:
+        lines.append(closest_after_line(after))
+    return lines
+
+class ReportSummary:
+    # Totals over the stream in constant memory: records per status, and the
+    # offset to the matched GPX point for photos that got one
+    def __init__(self):
+        self.statuses = defaultdict(int)
+        self.matched = 0
+        self.offset_total = 0
+        self.offset_max = 0
+
+    def add(self, record):
+        if record["type"] != "image":
+            return
+        self.statuses[record["status"]] += 1
+        match = record.get("match")
+        if match and not match["interpolated"]:
+            offset = abs(match["offset_s"])
+            self.matched += 1
+            self.offset_total += offset
+            self.offset_max = max(self.offset_max, offset)
+
+    def lines(self):
+        counts = ", ".join(f"{count} {status.replace('_', ' ')}" for status, count in sorted(self.statuses.items()))
+        lines = [f"Report records: {sum(self.statuses.values())} images ({counts or 'none'})"]
+        if self.matched:
+            lines.append(f"GPX match offset: mean {self.offset_total / self.matched / 60:.1f} min, max {self.offset_max / 60:.1f} min")
+        return lines
+
+class RunReport:
+    # JSONL stream of report records, flushed per record so a long run can be
+    # followed with tail -f. Without a path it lives in a temporary file.
+    def __init__(self, path=None):
+        self.path = path
+        if path:
+            if os.path.dirname(path):
+                ensure_dir(os.path.dirname(path))
+            self.file = open(path, "w+b")
+        else:
+            self.file = tempfile.TemporaryFile("w+b")
+        self.summary = ReportSummary()
+
+    def add(self, record):
+        self.file.write(json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n")
+        self.file.flush()
+        self.summary.add(record)
+
+    def records(self):
+        self.file.seek(0)
+        for line in self.file:
+            yield json.loads(line)
+
+    def images_by_taken(self):
+        # Image records newest first, undated last; only (key, offset) pairs
+        # are held in memory while sorting
+        index = []
+        self.file.seek(0)
+        offset = 0
+        for line in self.file:
+            record = json.loads(line)
+            if record["type"] == "image":
+                index.append(((record["taken"] is not None, record["taken"] or ""), offset))
+            offset += len(line)
+        index.sort(key=lambda item: item[0], reverse=True)
+        for _, offset in index:
+            self.file.seek(offset)
+            yield json.loads(self.file.readline())
+
+    def close(self):
+        self.file.close()
 
 # CHANGED: Added build_image_entry for consistent image structure
-def build_image_entry(path, title="", tags=None, added="", taken="", original_link="", location="", width="", height=""):
+def build_image_entry(path, title="", tags=None, added="", taken="", original_link="", location="", width="", height="", thumbs=None,
+                      placeholder="", color="", dhash=""):
     if tags is None:
         tags = []
+    if thumbs is None:
+        thumbs = []
     return {
         "path": path,
         "title": title,
@@ -283,7 +1209,11 @@ def build_image_entry(path, title="", tags=None, added="", taken="", original_li
         "original_link": original_link,
         "location": location,
         "width": width,
-        "height": height
+        "height": height,
+        "thumbs": thumbs,
+        "placeholder": placeholder,
+        "color": color,
+        "dhash": dhash
     }
 
 # --------- THUMBNAIL GENERATION FUNCTIONALITY ---------
@@ -291,58 +1221,877 @@ def ensure_dir(path):
     if not os.path.exists(path):
         os.makedirs(path)
 
-def thumb_path(img_path, size):
+def thumb_path(img_path, size, thumbs_dir=DEFAULT_THUMBS_DIR):
+    # Legacy name, still used by the frontend for entries without "thumbs"
     filename = os.path.splitext(os.path.basename(img_path))[0]
-    return os.path.join(DEFAULT_THUMBS_DIR, f"{filename}_{size}.webp")
+    return os.path.join(thumbs_dir, f"{filename}_{size}.webp")
 
-def generate_thumbnail(src_path, dest_path, max_width):
+def thumb_variants(thumbs):
+    # (path, width, format) for every variant an images.json "thumbs" value
+    # names: the compact {"base", "widths", "formats"} entry, or the variant
+    # list and {size: path} dict written by older versions
+    if isinstance(thumbs, dict) and "base" in thumbs:
+        by_extension = {ext: fmt for fmt, ext in THUMB_EXTENSIONS.items()}
+        return [(f"{thumbs['base']}_{width}.{ext}", width, by_extension[ext])
+                for width in thumbs["widths"] for ext in thumbs["formats"] if ext in by_extension]
+    if isinstance(thumbs, dict):
+        return [(src, int(size), "WEBP") for size, src in thumbs.items()]
+    formats = {mime: fmt for fmt, mime in THUMB_MIME_TYPES.items()}
+    return [(variant["src"], variant["width"], formats.get(variant.get("type"), "WEBP")) for variant in thumbs or []]
+
+def thumb_files(entry):
+    # Thumbnail paths referenced by an images.json entry, in any format it has had
+    return [path for path, _, _ in thumb_variants(entry.get("thumbs"))]
+
+_unwritable_formats = set()
+
+def writable_thumb_formats(formats=THUMB_FORMATS):
+    # The requested formats this Pillow can write, each missing one reported
+    # once per process. AVIF needs Pillow 11.3+ or the pillow-avif-plugin package.
+    Image.init()
+    for fmt in formats:
+        if fmt not in Image.SAVE and fmt not in _unwritable_formats:
+            _unwritable_formats.add(fmt)
+            print(f"Warning: this Pillow cannot write {fmt}; skipping {fmt} thumbnails")
+    return [fmt for fmt in formats if fmt in Image.SAVE]
+
+def thumb_key(digest):
+    # Changes whenever the source content or anything about the rendering does
+    params = f"{digest}:{sorted(THUMB_QUALITY.items())}:{THUMB_RENDER_VERSION}"
+    return hashlib.blake2b(params.encode(), digest_size=5).hexdigest()
+
+def thumb_base(img_path, digest, thumbs_dir=DEFAULT_THUMBS_DIR):
+    # Variants are named {base}_{width}.{ext}. The base is keyed by content,
+    # so images/a/IMG_1.jpg and images/b/IMG_1.jpg never share a thumbnail
+    # and an edited source gets new ones.
+    filename = os.path.splitext(os.path.basename(img_path))[0]
+    return norm_path(os.path.join(thumbs_dir, f"{filename}.{thumb_key(digest)}"))
+
+def plan_thumbnails(img_path, digest, width, height, thumbs_dir=DEFAULT_THUMBS_DIR, widths=THUMB_WIDTHS, formats=None):
+    # Every variant the source should have: one per ladder width below the
+    # source width (plus the source width itself when it is smaller than the
+    # top of the ladder) in every writable format.
+    # Returns [(dest_path, width, height, format)], largest first.
+    formats = writable_thumb_formats(formats or THUMB_FORMATS)
+    base = thumb_base(img_path, digest, thumbs_dir)
+    targets = sorted({w for w in widths if w < width} | {min(width, max(widths))}, reverse=True)
+    plan = []
+    for tw in targets:
+        th = height if tw == width else max(1, int(height * tw / width))
+        for fmt in formats:
+            plan.append((f"{base}_{tw}.{THUMB_EXTENSIONS[fmt]}", tw, th, fmt))
+    return plan
+
+def thumb_entry(plan, present):
+    # Compact images.json "thumbs" value for a plan: the gallery builds each
+    # URL from the base, so only widths with every format on disk are listed
+    if not plan:
+        return []
+    formats = list(dict.fromkeys(fmt for _, _, _, fmt in plan))
+    complete = {}
+    for dest_path, tw, _, _ in plan:
+        complete[tw] = complete.get(tw, True) and dest_path in present
+    widths = sorted(tw for tw, ok in complete.items() if ok)
+    if not widths:
+        return []
+    return {
+        "base": plan[0][0].rsplit("_", 1)[0],
+        "widths": widths,
+        "formats": [THUMB_EXTENSIONS[fmt] for fmt in formats]
+    }
+
+def save_thumbnail(img, dest_path, fmt="WEBP"):
+    # Written to a temp file and renamed, so an interrupted run never leaves a
+    # truncated thumbnail that later runs would take as done
+    if fmt == "JPEG" and img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+    elif img.mode not in ("RGB", "RGBA", "L"):
+        img = img.convert("RGBA" if img.mode.endswith("A") or "transparency" in img.info else "RGB")
+    tmp_path = f"{dest_path}.{os.getpid()}.{threading.get_ident()}.tmp"
     try:
-        with Image.open(src_path) as img:
-            w, h = img.size
+        img.save(tmp_path, fmt, quality=THUMB_QUALITY[fmt])
+        os.replace(tmp_path, dest_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def image_dhash(img):
+    # 64-bit difference hash as 16 hex digits: each bit says whether a pixel
+    # of a 9x8 grayscale copy is brighter than its right-hand neighbour
+    pixels = img.convert("L").resize((DHASH_SIZE + 1, DHASH_SIZE), Image.BOX).tobytes()
+    bits = 0
+    for row in range(DHASH_SIZE):
+        for col in range(DHASH_SIZE):
+            i = row * (DHASH_SIZE + 1) + col
+            bits = (bits << 1) | (pixels[i] > pixels[i + 1])
+    return f"{bits:0{DHASH_SIZE * DHASH_SIZE // 4}x}"
+
+def image_preview(img):
+    # Inline placeholder for the gallery: a PLACEHOLDER_WIDTH px WebP as a
+    # data URI (a few hundred bytes, blurred by the browser's upscaling) and
+    # the most common of a handful of quantized colours as a hex string, plus
+    # the perceptual hash used to find near-duplicates.
+    w, h = img.size
+    size = (PLACEHOLDER_WIDTH, max(1, round(h * PLACEHOLDER_WIDTH / w)))
+    tiny = img.convert("RGBA" if img.mode in ("RGBA", "LA", "PA") else "RGB").resize(size, Image.BOX)
+    buf = io.BytesIO()
+    tiny.save(buf, "WEBP", quality=PLACEHOLDER_QUALITY)
+    palette = tiny.convert("RGB").quantize(colors=4)
+    _, index = max(palette.getcolors())
+    r, g, b = palette.getpalette()[index * 3:index * 3 + 3]
+    return {
+        "placeholder": "data:image/webp;base64," + base64.b64encode(buf.getvalue()).decode("ascii"),
+        "color": f"#{r:02x}{g:02x}{b:02x}",
+        "dhash": image_dhash(img)
+    }
+
+def render_thumbnails(src_path, outputs, written=None):
+    # outputs: [(dest_path, max_width, format)]
+    # Decodes the source once and derives each width from the next larger one,
+    # encoding every format from the same resized pixels. For JPEGs, draft()
+    # has libjpeg decode straight at the smallest DCT scale (1/2, 1/4, 1/8)
+    # that is still at least as big as the largest output.
+    # Returns the placeholder preview and hash, taken from the smallest output (or from
+    # a minimal decode when there are no outputs).
+    outputs = sorted(outputs, key=lambda o: o[1], reverse=True)
+    with Image.open(src_path) as img:
+        w, h = img.size
+        largest = outputs[0][1] if outputs else PLACEHOLDER_WIDTH
+        if img.format == "JPEG" and w > largest:
+            img.draft(img.mode, (largest, max(1, int(h * largest / w))))
+        current = img
+        for dest_path, max_width, fmt in outputs:
             if w > max_width:
-                new_h = int(h * max_width / w)
-                img = img.resize((max_width, new_h), Image.LANCZOS)
-            img.save(dest_path, "WEBP", quality=85)
+                size = (max_width, max(1, int(h * max_width / w)))
+                if current.size != size:
+                    current = current.resize(size, Image.LANCZOS, reducing_gap=THUMB_REDUCING_GAP)
+            save_thumbnail(current, dest_path, fmt)
+            if written is not None:
+                written.append((dest_path, os.path.getsize(dest_path)))
+        return image_preview(current)
+
+def render_thumbnail(src_path, dest_path, max_width):
+    render_thumbnails(src_path, [(dest_path, max_width, "WEBP")])
+
+def generate_thumbnail(src_path, dest_path, max_width):
+    try:
+        render_thumbnail(src_path, dest_path, max_width)
     except Exception as e:
         print(f"Error generating thumbnail for {src_path}: {e}")
 
-def generate_thumbnails_for_all(images_dir=DEFAULT_IMAGE_DIR, thumbs_dir=DEFAULT_THUMBS_DIR, sizes=THUMB_SIZES, debug=False):
+def render_thumbnail_set(src_path, outputs):
+    # Process pool task: every missing variant for one source image, plus its
+    # placeholder preview.
+    # Returns (src_path, [(written dest path, bytes)], preview or None, error or None).
+    written = []
+    try:
+        preview = render_thumbnails(src_path, outputs, written)
+    except Exception as e:
+        return src_path, written, None, str(e)
+    return src_path, written, preview, None
+
+def generate_thumbnails_for_all(images_dir=DEFAULT_IMAGE_DIR, thumbs_dir=DEFAULT_THUMBS_DIR, widths=THUMB_WIDTHS, debug=False, workers=None,
+                                sources=None, keep=(), evict=True, previous=None, formats=THUMB_FORMATS):
+    # Brings the thumbs directory in line with the sources: renders variants
+    # that are missing or stale and evicts ones no source needs any more.
+    # `sources` maps image path -> (content hash, width, height); when omitted
+    # the directory is walked and each file hashed and its header read.
+    # `keep` lists extra files to preserve, e.g. thumbnails of indexed images
+    # whose source is temporarily missing. `previous` maps image path to its
+    # existing images.json entry; its placeholder and hash are reused when the entry's
+    # thumbnails are exactly the planned ones (their names are keyed by
+    # content, so the placeholder was taken from the same pixels).
+    # Returns {"thumbs": {path: thumb_entry}, "previews": {path: {"placeholder", "color", "dhash"}},
+    # "generated", "up_to_date", "evicted", "errors"}.
     ensure_dir(thumbs_dir)
+    if sources is None:
+        sources = {}
+        for root, dirs, files in os.walk(images_dir):
+            for file in sorted(files):
+                if os.path.splitext(file)[1].lower() in PHOTO_EXTENSIONS:
+                    src_path = os.path.join(root, file).replace("\\", "/")
+                    try:
+                        with Image.open(src_path) as img:
+                            sources[src_path] = (content_hash(src_path), *img.size)
+                    except Exception as e:
+                        print(f"Error generating thumbnail for {src_path}: {e}")
+    previous = previous or {}
+    plans = {}
+    previews = {}
+    tasks = []
+    up_to_date = 0
+    for src_path in sorted(sources):
+        digest, width, height = sources[src_path]
+        if not width or not height:
+            continue
+        plans[src_path] = plan_thumbnails(src_path, digest, width, height, thumbs_dir, widths, formats)
+        outputs = []
+        for dest_path, tw, th, fmt in plans[src_path]:
+            if not os.path.exists(dest_path):
+                outputs.append((dest_path, tw, fmt))
+            else:
+                up_to_date += 1
+                if debug:
+                    print(f"Thumbnail already exists: {dest_path}")
+        entry = previous.get(src_path) or {}
+        if entry.get("placeholder") and entry.get("dhash") and set(thumb_files(entry)) == {dest_path for dest_path, _, _, _ in plans[src_path]}:
+            previews[src_path] = {"placeholder": entry["placeholder"], "color": entry.get("color", ""), "dhash": entry["dhash"]}
+        if outputs or src_path not in previews:
+            tasks.append((src_path, outputs))
+
+    workers = workers or os.cpu_count() or 1
     count = 0
-    for root, dirs, files in os.walk(images_dir):
-        for file in files:
-            ext = os.path.splitext(file)[1].lower()
-            if ext in PHOTO_EXTENSIONS:
-                src_path = os.path.join(root, file)
-                for size, max_width in sizes:
-                    dest_path = thumb_path(src_path, size)
-                    if not os.path.exists(dest_path):
-                        generate_thumbnail(src_path, dest_path, max_width)
-                        count += 1
-                        if debug:
-                            print(f"Generated thumbnail: {dest_path}")
-                    else:
-                        if debug:
-                            print(f"Thumbnail already exists: {dest_path}")
+    errors = []
+    sizes = {}
+    progress_every = max(10, len(tasks) // 20)
+
+    def collect(done, result):
+        nonlocal count
+        src_path, written, preview, error = result
+        if preview:
+            previews[src_path] = preview
+        count += len(written)
+        for dest_path, nbytes in written:
+            sizes[dest_path] = nbytes
+            metrics.count("thumbnail_bytes_written", nbytes)
+            if debug:
+                print(f"Generated thumbnail: {dest_path}")
+        if error:
+            errors.append(f"{src_path}: {error}")
+        if done % progress_every == 0 or done == len(tasks):
+            print(f"  Thumbnails: {done}/{len(tasks)} images")
+
+    if workers == 1 or len(tasks) <= 1:
+        for done, (src_path, outputs) in enumerate(tasks, 1):
+            collect(done, render_thumbnail_set(src_path, outputs))
+    else:
+        # One task per image: idle workers pick up the next image as soon as
+        # they finish, so a few huge files don't hold up a whole chunk
+        with ProcessPoolExecutor(max_workers=min(workers, len(tasks))) as pool:
+            futures = [pool.submit(render_thumbnail_set, src_path, outputs) for src_path, outputs in tasks]
+            for done, fut in enumerate(as_completed(futures), 1):
+                collect(done, fut.result())
+
+    thumbs = {}
+    for src_path, plan in plans.items():
+        present = {dest_path for dest_path, _, _, _ in plan if dest_path in sizes or os.path.exists(dest_path)}
+        thumbs[src_path] = thumb_entry(plan, present)
+
+    evicted = 0
+    if evict:
+        live = {norm_path(dest_path) for plan in plans.values() for dest_path, _, _, _ in plan}
+        live.update(norm_path(p) for p in keep)
+        for name in os.listdir(thumbs_dir):
+            path = norm_path(os.path.join(thumbs_dir, name))
+            if path not in live and os.path.splitext(name)[1] in THUMB_CACHE_EXTENSIONS:
+                os.remove(path)
+                evicted += 1
+                if debug:
+                    print(f"Evicted thumbnail: {path}")
+
+    for error in errors:
+        print(f"Error generating thumbnail for {error}")
     print(f"Thumbnail generation complete. {count} new thumbnails created.")
+    return {"thumbs": thumbs, "previews": previews, "generated": count, "up_to_date": up_to_date, "evicted": evicted, "errors": errors}
 
 # ------------ END THUMBNAIL GENERATION ----------------
 
-def integrate_index_and_geotag(gpx_dir, img_dir, json_path, test_mode=False, debug=False, window_seconds=3600, force=False, prune=False):
-    # Generate thumbnails first
-    print("Generating thumbnails before indexing...")
-    generate_thumbnails_for_all(images_dir=img_dir, debug=debug)
-    # ... remainder unchanged ...
-    if os.path.exists(json_path):
-        with open(json_path, "r", encoding="utf-8") as f:
-            data = json.load(f)
+# --------- INCREMENTAL MANIFEST ---------
+# Remembers, per image path, the file's size/mtime/content hash and what was
+# extracted from it last time, so unchanged images can be skipped and moved
+# ones recognised by content instead of being pruned and re-added.
+MANIFEST_VERSION = 1
+
+def load_manifest(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {}
+    if manifest.get("version") != MANIFEST_VERSION:
+        manifest = {"version": MANIFEST_VERSION, "files": {}}
+    return manifest
+
+def save_manifest(path, manifest):
+    if os.path.dirname(path):
+        ensure_dir(os.path.dirname(path))
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, separators=(',', ':'), sort_keys=True)
+    os.replace(tmp, path)
+
+def manifest_record(record):
+    # The part of a read_image_record() result the manifest keeps
+    lat, lon = get_lat_lon(record["gps"]) if record["gps"] else (None, None)
+    return {
+        "width": record["width"],
+        "height": record["height"],
+        "taken": record["taken"],
+        "gps": [lat, lon] if lat is not None else None,
+        "orientation": record["orientation"]
+    }
+
+def manifest_entry(st, digest, record, match_key, thumbs=None):
+    return {
+        "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+        "hash": digest,
+        "record": record,
+        "thumbs": thumbs or [],
+        # None: nothing about GPX matching can change this image's result.
+        # Otherwise the match signature it was last matched under.
+        "match_key": match_key
+    }
+
+def match_signature(track, window_seconds, interpolate, max_gap, max_speed_kmh):
+    # Changes whenever any photo could match the GPX track differently
+    h = hashlib.blake2b(digest_size=16)
+    for arr in (track.epochs, track.lats, track.lons):
+        h.update(np.ascontiguousarray(arr).tobytes())
+    h.update(repr((window_seconds, interpolate, max_gap, max_speed_kmh)).encode())
+    return h.hexdigest()
+
+# --------- GEOTAG WRITE-BACK ---------
+# GPS positions found from the GPX track are written as one batch on a
+# thread pool, either into the image's EXIF (via a temp file renamed over
+# the original) or into an XMP sidecar that leaves the original untouched.
+# Every write (or, with --test, every planned write) is recorded in a JSONL
+# journal with the old and new values, which --rollback can undo.
+GPS_WRITE_TAGS = (piexif.GPSIFD.GPSLatitudeRef, piexif.GPSIFD.GPSLatitude,
+                  piexif.GPSIFD.GPSLongitudeRef, piexif.GPSIFD.GPSLongitude)
+XMP_EXIF_NS = "http://ns.adobe.com/exif/1.0/"
+XMP_RDF_NS = "http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+XMP_PACKET = '<?xpacket begin="\ufeff" id="W5M0MpCehiHzreSzNTczkc9d"?>\n{}\n<?xpacket end="w"?>\n'
+XMP_SIDECAR_TEMPLATE = """<?xpacket begin="\ufeff" id="W5M0MpCehiHzreSzNTczkc9d"?>
+<x:xmpmeta xmlns:x="adobe:ns:meta/">
+ <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
+  <rdf:Description rdf:about="" xmlns:exif="http://ns.adobe.com/exif/1.0/"
+   exif:GPSVersionID="2.3.0.0"
+   exif:GPSLatitude="{lat}"
+   exif:GPSLongitude="{lon}"/>
+ </rdf:RDF>
+</x:xmpmeta>
+<?xpacket end="w"?>
+"""
+
+def xmp_sidecar_path(img_path, naming="file"):
+    # "file": IMG_0001.jpg -> IMG_0001.jpg.xmp (darktable's naming, also read
+    # by exiftool), so IMG_0001.jpg and IMG_0001.jpeg never share a sidecar.
+    # "stem": IMG_0001.xmp, as Lightroom and Capture One name them.
+    if naming == "stem":
+        return os.path.splitext(img_path)[0] + ".xmp"
+    return img_path + ".xmp"
+
+def read_sidecar_gps(img_path, naming="file"):
+    # (lat, lon) from the image's sidecar under either naming, the configured
+    # one first, so a sidecar another tool wrote still counts as a geotag
+    for name in sorted(SIDECAR_NAMINGS, key=lambda n: n != naming):
+        latlon = read_xmp_gps(xmp_sidecar_path(img_path, name))
+        if latlon:
+            return latlon
+    return None
+
+_xmp_namespace_lock = threading.Lock()
+
+def xmp_with_gps(xmp_path, lat, lon):
+    # An existing sidecar's XML with the GPS attributes set on its first
+    # rdf:Description; everything else in it is kept
+    with _xmp_namespace_lock:
+        # ElementTree's prefix table is global, so keep the file's own prefixes
+        for _, (prefix, uri) in ET.iterparse(xmp_path, events=("start-ns",)):
+            try:
+                ET.register_namespace(prefix, uri)
+            except ValueError:
+                pass
+        ET.register_namespace("exif", XMP_EXIF_NS)
+        root = ET.parse(xmp_path).getroot()
+        description = root.find(f".//{{{XMP_RDF_NS}}}Description")
+        if description is None:
+            rdf = root if root.tag == f"{{{XMP_RDF_NS}}}RDF" else root.find(f".//{{{XMP_RDF_NS}}}RDF")
+            if rdf is None:
+                rdf = ET.SubElement(root, f"{{{XMP_RDF_NS}}}RDF")
+            description = ET.SubElement(rdf, f"{{{XMP_RDF_NS}}}Description", {f"{{{XMP_RDF_NS}}}about": ""})
+        description.set(f"{{{XMP_EXIF_NS}}}GPSVersionID", "2.3.0.0")
+        description.set(f"{{{XMP_EXIF_NS}}}GPSLatitude", xmp_coordinate(lat, "N", "S"))
+        description.set(f"{{{XMP_EXIF_NS}}}GPSLongitude", xmp_coordinate(lon, "E", "W"))
+        return XMP_PACKET.format(ET.tostring(root, encoding="unicode"))
+
+def xmp_coordinate(value, pos, neg):
+    # XMP GPSCoordinate: "DDD,MM.mmmmmmK"
+    deg = int(abs(value))
+    minutes = (abs(value) - deg) * 60
+    return f"{deg},{minutes:.6f}{pos if value >= 0 else neg}"
+
+def parse_xmp_coordinate(text):
+    text = text.strip()
+    ref, parts = text[-1].upper(), text[:-1].split(",")
+    value = float(parts[0]) + sum(float(p) / 60 ** i for i, p in enumerate(parts[1:], 1))
+    return -value if ref in ("S", "W") else value
+
+def read_xmp_gps(xmp_path):
+    # (lat, lon) from a sidecar, as attributes or elements; None if absent
+    try:
+        root = ET.parse(xmp_path).getroot()
+    except (OSError, ET.ParseError):
+        return None
+    found = {}
+    for el in root.iter():
+        for name in ("GPSLatitude", "GPSLongitude"):
+            key = f"{{{XMP_EXIF_NS}}}{name}"
+            if key in el.attrib:
+                found[name] = el.attrib[key]
+            elif el.tag == key and el.text:
+                found[name] = el.text
+    try:
+        return parse_xmp_coordinate(found["GPSLatitude"]), parse_xmp_coordinate(found["GPSLongitude"])
+    except (KeyError, ValueError, IndexError):
+        return None
+
+def gps_tags_to_json(gps):
+    # The GPS tags a write replaces, in a JSON-safe form (None when absent)
+    def plain(value):
+        if isinstance(value, bytes):
+            return value.decode("ascii", "replace")
+        if isinstance(value, tuple):
+            return [plain(v) for v in value]
+        return value
+    return {str(tag): plain(gps.get(tag)) for tag in GPS_WRITE_TAGS}
+
+def gps_tags_from_json(tags):
+    def exif_value(value):
+        return tuple(exif_value(v) for v in value) if isinstance(value, list) else value
+    return {int(tag): exif_value(value) for tag, value in tags.items()}
+
+def write_text_atomic(path, text):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def write_exif_atomic(path, exif_dict):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        piexif.insert(piexif.dump(exif_dict), path, tmp_path)
+        shutil.copymode(path, tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def write_geotag(path, exif, lat, lon, mode, dry_run=False, sidecar_naming="file"):
+    # One journal record; "status" is "planned", "written" or "error"
+    record = {"path": path, "mode": mode, "new": {"lat": lat, "lon": lon}, "status": "planned", "error": None}
+    try:
+        if mode == "xmp":
+            sidecar = xmp_sidecar_path(path, sidecar_naming)
+            record["sidecar"] = sidecar
+            # A sidecar from another tool gets the GPS merged in; its old
+            # text is journaled so --rollback can put it back
+            if os.path.exists(sidecar):
+                with open(sidecar, "r", encoding="utf-8") as f:
+                    record["old_sidecar"] = f.read()
+                text = xmp_with_gps(sidecar, lat, lon)
+            else:
+                text = XMP_SIDECAR_TEMPLATE.format(lat=xmp_coordinate(lat, "N", "S"), lon=xmp_coordinate(lon, "E", "W"))
+            if not dry_run:
+                write_text_atomic(sidecar, text)
+        else:
+            exif_dict = exif or empty_exif()
+            record["old"] = gps_tags_to_json(exif_dict["GPS"])
+            if not dry_run:
+                exif_dict["GPS"].update(gps_ifd(lat, lon))
+                write_exif_atomic(path, exif_dict)
+        if not dry_run:
+            record["status"] = "written"
+            metrics.count("geotag_bytes_written", os.path.getsize(sidecar if mode == "xmp" else path))
+    except Exception as e:
+        record["status"], record["error"] = "error", str(e)
+    return record
+
+def write_geotags(writes, mode, workers=DEFAULT_IO_WORKERS, dry_run=False, sidecar_naming="file"):
+    # writes: [(path, parsed exif dict or None, lat, lon)]. Returns journal
+    # records in input order.
+    def run(write):
+        return write_geotag(*write, mode=mode, dry_run=dry_run, sidecar_naming=sidecar_naming)
+    return [record for _, record in read_ahead(run, writes, workers)]
+
+def save_journal(path, records, run_started):
+    if os.path.dirname(path):
+        ensure_dir(os.path.dirname(path))
+    with open(path, "a", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps({"run": run_started, **record}, ensure_ascii=False, separators=(',', ':')) + "\n")
+
+def rollback_journal(journal_path, debug=False, manifest_path=None):
+    # Undoes the "written" records of a journal, newest first. An image whose
+    # GPS no longer matches what was written is left alone. Rolled back
+    # images are marked in the manifest so later runs don't geotag them
+    # again until their content changes.
+    with open(journal_path, "r", encoding="utf-8") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    reverted, skipped = 0, []
+    rolled_back = []
+    for record in reversed(records):
+        if record.get("status") != "written":
+            continue
+        path = record["path"]
+        try:
+            if record["mode"] == "xmp":
+                if read_xmp_gps(record["sidecar"]) is None:
+                    raise ValueError("sidecar missing or has no GPS")
+                if record.get("old_sidecar") is None:
+                    os.remove(record["sidecar"])
+                else:
+                    write_text_atomic(record["sidecar"], record["old_sidecar"])
+            else:
+                with Image.open(path) as img:
+                    exif_bytes = img.info.get("exif")
+                exif_dict = piexif.load(exif_bytes) if exif_bytes else empty_exif()
+                lat, lon = get_lat_lon(exif_dict["GPS"])
+                new = record["new"]
+                if lat is None or abs(lat - new["lat"]) > 1e-5 or abs(lon - new["lon"]) > 1e-5:
+                    raise ValueError("GPS no longer matches what was written")
+                for tag, value in gps_tags_from_json(record["old"]).items():
+                    if value is None:
+                        exif_dict["GPS"].pop(tag, None)
+                    else:
+                        exif_dict["GPS"][tag] = value
+                write_exif_atomic(path, exif_dict)
+            reverted += 1
+            rolled_back.append(path)
+            if debug:
+                print(f"Rolled back geotag for {path}")
+        except Exception as e:
+            skipped.append(f"{path}: {e}")
+    print(f"Rolled back {reverted} geotags from {journal_path}.")
+    for message in skipped:
+        print(f" - Skipped {message}")
+    if manifest_path and rolled_back:
+        manifest = load_manifest(manifest_path)
+        for path in rolled_back:
+            entry = manifest["files"].get(path)
+            if not entry:
+                continue
+            try:
+                st = os.stat(path)
+                digest = content_hash(path)
+            except OSError:
+                continue
+            entry.update(size=st.st_size, mtime_ns=st.st_mtime_ns, hash=digest, match_key=None, rolled_back=True)
+        save_manifest(manifest_path, manifest)
+        print("Later runs leave the rolled back images untagged until they change.")
+    return reverted, skipped
+
+# --------- NEAR-DUPLICATE DETECTION ---------
+# Bursts and re-exports of the same shot have dHashes a few bits apart. A
+# BK-tree finds every earlier image within that distance without comparing
+# all pairs, and connected matches form a group.
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+class BKTree:
+    # Nodes are [hash, item, {distance: child}]. By the triangle inequality a
+    # match within `radius` of the query can only sit under children whose
+    # edge distance is within `radius` of the node's own distance.
+    def __init__(self):
+        self.root = None
+
+    def add(self, value, item):
+        if self.root is None:
+            self.root = [value, item, {}]
+            return
+        node = self.root
+        while True:
+            d = hamming(value, node[0])
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = [value, item, {}]
+                return
+            node = child
+
+    def search(self, value, radius):
+        # [(distance, item)] for every stored hash within radius
+        found = []
+        stack = [self.root] if self.root else []
+        while stack:
+            node = stack.pop()
+            d = hamming(value, node[0])
+            if d <= radius:
+                found.append((d, node[1]))
+            for edge, child in node[2].items():
+                if d - radius <= edge <= d + radius:
+                    stack.append(child)
+        return found
+
+def duplicate_groups(images, max_distance=DEFAULT_DUPLICATE_DISTANCE):
+    # Lists of paths, each a group of two or more near-duplicates, in image order
+    parent = {}
+
+    def root(path):
+        while parent[path] != path:
+            parent[path] = parent[parent[path]]
+            path = parent[path]
+        return path
+
+    tree = BKTree()
+    order = []
+    for img in images:
+        try:
+            value = int(img.get("dhash") or "", 16)
+        except ValueError:
+            continue
+        path = img["path"]
+        parent[path] = path
+        order.append(path)
+        for _, other in tree.search(value, max_distance):
+            parent[root(other)] = root(path)
+        tree.add(value, path)
+    groups = defaultdict(list)
+    for path in order:
+        groups[root(path)].append(path)
+    return [group for group in groups.values() if len(group) > 1]
+
+def collapse_duplicates(images, groups):
+    # One entry per group, the one with the most pixels; the others are nested
+    # under it as "duplicates" and expanded again by load_images_json
+    by_path = {img["path"]: img for img in images}
+    nested = {}
+    for group in groups:
+        keeper = max(group, key=lambda p: (by_path[p].get("width") or 0) * (by_path[p].get("height") or 0))
+        for path in group:
+            nested[path] = [by_path[p] for p in group if p != keeper] if path == keeper else None
+    collapsed = []
+    for img in images:
+        path = img["path"]
+        if path not in nested:
+            collapsed.append(img)
+        elif nested[path] is not None:
+            collapsed.append({**img, "duplicates": nested[path]})
+    return collapsed
+
+# --------- IMAGES.JSON OUTPUT ---------
+# images.json is either one file holding every entry, or (with a shard size)
+# a small index of counts, facet summaries and a shard list, next to
+# fixed-size shards of entries in display order. Shards are cut from the
+# oldest end so new photos only change the newest shard, and a shard is
+# only rewritten when its contents change. Either way images.facets.json
+# holds the filter postings.
+SHARDED_INDEX_VERSION = 1
+
+def iter_json_lines(items):
+    # One compact entry per line keeps git diffs to the entries that changed
+    last = len(items) - 1
+    for i, item in enumerate(items):
+        yield f"    {json.dumps(item, ensure_ascii=False, separators=(',', ':'))}{',' if i < last else ''}\n"
+
+def json_lines(items):
+    return "".join(iter_json_lines(items))
+
+def iter_images_document(images, pruned=None):
+    yield '{\n  "images": [\n'
+    yield from iter_json_lines(images)
+    if pruned is not None:
+        yield '  ],\n  "pruned": [\n'
+        yield from iter_json_lines(pruned)
+    yield '  ]\n}\n'
+
+def images_document(images, pruned=None):
+    return "".join(iter_images_document(images, pruned))
+
+def write_atomic(path, chunks):
+    # Streams text chunks to a temp file beside `path` while hashing them,
+    # then renames it over `path`, so the served file is never half written.
+    # When the hash matches the existing file the temp file is dropped and
+    # `path` is left untouched (mtime included). Returns True if written.
+    h = hashlib.blake2b(digest_size=16)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            for chunk in chunks:
+                data = chunk.encode("utf-8")
+                f.write(data)
+                h.update(data)
+        if os.path.exists(path) and content_hash(path) == h.hexdigest():
+            return False
+        os.replace(tmp, path)
+        return True
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def write_if_changed(path, text):
+    return write_atomic(path, [text])
+
+def shard_name(json_path, number):
+    stem = os.path.splitext(os.path.basename(json_path))[0]
+    return f"{stem}-{number:04d}.json"
+
+def load_images_json(json_path):
+    # Entries from either layout, in file order
+    if not os.path.exists(json_path):
+        return []
+    with open(json_path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    if isinstance(data, list):
+        images = data
+    elif "shards" not in data:
         images = data.get("images", [])
     else:
         images = []
+        base = os.path.dirname(json_path)
+        for shard in data["shards"]:
+            with open(os.path.join(base, shard["src"]), "r", encoding="utf-8") as f:
+                images.extend(json.load(f).get("images", []))
+    # Entries collapsed under another as near-duplicates come back out
+    expanded = []
+    for img in images:
+        expanded.append(img)
+        expanded.extend(img.pop("duplicates", None) or [])
+    return expanded
+
+def facet_summary(images):
+    # Counts per year taken, place and tag, for filter UIs that load before the shards
+    years, places, tags = defaultdict(int), defaultdict(int), defaultdict(int)
+    for img in images:
+        if img.get("taken"):
+            years[img["taken"][:4]] += 1
+        if img.get("location"):
+            places[img["location"]] += 1
+        for tag in img.get("tags") or []:
+            tags[tag] += 1
+    return {
+        "years": dict(sorted(years.items(), reverse=True)),
+        "places": dict(sorted(places.items())),
+        "tags": dict(sorted(tags.items()))
+    }
+
+FACET_INDEX_VERSION = 1
+
+def facets_path(json_path):
+    stem, _ = os.path.splitext(json_path)
+    return f"{stem}.facets.json"
+
+def date_bucket(taken):
+    # Month buckets, matching how the gallery displays dates
+    return taken[:7] if taken and len(taken) >= 7 else ""
+
+def build_facet_index(images):
+    # Postings per date bucket, place and tag: the ordinals (positions in
+    # display order, across shards) of the images carrying that value, in
+    # ascending order. Filters intersect these instead of scanning entries.
+    postings = {"dates": defaultdict(list), "places": defaultdict(list), "tags": defaultdict(list)}
+    for ordinal, img in enumerate(images):
+        bucket = date_bucket(img.get("taken"))
+        if bucket:
+            postings["dates"][bucket].append(ordinal)
+        if img.get("location"):
+            postings["places"][img["location"]].append(ordinal)
+        for tag in sorted(set(img.get("tags") or [])):
+            postings["tags"][tag].append(ordinal)
+    return {
+        "version": FACET_INDEX_VERSION,
+        "count": len(images),
+        "dates": {k: {"count": len(v), "ids": v} for k, v in sorted(postings["dates"].items(), reverse=True)},
+        "places": {k: {"count": len(v), "ids": v} for k, v in sorted(postings["places"].items())},
+        "tags": {k: {"count": len(v), "ids": v} for k, v in sorted(postings["tags"].items())}
+    }
+
+def facet_index_document(index):
+    # One facet value per line, so a new photo only touches the values it carries
+    parts = [f'  "version": {index["version"]},\n  "count": {index["count"]}']
+    for facet in ("dates", "places", "tags"):
+        lines = ",\n".join(
+            f"    {json.dumps(value, ensure_ascii=False)}: {json.dumps(posting, separators=(',', ':'))}"
+            for value, posting in index[facet].items()
+        )
+        parts.append(f'  "{facet}": {{\n{lines}\n  }}' if lines else f'  "{facet}": {{}}')
+    return "{\n" + ",\n".join(parts) + "\n}\n"
+
+def write_sharded_images_json(json_path, images, pruned, shard_size, shard_dir=DEFAULT_SHARD_DIR):
+    # images in display order (newest first).
+    # Returns {"written", "unchanged", "removed"} shard counts and "index_written".
+    base = os.path.dirname(json_path)
+    ensure_dir(os.path.join(base, shard_dir))
+    stats = {"written": 0, "unchanged": 0, "removed": 0}
+    shards = []
+    total = len(images)
+    count = (total + shard_size - 1) // shard_size
+    for number in range(count - 1, -1, -1):
+        chunk = images[max(0, total - (number + 1) * shard_size):total - number * shard_size]
+        text = images_document(chunk)
+        src = f"{shard_dir}/{shard_name(json_path, number)}"
+        stats["written" if write_if_changed(os.path.join(base, src), text) else "unchanged"] += 1
+        shards.append({
+            "src": src,
+            "count": len(chunk),
+            "first": chunk[0].get("taken", ""),
+            "last": chunk[-1].get("taken", ""),
+            # Lets the frontend bust caches for changed shards only
+            "hash": hashlib.blake2b(text.encode("utf-8"), digest_size=6).hexdigest()
+        })
+    live = {shard_name(json_path, number) for number in range(count)}
+    stem = os.path.splitext(os.path.basename(json_path))[0]
+    for name in os.listdir(os.path.join(base, shard_dir)):
+        if name.startswith(stem + "-") and name.endswith(".json") and name not in live:
+            os.remove(os.path.join(base, shard_dir, name))
+            stats["removed"] += 1
+    index = {
+        "version": SHARDED_INDEX_VERSION,
+        "count": total,
+        "shard_size": shard_size,
+        "facets": facet_summary(images),
+        "shards": shards
+    }
+    # Pruned entries are spliced in one per line, as in the single-file layout
+    text = json.dumps(index, ensure_ascii=False, indent=2)[:-2]
+    text += ',\n  "pruned": [\n' + json_lines(pruned) + '  ]\n}\n'
+    stats["index_written"] = write_if_changed(json_path, text)
+    return stats
+
+def write_images_json(json_path, images, pruned, shard_size=DEFAULT_SHARD_SIZE, shard_dir=DEFAULT_SHARD_DIR):
+    # Returns (whether anything changed on disk, shard stats or None)
+    changed = write_if_changed(facets_path(json_path), facet_index_document(build_facet_index(images)))
+    if shard_size:
+        shard_stats = write_sharded_images_json(json_path, images, pruned, shard_size, shard_dir)
+        return changed or shard_stats["index_written"] or shard_stats["written"] > 0, shard_stats
+    return write_atomic(json_path, iter_images_document(images, pruned)) or changed, None
+
+def integrate_index_and_geotag(gpx_dir, img_dir, json_path, test_mode=False, debug=False, window_seconds=3600, force=False, prune=False,
+                               geocache_path=DEFAULT_GEOCODE_CACHE, geocache_precision=DEFAULT_GEOCODE_PRECISION,
+                               geocache_ttl_days=DEFAULT_GEOCODE_TTL_DAYS, geocode_budget=DEFAULT_GEOCODE_BUDGET, geocoder=None,
+                               interpolate=False, max_gap=DEFAULT_INTERP_MAX_GAP, max_speed_kmh=DEFAULT_INTERP_MAX_SPEED,
+                               gpx_cache_dir=DEFAULT_GPX_CACHE_DIR, manifest_path=DEFAULT_MANIFEST, full=False, workers=None,
+                               thumbs_dir=DEFAULT_THUMBS_DIR, shard_size=DEFAULT_SHARD_SIZE, shard_dir=DEFAULT_SHARD_DIR,
+                               io_workers=DEFAULT_IO_WORKERS, geotag_mode="exif", journal_path=None, state=None, thumbnails=True,
+                               duplicate_distance=DEFAULT_DUPLICATE_DISTANCE, collapse=False, report_path=DEFAULT_REPORT,
+                               thumb_widths=THUMB_WIDTHS, thumb_formats=THUMB_FORMATS, sidecar_naming="file"):
+    # `state` is a WatchState carried between runs in watch mode; it stands in
+    # for reloading images.json, the manifest and the GPX track when none of
+    # them changed, and for the directory walk when the watcher tracks files.
+    # With thumbnails=False the thumbnail pass is skipped and entries keep
+    # whatever thumbnails they had; the preview server renders the rest.
+    # Near-duplicates (dHashes within duplicate_distance bits) are reported,
+    # and with collapse=True written as one entry per group. The per-image
+    # report streams to report_path (a temporary file when empty).
+    metrics.reset()
+    report = RunReport(report_path)
+    with metrics.stage("json_load"):
+        images = state.load_images(json_path) if state else load_images_json(json_path)
     images_by_path = {img["path"]: img for img in images}
 
-    all_image_files_list = all_image_files(img_dir, debug=debug)
-    gpx_points = get_all_gpx_points(gpx_dir, debug=debug)
+    with metrics.stage("walk"):
+        if state and state.image_files is not None:
+            all_image_files_list = list(state.image_files)
+        else:
+            all_image_files_list = all_image_files(img_dir, debug=debug)
+    metrics.count("files_found", len(all_image_files_list))
+    with metrics.stage("gpx_load"):
+        track = state.load_track(gpx_dir, debug, gpx_cache_dir) if state else load_gpx_track(gpx_dir, debug=debug, cache_dir=gpx_cache_dir)
+    metrics.count("gpx_points", len(track))
 
     actions = {
         "added": 0,
@@ -352,15 +2101,118 @@ def integrate_index_and_geotag(gpx_dir, img_dir, json_path, test_mode=False, deb
         "skipped": 0,
         "geotag_updated": 0,
         "errors": [],
-        "pruned": 0
+        "pruned": 0,
+        "from_manifest": 0,
+        "moved": 0
     }
-    detailed_actions = []
-    results = []
     updated_paths = set()
 
-    for path in all_image_files_list:
+    if not manifest_path:
+        manifest = {"files": {}}
+    else:
+        manifest = state.load_manifest(manifest_path) if state else load_manifest(manifest_path)
+    old_files = manifest["files"]
+    new_files = {}
+    thumb_sources = {}  # path -> (content hash, width, height) once the file is final
+    match_key = match_signature(track, window_seconds, interpolate, max_gap, max_speed_kmh)
+    use_manifest = bool(manifest_path) and not (full or force)
+    current_paths = set(all_image_files_list)
+    # Indexed images whose file has disappeared, by content: candidates for a move
+    vanished_by_hash = {
+        entry["hash"]: old_path for old_path, entry in old_files.items()
+        if old_path not in current_paths and old_path in images_by_path
+    }
+
+    # File reads for pass 1 run ahead on a thread pool; everything that
+    # depends on earlier images (moves, counters, ordering) stays in the loop.
+    indexed_paths = set(images_by_path)
+
+    def hash_in_pool(path, st):
+        with metrics.stage("hash", per_thread=True):
+            digest = content_hash(path)
+        metrics.count("bytes_hashed", st.st_size)
+        return digest
+
+    def read_image_state(path):
+        # A file deleted or unreadable since the listing comes back with no
+        # stat and an error record. Images that are read also get their
+        # content hash here, since thumbnails and the manifest need it.
+        try:
+            st = os.stat(path)
+            digest = None
+            entry = old_files.get(path) if use_manifest else None
+            if (use_manifest and path not in indexed_paths) or (entry and (entry["size"], entry["mtime_ns"]) != (st.st_size, st.st_mtime_ns)):
+                digest = hash_in_pool(path, st)
+            served = (entry and path in indexed_paths and entry["match_key"] in (None, match_key)
+                      and digest in (None, entry["hash"]))
+            if served:
+                return st, digest, None
+            digest = digest or hash_in_pool(path, st)
+        except OSError as e:
+            return None, None, empty_image_record(path, error=str(e))
+        with metrics.stage("exif_read", per_thread=True):
+            record = read_image_record(path)
+        metrics.count("images_read")
+        return st, digest, record
+
+    def restat(path):
+        # (stat, hash) after a geotag write, or (None, error) if it went away
+        try:
+            st = os.stat(path)
+            return st, hash_in_pool(path, st)
+        except OSError as e:
+            return None, str(e)
+
+    def read_error(path, error):
+        actions["skipped"] += 1
+        actions["errors"].append(f"Error reading {path}: {error}")
+
+    # Pass 1: read metadata and match GPX points for every image, remembering
+    # every coordinate that will need a place name. Each image's field updates
+    # go to the report as soon as it is read; the job keeps only what passes 2
+    # and 3 need and is dropped once its image record is written.
+    metrics.start("metadata")
+    jobs = deque()
+    coords = []
+    for path, (st, digest, prefetched) in read_ahead(read_image_state, all_image_files_list, io_workers):
+        entry = old_files.get(path)
+        if st is None:
+            read_error(path, prefetched["error"])
+            entry = None
+        elif use_manifest and path not in images_by_path:
+            digest = digest or content_hash(path)
+            old_path = vanished_by_hash.pop(digest, None)
+            if old_path:
+                moved = images_by_path.pop(old_path)
+                moved["path"] = path
+                images_by_path[path] = moved
+                entry = dict(old_files[old_path])
+                actions["moved"] += 1
+                report.add({"type": "moved", "path": path, "from": old_path, "actions": [f"Moved {old_path} -> {path}"]})
+        if use_manifest and entry and path in images_by_path:
+            fresh = entry["size"] == st.st_size and entry["mtime_ns"] == st.st_mtime_ns
+            if not fresh:
+                digest = digest or content_hash(path)
+                fresh = digest == entry["hash"]
+            if fresh and entry["match_key"] in (None, match_key):
+                entry.update(size=st.st_size, mtime_ns=st.st_mtime_ns)
+                new_files[path] = entry
+                record = entry["record"] or {}
+                thumb_sources[path] = (entry["hash"], record.get("width"), record.get("height"))
+                images_by_path[path] = {**build_image_entry(path), **images_by_path[path]}
+                actions["from_manifest"] += 1
+                updated_paths.add(path)
+                continue
+
         existing = images_by_path.get(path, {})
-        width, height, date_taken, gps_info, error = get_image_metadata(path)
+        # A photo whose geotag was rolled back stays untagged until it changes
+        rolled_back = bool(entry and entry.get("rolled_back") and entry["hash"] == digest)
+        record = prefetched or read_image_record(path)
+        width, height, date_taken, error = record["width"], record["height"], record["taken"], record["error"]
+        gps_info = record["gps"]
+        # In sidecar mode a position written to the XMP sidecar counts as a geotag
+        sidecar_latlon = read_sidecar_gps(path, sidecar_naming) if geotag_mode == "xmp" and not gps_info else None
+        details = []
 
         # CHANGED: Create new entry using template if not in JSON, else merge template for missing fields
         if path not in images_by_path:
@@ -368,14 +2220,6 @@ def integrate_index_and_geotag(gpx_dir, img_dir, json_path, test_mode=False, deb
                 iso_taken = exif_to_iso8601(date_taken)
             else:
                 iso_taken = ""
-            if gps_info:
-                lat, lon = get_lat_lon(gps_info)
-                if lat is not None and lon is not None:
-                    city_country = get_city_country(lat, lon)
-                else:
-                    city_country = ""
-            else:
-                city_country = ""
             img = build_image_entry(
                 path=path,
                 title="",
@@ -383,16 +2227,18 @@ def integrate_index_and_geotag(gpx_dir, img_dir, json_path, test_mode=False, deb
                 added=datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
                 taken=iso_taken,
                 original_link="",
-                location=city_country,
+                location="",
                 width=width,
                 height=height
             )
+            is_new = True
         else:
             img = dict(existing)
             img["path"] = path
             # Ensure all fields are present (merge with template)
             template = build_image_entry(path)
             img = {**template, **img}
+            is_new = False
 
         img_dt = None
 
@@ -403,7 +2249,7 @@ def integrate_index_and_geotag(gpx_dir, img_dir, json_path, test_mode=False, deb
             img["height"] = height
             if width and height:
                 actions["updated_size"] += 1
-                detailed_actions.append(f"Set width/height for {path} to {width}x{height}")
+                details.append(f"Set width/height for {path} to {width}x{height}")
 
         # taken
         if force or not img.get("taken"):
@@ -415,7 +2261,7 @@ def integrate_index_and_geotag(gpx_dir, img_dir, json_path, test_mode=False, deb
                 except Exception:
                     img_dt = None
                 actions["updated_taken"] += 1
-                detailed_actions.append(f"Set date taken for {path} to {iso_taken}")
+                details.append(f"Set date taken for {path} to {iso_taken}")
             else:
                 img_dt = None
         else:
@@ -429,126 +2275,216 @@ def integrate_index_and_geotag(gpx_dir, img_dir, json_path, test_mode=False, deb
         if not img.get("added"):
             img["added"] = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
             actions["added"] += 1
-            detailed_actions.append(f"Added new image: {path}")
+            details.append(f"Added new image: {path}")
 
-        # location
-        if force or not img.get("location"):
+        # location (resolved in pass 2)
+        gps_latlon = None
+        if is_new or force or not img.get("location"):
             if gps_info:
                 lat, lon = get_lat_lon(gps_info)
                 if lat is not None and lon is not None:
-                    city_country = get_city_country(lat, lon)
-                    img["location"] = city_country
-                    if city_country:
-                        actions["updated_location"] += 1
-                        detailed_actions.append(f"Set location for {path} to {city_country}")
-
-        has_gps = image_has_gps(path, debug=debug)
-        best, before, after = None, None, None
-        if img_dt:
-            best, before, after = find_nearest_gpx_point(img_dt, gpx_points, window_seconds=window_seconds)
-        img_time_str = format_time(img_dt) if img_dt else "N/A"
-        output_lines = []
-        city_country = img.get("location", "Unknown Location")
+                    gps_latlon = (lat, lon)
+                    coords.append(gps_latlon)
+            elif sidecar_latlon:
+                gps_latlon = sidecar_latlon
+                coords.append(gps_latlon)
 
-        if error:
-            output_lines.append(f"MISSING TIMESTAMP: {path}")
-        elif not img_dt:
-            output_lines.append(f"MISSING TIMESTAMP: {path}")
-        elif has_gps:
+        has_gps = gps_info is not None or sidecar_latlon is not None
+        exif_latlon, exif_error = None, None
+        if has_gps and not error and img_dt:
             try:
-                exif_dict = piexif.load(path)
-                lat, lon = extract_gps_from_exif(exif_dict)
-                loc_str = get_city_country(lat, lon)
-                output_lines.append(f"SKIP (already geotagged): {path}")
-                output_lines.append(f"  Photo geotag: {loc_str}")
-                # before/after
-                if before:
-                    before_loc = get_city_country(before['lat'], before['lon'])
-                    diff = time_difference_in_days_hours(img_dt, before['time'].replace(second=0, microsecond=0, tzinfo=None))
-                    before_day = before['time'].date().isoformat()
-                    warn = " (different day)" if before_day != img_dt.date().isoformat() else ""
-                    output_lines.append(f"  Closest Before: {format_time(before['time'])} {before_loc} {diff}{warn}")
-                else:
-                    output_lines.append("  No GPX point before photo.")
-                if after:
-                    after_loc = get_city_country(after['lat'], after['lon'])
-                    diff = time_difference_in_days_hours(img_dt, after['time'].replace(second=0, microsecond=0, tzinfo=None))
-                    # Distance from before to after (if both exist)
-                    if before:
-                        dist = haversine(before['lat'], before['lon'], after['lat'], after['lon'])
-                        dist_str = f"{dist:.1f} km"
-                    else:
-                        dist_str = ""
-                    after_day = after['time'].date().isoformat()
-                    warn = " (different day)" if after_day != img_dt.date().isoformat() else ""
-                    output_lines.append(f"  Closest After: {format_time(after['time'])} {after_loc} {diff}{warn} {dist_str}")
-                else:
-                    output_lines.append("  No GPX point after photo.")
+                exif_latlon = sidecar_latlon or extract_gps_from_exif(record["exif"])
+                if None in exif_latlon:
+                    raise ValueError("incomplete GPS coordinates")
+                coords.append(exif_latlon)
             except Exception as e:
-                output_lines.append(f"  Error reading geotag: {e}")
-        elif best:
-            action = "WOULD UPDATE" if test_mode else "UPDATED"
-            loc_str = get_city_country(best['lat'], best['lon'])
-            output_lines.append(f"{action}: {path} -> {loc_str} at {format_time(best['time'])}")
-            if not test_mode:
-                try:
-                    exif_dict = piexif.load(path)
-                    gps_dict = gps_ifd(best['lat'], best['lon'])
-                    exif_dict['GPS'].update(gps_dict)
-                    exif_bytes = piexif.dump(exif_dict)
-                    piexif.insert(exif_bytes, path)
-                    actions["geotag_updated"] += 1
-                except Exception as e:
-                    output_lines.append(f"Error updating {path}: {e}")
-            if before and before != best:
-                before_loc = get_city_country(before['lat'], before['lon'])
-                diff = time_difference_in_days_hours(img_dt, before['time'].replace(second=0, microsecond=0, tzinfo=None))
-                before_day = before['time'].date().isoformat()
-                warn = " (different day)" if before_day != img_dt.date().isoformat() else ""
-                output_lines.append(f"  Closest Before: {format_time(before['time'])} {before_loc} {diff}{warn}")
-            if after and after != best:
-                after_loc = get_city_country(after['lat'], after['lon'])
-                diff = time_difference_in_days_hours(img_dt, after['time'].replace(second=0, microsecond=0, tzinfo=None))
-                # Distance from before to after
-                if before:
-                    dist = haversine(before['lat'], before['lon'], after['lat'], after['lon'])
-                    dist_str = f"{dist:.1f} km"
-                else:
-                    dist_str = ""
-                after_day = after['time'].date().isoformat()
-                warn = " (different day)" if after_day != img_dt.date().isoformat() else ""
-                output_lines.append(f"  Closest After: {format_time(after['time'])} {after_loc} {diff}{warn} {dist_str}")
+                exif_error = e
+
+        # Parsed EXIF (embedded thumbnail and MakerNote included) is only kept
+        # for photos the write-back may touch
+        exif = record.pop("exif")
+        report.add({"type": "read", "path": path, "actions": details})
+        jobs.append({
+            "path": path, "img": img, "error": error, "img_dt": img_dt,
+            "exif": exif if img_dt and not error and not has_gps and not rolled_back else None,
+            "record": manifest_record(record), "stat": st, "digest": digest, "written": False,
+            "is_new": is_new, "gps_latlon": gps_latlon, "has_gps": has_gps, "rolled_back": rolled_back,
+            "exif_latlon": exif_latlon, "exif_error": exif_error,
+            "best": None, "before": None, "after": None,
+        })
+
+    metrics.stop("metadata")
+
+    # Match every timestamped photo against the GPX track in one batch
+    metrics.start("matching")
+    timed = [job for job in jobs if job["img_dt"]]
+    epochs = [to_epoch(job["img_dt"]) for job in timed]
+    matches = track.match_batch(epochs, window_seconds=window_seconds)
+    track_points = {}
+    for job, indices in zip(timed, zip(*matches)):
+        for key, i in zip(("best", "before", "after"), indices):
+            if i >= 0:
+                if i not in track_points:
+                    track_points[i] = track.point(i)
+                    coords.append((track_points[i]['lat'], track_points[i]['lon']))
+                job[key] = track_points[i]
+    if interpolate and timed:
+        _, before_idx, after_idx = matches
+        lats, lons, ok = interpolate_positions(track, epochs, before_idx, after_idx, max_gap=max_gap, max_speed_kmh=max_speed_kmh)
+        for job, lat, lon, use in zip(timed, lats, lons, ok):
+            if use:
+                job["best"] = {
+                    'lat': float(lat),
+                    'lon': float(lon),
+                    'time': job["img_dt"].replace(tzinfo=datetime.timezone.utc),
+                    'interpolated': True
+                }
+                coords.append((job["best"]['lat'], job["best"]['lon']))
+    for job in jobs:
+        if not job["best"]:
+            job["exif"] = None
+    del timed, epochs, matches, track_points
+    metrics.stop("matching")
+
+    # Pass 2: resolve every place name in one batch
+    metrics.start("geocode")
+    geocache = GeocodeCache(geocache_path, precision=geocache_precision, ttl_days=geocache_ttl_days) if geocache_path else None
+    remote = None
+
+    def open_remote():
+        nonlocal remote
+        remote_geocoder = geocoder if geocoder is not None else get_geolocator()
+        remote = ReverseGeocodeQueue(remote_geocoder, precision=geocache_precision) if remote_geocoder else None
+        return remote
+
+    places = resolve_places(coords, cache=geocache, remote=open_remote, budget=geocode_budget)
+    if remote:
+        remote.close()
+    if geocache:
+        geocache.close()
+    metrics.stop("geocode")
+    metrics.count("coords_resolved", len(set(coords)))
+    if geocache:
+        metrics.count("geocode_cache_hits", geocache.hits)
+        metrics.count("geocode_cache_misses", geocache.misses)
+    if remote:
+        metrics.count("geopy_calls", remote.calls)
+
+    def location_of(p):
+        # None while the lookup is still outstanding (geocode budget ran out)
+        return places[(float(p['lat']), float(p['lon']))]
+
+    def place_of(p):
+        return location_of(p) or unknown_place(float(p['lat']), float(p['lon']))
+
+    # Geotag write-back for every photo that gets a GPX position, as one
+    # parallel batch ahead of the report so each outcome is known there
+    geotag_jobs = [job for job in jobs if job["best"] and job["img_dt"] and not job["error"] and not job["has_gps"]
+                   and not job["rolled_back"]]
+    with metrics.stage("geotag_write"):
+        journal = write_geotags(
+            [(job["path"], job["exif"], job["best"]['lat'], job["best"]['lon']) for job in geotag_jobs],
+            geotag_mode, workers=io_workers, dry_run=test_mode, sidecar_naming=sidecar_naming
+        )
+    del geotag_jobs
+    geotag_results = {record["path"]: record for record in journal}
+    # JPEGs rewritten in place have a new size and hash, read on the pool too
+    rewritten = {}
+    if geotag_mode == "exif":
+        rewritten = dict(read_ahead(restat, [r["path"] for r in journal if r["status"] == "written"], io_workers))
+    if journal:
+        run_started = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        journal_path = journal_path or os.path.join(
+            DEFAULT_JOURNAL_DIR, f"geotag-{run_started.replace(':', '')}{'-dry-run' if test_mode else ''}.jsonl")
+        save_journal(journal_path, journal, run_started)
+
+    # Pass 3: apply locations, record geotag writes and stream a report
+    # record per image
+    metrics.start("report")
+    images_indexed = len(jobs)
+    while jobs:
+        job = jobs.popleft()
+        path, img, img_dt = job["path"], job["img"], job["img_dt"]
+        best, before, after = job["best"], job["before"], job["after"]
+        image_actions = []
+        unresolved = False
+
+        if job["gps_latlon"]:
+            lat, lon = job["gps_latlon"]
+            city_country = location_of({'lat': lat, 'lon': lon})
+            img["location"] = city_country or ""
+            unresolved = city_country is None
+            if city_country and (force or not job["is_new"]):
+                actions["updated_location"] += 1
+                image_actions.append(f"Set location for {path} to {city_country}")
+
+        record = {"type": "image", "path": path, "status": None, "taken": img_dt.strftime(REPORT_TIME_FORMAT) if img_dt else None}
+        if job["error"] or not img_dt:
+            record["status"] = "missing_timestamp"
+        elif job["has_gps"] and job["exif_error"]:
+            record["status"] = "geotag_error"
+            record["error"] = str(job["exif_error"])
         else:
-            output_lines.append(f"NO MATCH: {path}")
-            output_lines.append(f"  Photo Time: {img_time_str}")
-            if before:
-                before_loc = get_city_country(before['lat'], before['lon'])
-                diff = time_difference_in_days_hours(img_dt, before['time'].replace(second=0, microsecond=0, tzinfo=None))
-                before_day = before['time'].date().isoformat()
-                warn = " (different day)" if before_day != img_dt.date().isoformat() else ""
-                output_lines.append(f"  Closest Before: {format_time(before['time'])} {before_loc} {diff}{warn}")
-            else:
-                output_lines.append("  No GPX point before photo.")
-            if after:
-                after_loc = get_city_country(after['lat'], after['lon'])
-                diff = time_difference_in_days_hours(img_dt, after['time'].replace(second=0, microsecond=0, tzinfo=None))
-                # Distance from before to after
-                if before:
-                    dist = haversine(before['lat'], before['lon'], after['lat'], after['lon'])
-                    dist_str = f"{dist:.1f} km"
-                else:
-                    dist_str = ""
-                after_day = after['time'].date().isoformat()
-                warn = " (different day)" if after_day != img_dt.date().isoformat() else ""
-                output_lines.append(f"  Closest After: {format_time(after['time'])} {after_loc} {diff}{warn} {dist_str}")
+            if job["has_gps"]:
+                lat, lon = job["exif_latlon"]
+                record["status"] = "already_geotagged"
+                record["photo"] = {"lat": lat, "lon": lon, "place": place_of({'lat': lat, 'lon': lon})}
+            elif best and job["rolled_back"]:
+                record["status"] = "rolled_back"
+            elif best:
+                record["status"] = "would_update" if test_mode else "updated"
+                record["match"] = {**report_point(img_dt, best, place_of), "interpolated": bool(best.get('interpolated'))}
+                if not test_mode:
+                    geotag = geotag_results[path]
+                    if geotag["status"] == "written":
+                        actions["geotag_updated"] += 1
+                        job["written"] = True
+                    else:
+                        record["status"] = "geotag_failed"
+                        record["error"] = geotag["error"]
             else:
-                output_lines.append("  No GPX point after photo.")
-
-        results.append((path, img_dt, "\n".join(output_lines)))
-        detailed_actions.append(output_lines[0])
+                record["status"] = "no_match"
+            record["before"] = report_point(img_dt, before, place_of, before == best) if before else None
+            record["after"] = report_point(img_dt, after, place_of, after == best, before) if after else None
+        # A photo geotagged just now takes its location from the match, since
+        # the manifest marks it final and later runs will not read it again
+        if job["written"] and (job["is_new"] or force or not img.get("location")):
+            city_country = location_of(best)
+            img["location"] = city_country or ""
+            unresolved = city_country is None
+            if city_country and (force or not job["is_new"]):
+                actions["updated_location"] += 1
+                image_actions.append(f"Set location for {path} to {city_country}")
+        record["actions"] = image_actions + [report_lines(record)[0]]
+        report.add(record)
         images_by_path[path] = img
         updated_paths.add(path)
 
+        st, digest = job["stat"], job["digest"]
+        if st is None:
+            continue
+        if path in rewritten:
+            st, digest = rewritten[path]
+        elif digest is None:
+            st, digest = restat(path)
+        if st is None:
+            # Deleted since pass 1: no manifest entry, so the next run looks again
+            read_error(path, digest)
+            continue
+        thumb_sources[path] = (digest, job["record"]["width"], job["record"]["height"])
+        if manifest_path:
+            if job["error"] or unresolved or (test_mode and best and not job["has_gps"] and not job["rolled_back"]):
+                key = "pending"
+            elif not img_dt or job["has_gps"] or job["written"] or job["rolled_back"]:
+                key = None
+            else:
+                key = match_key
+            new_files[path] = manifest_entry(st, digest, job["record"], key)
+            if job["rolled_back"]:
+                new_files[path]["rolled_back"] = True
+
+    metrics.stop("report")
+
     # Prune: remove metadata for images not present
     pruned_images = []
     if prune:
@@ -556,33 +2492,71 @@ def integrate_index_and_geotag(gpx_dir, img_dir, json_path, test_mode=False, deb
         actions["pruned"] = len(pruned)
         for p in pruned:
             pruned_images.append(images_by_path[p])
-            detailed_actions.append(f"Pruned metadata for missing image: {p}")
+            report.add({"type": "pruned", "path": p, "actions": [f"Pruned metadata for missing image: {p}"]})
             del images_by_path[p]
 
+    # Thumbnails run last so they are keyed by each file's final content
+    # (after any geotag write). Indexed images whose source is missing keep
+    # their thumbnails; anything else unreferenced is evicted.
+    thumb_stats = None
+    if thumbnails:
+        print("Generating thumbnails...")
+        keep = []
+        for path, img in images_by_path.items():
+            if path not in thumb_sources:
+                keep.extend(thumb_files(img) or [thumb_path(path, size, thumbs_dir) for size, _ in THUMB_SIZES])
+        with metrics.stage("thumbnails"):
+            thumb_stats = generate_thumbnails_for_all(
+                images_dir=img_dir, thumbs_dir=thumbs_dir, debug=debug, workers=workers,
+                sources=thumb_sources, keep=keep, evict=not test_mode, previous=images_by_path,
+                widths=thumb_widths, formats=thumb_formats
+            )
+        metrics.count("thumbnails_generated", thumb_stats["generated"])
+        metrics.count("thumbnails_up_to_date", thumb_stats["up_to_date"])
+        metrics.count("thumbnails_evicted", thumb_stats["evicted"])
+        for path, outputs in thumb_stats["thumbs"].items():
+            images_by_path[path]["thumbs"] = outputs
+            images_by_path[path].update(thumb_stats["previews"].get(path, {}))
+            if path in new_files:
+                new_files[path]["thumbs"] = outputs
+
     # Prepare updated_images list for JSON output
-    updated_images = list(images_by_path.values())
+    # Sorted by path first so entries with equal dates keep a stable order
+    updated_images = sorted(images_by_path.values(), key=lambda img: img["path"])
     with_dates = [img for img in updated_images if img.get("taken") and img.get("taken").strip()]
     without_dates = [img for img in updated_images if not (img.get("taken") and img.get("taken").strip())]
     with_dates.sort(key=lambda img: img["taken"], reverse=True)
     without_dates.sort(key=lambda img: img.get("added", ""), reverse=True)
     updated_images = with_dates + without_dates
 
-    with open(json_path, "w", encoding="utf-8") as f:
-        f.write('{\n  "images": [\n')
-        for i, img in enumerate(updated_images):
-            line = json.dumps(img, ensure_ascii=False, separators=(',', ':'))
-            if i < len(updated_images) - 1:
-                line += ','
-            f.write(f'    {line}\n')
-        f.write('  ],\n  "pruned": [\n')
-        for i, img in enumerate(pruned_images):
-            line = json.dumps(img, ensure_ascii=False, separators=(',', ':'))
-            if i < len(pruned_images) - 1:
-                line += ','
-            f.write(f'    {line}\n')
-        f.write('  ]\n}\n')
-
-    results.sort(key=lambda x: (x[1] is not None, x[1]), reverse=True)
+    with metrics.stage("duplicates"):
+        groups = duplicate_groups(updated_images, duplicate_distance)
+    metrics.count("duplicate_groups", len(groups))
+    for group in groups:
+        report.add({"type": "duplicates", "paths": group, "actions": [f"Near-duplicates: {', '.join(group)}"]})
+    output_images = collapse_duplicates(updated_images, groups) if collapse else updated_images
+
+    with metrics.stage("json_write"):
+        json_changed, shard_stats = write_images_json(json_path, output_images, pruned_images, shard_size, shard_dir)
+
+    if manifest_path:
+        # Keep entries for indexed-but-missing files so a later move is still recognised
+        for old_path, entry in old_files.items():
+            if old_path not in new_files and old_path in images_by_path:
+                new_files[old_path] = entry
+        manifest["files"] = new_files
+        with metrics.stage("manifest_write"):
+            save_manifest(manifest_path, manifest)
+    if state:
+        state.remember(json_path, updated_images, all_image_files_list, manifest_path, manifest)
+
+    metrics.count("images_indexed", images_indexed)
+    metrics.count("images_from_manifest", actions["from_manifest"])
+    metrics.count("geotags_written", actions["geotag_updated"])
+    metrics.count("errors", len(actions["errors"]))
+    if json_changed:
+        metrics.count("json_bytes_written", os.path.getsize(json_path))
+
     print(f"\n--- Geotag & Index Summary ---")
     print(f"Total image files found: {len(all_image_files_list)}")
     print(f"New images added: {actions['added']}")
@@ -592,6 +2566,29 @@ def integrate_index_and_geotag(gpx_dir, img_dir, json_path, test_mode=False, deb
     print(f"Images with updated geotag: {actions['geotag_updated']}")
     print(f"Images skipped due to errors: {actions['skipped']}")
     print(f"Images pruned: {actions['pruned']}")
+    if thumb_stats:
+        print(f"Thumbnail cache: {thumb_stats['up_to_date']} up to date, {thumb_stats['generated']} generated, {thumb_stats['evicted']} evicted")
+    else:
+        print("Thumbnail cache: skipped (rendered on request by --serve)")
+    if groups:
+        collapsed = f", collapsed into {len(groups)} entries" if collapse else ""
+        print(f"Near-duplicate groups: {len(groups)} ({sum(len(group) for group in groups)} images{collapsed})")
+    for line in report.summary.lines():
+        print(line)
+    if report_path:
+        print(f"Report stream: {report_path}")
+    if journal:
+        print(f"Geotag journal: {journal_path} ({len(journal)} {'planned' if test_mode else 'recorded'})")
+    if shard_stats:
+        print(f"Shards: {shard_stats['written']} written, {shard_stats['unchanged']} unchanged, {shard_stats['removed']} removed")
+    if manifest_path:
+        print(f"Images served from manifest: {actions['from_manifest']}")
+        print(f"Images recognised as moved: {actions['moved']}")
+    if geocache or remote:
+        hits = geocache.hits if geocache else 0
+        misses = geocache.misses if geocache else 0
+        calls = remote.calls if remote else 0
+        print(f"Geocode cache: {hits} hits, {misses} misses, {calls} geopy lookups")
 
     if actions["errors"]:
         print(f"\nErrors encountered:")
@@ -599,34 +2596,632 @@ def integrate_index_and_geotag(gpx_dir, img_dir, json_path, test_mode=False, deb
             print(f" - {err}")
 
     print(f"\nDetailed actions:")
-    for detail in detailed_actions:
-        print(f" - {detail}")
+    for record in report.records():
+        for detail in record["actions"]:
+            print(f" - {detail}")
 
-    print(f"\nimages.json updated, sorted by date taken (most recent first).")
+    if json_changed:
+        print(f"\nimages.json updated, sorted by date taken (most recent first).")
+    else:
+        print(f"\nimages.json unchanged.")
 
     print(f"\n--- Detailed Geotag Output ---")
-    for _, _, text in results:
-        print(text)
+    for record in report.images_by_taken():
+        print("\n".join(report_lines(record)))
+    report.close()
+
+    if debug:
+        print(f"\n--- Stage Timings ---")
+        for line in metrics.summary_lines():
+            print(line)
+
+# --------- WATCH MODE ---------
+# Keeps running after the first pass and indexes files as they land. The
+# city table is a module-level singleton and stays loaded; WatchState keeps
+# the rest warm between runs.
+WATCH_GPX_EXTENSIONS = {".gpx"}
+
+def file_signature(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+class WatchState:
+    def __init__(self):
+        self.images = None
+        self.json_signature = None
+        self.manifest = None
+        self.manifest_signature = None
+        self.track = None
+        self.track_key = None
+        self.image_files = None  # Walk order, kept current by the watcher; None means walk again
+
+    def load_images(self, json_path):
+        # Shallow copies, since a run edits entries in place
+        if self.images is None or file_signature(json_path) != self.json_signature:
+            return load_images_json(json_path)
+        return [dict(img) for img in self.images]
+
+    def load_manifest(self, manifest_path):
+        if self.manifest is None or file_signature(manifest_path) != self.manifest_signature:
+            return load_manifest(manifest_path)
+        return {**self.manifest, "files": {path: dict(entry) for path, entry in self.manifest["files"].items()}}
+
+    def load_track(self, gpx_dir, debug=False, cache_dir=DEFAULT_GPX_CACHE_DIR):
+        key = [(path, file_signature(path)) for path in gpx_files_in(gpx_dir)]
+        if self.track is None or key != self.track_key:
+            self.track = load_gpx_track(gpx_dir, debug=debug, cache_dir=cache_dir)
+            self.track_key = key
+        return self.track
+
+    def remember(self, json_path, images, image_files, manifest_path, manifest):
+        self.images = images
+        self.json_signature = file_signature(json_path)
+        if self.image_files is None:
+            self.image_files = list(image_files)
+        if manifest_path:
+            self.manifest = manifest
+            self.manifest_signature = file_signature(manifest_path)
+
+    def forget(self):
+        self.__init__()
+
+    def is_change(self, path):
+        # False for files that are exactly as the last run left them, which
+        # covers the run's own geotag writes
+        ext = os.path.splitext(path)[1].lower()
+        if ext in WATCH_GPX_EXTENSIONS:
+            return True
+        if ext not in PHOTO_EXTENSIONS:
+            return False
+        entry = (self.manifest or {"files": {}})["files"].get(path)
+        signature = file_signature(path)
+        if entry is None:
+            return signature is not None
+        return signature != (entry["size"], entry["mtime_ns"])
+
+    def apply(self, paths):
+        # Brings the tracked file list in line with changed photo paths
+        if self.image_files is None:
+            return
+        known = set(self.image_files)
+        for path in sorted(paths):
+            if os.path.splitext(path)[1].lower() not in PHOTO_EXTENSIONS:
+                continue
+            exists = os.path.isfile(path)
+            if exists and path not in known:
+                self.image_files.append(path)
+                known.add(path)
+            elif not exists and path in known:
+                self.image_files.remove(path)
+                known.discard(path)
+
+class PollingWatcher:
+    # Rescans the directories every `interval` seconds and reports files whose
+    # size or mtime changed, appeared or disappeared
+    def __init__(self, dirs, interval=DEFAULT_WATCH_POLL):
+        self.dirs = dirs
+        self.interval = interval
+        self.snapshot = self._scan()
+
+    def _scan(self):
+        snapshot = {}
+        for d in self.dirs:
+            for root, dirs, files in os.walk(d):
+                for file in files:
+                    path = os.path.join(root, file).replace("\\", "/")
+                    snapshot[path] = file_signature(path)
+        return snapshot
+
+    def poll(self, timeout=None):
+        # Returns (changed paths, whether the file list must be walked again)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self.interval if deadline is None else min(self.interval, deadline - time.monotonic())
+            if wait > 0:
+                time.sleep(wait)
+            snapshot = self._scan()
+            changed = {path for path in snapshot.keys() | self.snapshot.keys() if snapshot.get(path) != self.snapshot.get(path)}
+            self.snapshot = snapshot
+            if changed or (deadline is not None and time.monotonic() >= deadline):
+                return changed, False
+
+class InotifyWatcher:
+    # Linux inotify through the optional inotify_simple package. Watches are
+    # per directory, so new subdirectories get their own as they appear.
+    def __init__(self, dirs):
+        from inotify_simple import INotify, flags
+        self.flags = flags
+        self.inotify = INotify()
+        self.mask = (flags.CLOSE_WRITE | flags.MOVED_TO | flags.MOVED_FROM | flags.DELETE
+                     | flags.CREATE | flags.DELETE_SELF)
+        self.watches = {}
+        for d in dirs:
+            self._watch_tree(d)
+
+    def _watch_tree(self, top):
+        for root, dirs, files in os.walk(top):
+            try:
+                self.watches[self.inotify.add_watch(root, self.mask)] = root.replace("\\", "/")
+            except OSError:
+                pass
+
+    def poll(self, timeout=None):
+        events = self.inotify.read(timeout=None if timeout is None else int(timeout * 1000))
+        changed, rewalk = set(), False
+        for event in events:
+            if event.mask & self.flags.Q_OVERFLOW:
+                rewalk = True
+                continue
+            parent = self.watches.get(event.wd)
+            if event.mask & self.flags.IGNORED:
+                self.watches.pop(event.wd, None)
+                continue
+            if parent is None or not event.name:
+                continue
+            path = f"{parent}/{event.name}"
+            if event.mask & self.flags.ISDIR:
+                # A directory moved or created with files already inside
+                # produces no events for them
+                if event.mask & (self.flags.CREATE | self.flags.MOVED_TO):
+                    self._watch_tree(path)
+                rewalk = True
+            else:
+                changed.add(path)
+        return changed, rewalk
+
+def make_watcher(dirs, polling=False, interval=DEFAULT_WATCH_POLL, debug=False):
+    if not polling:
+        try:
+            return InotifyWatcher(dirs)
+        except (ImportError, OSError) as e:
+            if debug:
+                print(f"[DEBUG] inotify unavailable ({e}); polling every {interval}s")
+    return PollingWatcher(dirs, interval)
+
+def watch_index(gpx_dir, img_dir, json_path, debounce=DEFAULT_WATCH_DEBOUNCE, max_delay=DEFAULT_WATCH_MAX_DELAY,
+                polling=False, poll_interval=DEFAULT_WATCH_POLL, metrics_path=None, **options):
+    # Runs integrate_index_and_geotag once, then again for every burst of
+    # changes: a batch closes after `debounce` quiet seconds, or `max_delay`
+    # seconds after its first change when files keep arriving.
+    state = WatchState()
+    dirs = [d for d in (img_dir, gpx_dir) if os.path.isdir(d)]
+    watcher = make_watcher(dirs, polling=polling, interval=poll_interval, debug=options.get("debug"))
+    print(f"Watching {', '.join(dirs)} ({'polling' if isinstance(watcher, PollingWatcher) else 'inotify'}); Ctrl-C to stop")
+
+    def run(reason):
+        print(f"\n=== {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} {reason} ===")
+        try:
+            integrate_index_and_geotag(gpx_dir, img_dir, json_path, state=state, **options)
+        except Exception as e:
+            # Next run starts cold rather than from state a failed run may have half-updated
+            print(f"Error: indexing run failed: {e}")
+            state.forget()
+        if metrics_path:
+            metrics.save(metrics_path)
+
+    run("initial index")
+    try:
+        while True:
+            changed, rewalk = watcher.poll()
+            first = time.monotonic()
+            while True:
+                quiet = min(debounce, first + max_delay - time.monotonic())
+                if quiet <= 0:
+                    break
+                more, more_rewalk = watcher.poll(quiet)
+                if not more and not more_rewalk:
+                    break
+                changed |= more
+                rewalk = rewalk or more_rewalk
+            changed = {path for path in changed if state.is_change(path)}
+            if not changed and not rewalk:
+                continue
+            if rewalk:
+                state.image_files = None
+            state.apply(changed)
+            run(f"{len(changed)} changed file{'s' if len(changed) != 1 else ''}" + (", rescanning" if rewalk else ""))
+    except KeyboardInterrupt:
+        print("\nStopped watching.")
+
+# --------- PREVIEW SERVER ---------
+# Serves the site for local previews and renders thumbnails the first time
+# they are requested, so a fresh import is viewable without a full thumbnail
+# pass. Rendered files land in the thumbs directory (the on-disk cache) and
+# the most recently used ones are also kept in memory.
+PREVIEW_IMMUTABLE = "public, max-age=31536000, immutable"  # Content-keyed names never change
+PREVIEW_COPY_CHUNK = 1 << 16
+
+def preview_sources(images, thumbs_dir=DEFAULT_THUMBS_DIR):
+    # URL path -> (source image, width, format, content keyed) for every
+    # thumbnail the gallery may ask for: the variants listed in images.json
+    # and the legacy {name}_{size}.webp names it falls back to without them
+    sources = {}
+    for img in images:
+        path = img.get("path")
+        if not path:
+            continue
+        thumbs = img.get("thumbs")
+        # Only the legacy {size: path} dict has names that aren't content keyed
+        keyed = not (isinstance(thumbs, dict) and "base" not in thumbs)
+        for src, width, fmt in thumb_variants(thumbs):
+            sources.setdefault(norm_path(src), (path, width, fmt, keyed))
+        for size, width in THUMB_SIZES:
+            sources.setdefault(norm_path(thumb_path(path, size, thumbs_dir)), (path, width, "WEBP", False))
+    return sources
+
+def parse_byte_range(header, size):
+    # Single "bytes=" range -> (start, end) with end exclusive. None when it
+    # can't be satisfied; () when it is malformed or asks for several ranges,
+    # which is answered with the whole body.
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return ()
+    first, dash, last = spec.strip().partition("-")
+    if not dash:
+        return ()
+    try:
+        if first:
+            start, end = int(first), int(last) + 1 if last else size
+            if last and end <= start:
+                return ()
+        elif last:
+            start, end = max(0, size - int(last)), size
+        else:
+            return ()
+    except ValueError:
+        return ()
+    if start >= size or start < 0:
+        return None
+    return start, min(end, size)
+
+class ByteLRU:
+    # Thread-safe LRU of (bytes, file signature) by path, bounded by total size
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                self._items.move_to_end(key)
+            return item
+
+    def put(self, key, data, signature):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.bytes -= len(old[0])
+            self._items[key] = (data, signature)
+            self.bytes += len(data)
+            while self.bytes > self.max_bytes:
+                _, (evicted, _) = self._items.popitem(last=False)
+                self.bytes -= len(evicted)
+
+class PreviewThumbnails:
+    # Thumbnail lookups for the preview server. images.json is reread when it
+    # changes; at most `max_renders` thumbnails are rendered at once, and
+    # concurrent requests for the same one wait for a single render.
+    def __init__(self, json_path=DEFAULT_JSON_PATH, thumbs_dir=DEFAULT_THUMBS_DIR, max_renders=None,
+                 cache_bytes=DEFAULT_PREVIEW_CACHE_MB * 1024 * 1024):
+        self.json_path = json_path
+        self.thumbs_dir = thumbs_dir
+        self.cache = ByteLRU(cache_bytes)
+        self.renders = threading.BoundedSemaphore(max_renders or os.cpu_count() or 1)
+        self.rendered = 0
+        self._sources = {}
+        self._json_signature = None
+        self._lock = threading.Lock()
+        # path -> [render lock, requests holding or waiting for it]
+        self._rendering = {}
+
+    def sources(self):
+        signature = file_signature(self.json_path)
+        with self._lock:
+            if signature != self._json_signature:
+                self._sources = preview_sources(load_images_json(self.json_path), self.thumbs_dir)
+                self._json_signature = signature
+            return self._sources
+
+    def _is_fresh(self, path, src_path, keyed):
+        # Content-keyed names are fresh once they exist; legacy names must be
+        # newer than their source
+        thumb = file_signature(path)
+        if thumb is None:
+            return False
+        if keyed:
+            return True
+        source = file_signature(src_path)
+        return source is None or thumb[1] >= source[1]
+
+    def get(self, path):
+        # (bytes, (size, mtime_ns), content keyed) for a known thumbnail path,
+        # rendered first if needed; None for anything else
+        source = self.sources().get(path)
+        if source is None:
+            return None
+        src_path, width, fmt, keyed = source
+        # The entry is dropped by the last request using it, under the
+        # registry lock, so a new request never gets a second lock for a path
+        # that is still being rendered
+        with self._lock:
+            entry = self._rendering.setdefault(path, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                if not self._is_fresh(path, src_path, keyed):
+                    ensure_dir(os.path.dirname(path) or ".")
+                    with self.renders:
+                        render_thumbnails(src_path, [(path, width, fmt)])
+                    with self._lock:
+                        self.rendered += 1
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._rendering[path]
+        signature = file_signature(path)
+        cached = self.cache.get(path)
+        if cached and cached[1] == signature:
+            return cached[0], signature, keyed
+        with open(path, "rb") as f:
+            data = f.read()
+        self.cache.put(path, data, signature)
+        return data, signature, keyed
+
+class PreviewRequestHandler(SimpleHTTPRequestHandler):
+    # Static files as SimpleHTTPRequestHandler serves them, plus ETag,
+    # conditional requests and single byte ranges; thumbnail paths go through
+    # the server's PreviewThumbnails first.
+    def do_GET(self):
+        self.serve(head=False)
+
+    def do_HEAD(self):
+        self.serve(head=True)
+
+    def serve(self, head):
+        url_path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path).lstrip("/")
+        try:
+            found = self.server.thumbnails.get(norm_path(url_path)) if url_path else None
+        except Exception as e:
+            self.send_error(500, f"Thumbnail rendering failed: {e}")
+            return
+        if found:
+            data, (size, mtime_ns), keyed = found
+            self.send_body(lambda start, end: self.wfile.write(data[start:end]), size, mtime_ns,
+                           self.guess_type(url_path), head, PREVIEW_IMMUTABLE if keyed else "no-cache")
+            return
+        fs_path = self.translate_path(self.path)
+        if os.path.isdir(fs_path):
+            # Directory redirects and index.html
+            return super().do_HEAD() if head else super().do_GET()
+        try:
+            st = os.stat(fs_path)
+        except OSError:
+            self.send_error(404, "File not found")
+            return
+
+        def copy(start, end):
+            with open(fs_path, "rb") as f:
+                f.seek(start)
+                remaining = end - start
+                while remaining > 0:
+                    chunk = f.read(min(PREVIEW_COPY_CHUNK, remaining))
+                    if not chunk:
+                        break
+                    self.wfile.write(chunk)
+                    remaining -= len(chunk)
+
+        self.send_body(copy, st.st_size, st.st_mtime_ns, self.guess_type(fs_path), head, "no-cache")
+
+    def not_modified(self, etag, mtime_ns):
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match:
+            return if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if if_modified_since:
+            try:
+                return mtime_ns // 1_000_000_000 <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                pass
+        return False
+
+    def send_body(self, write, size, mtime_ns, content_type, head, cache_control):
+        # write(start, end) sends that slice of the body
+        etag = f'"{size:x}-{mtime_ns:x}"'
+        last_modified = formatdate(mtime_ns / 1e9, usegmt=True)
+        validators = [("ETag", etag), ("Last-Modified", last_modified), ("Cache-Control", cache_control)]
+        if self.not_modified(etag, mtime_ns):
+            self.send_response(304)
+            for name, value in validators:
+                self.send_header(name, value)
+            self.end_headers()
+            return
+        start, end, status = 0, size, 200
+        range_header = self.headers.get("Range")
+        if_range = self.headers.get("If-Range")
+        if range_header and (not if_range or if_range.strip() in (etag, last_modified)):
+            byte_range = parse_byte_range(range_header, size)
+            if byte_range is None:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            if byte_range:
+                (start, end), status = byte_range, 206
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(end - start))
+        self.send_header("Accept-Ranges", "bytes")
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end - 1}/{size}")
+        for name, value in validators:
+            self.send_header(name, value)
+        self.end_headers()
+        if not head:
+            write(start, end)
+
+def serve_preview(host="127.0.0.1", port=DEFAULT_PREVIEW_PORT, json_path=DEFAULT_JSON_PATH, thumbs_dir=DEFAULT_THUMBS_DIR,
+                  max_renders=None, cache_mb=DEFAULT_PREVIEW_CACHE_MB):
+    # Serves the current directory (the site root) until interrupted
+    server = ThreadingHTTPServer((host, port), partial(PreviewRequestHandler, directory=os.getcwd()))
+    server.thumbnails = PreviewThumbnails(json_path, thumbs_dir, max_renders, int(cache_mb * 1024 * 1024))
+    print(f"Serving http://{host}:{server.server_address[1]}/ with thumbnails rendered on request; Ctrl-C to stop")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(f"\nStopped serving ({server.thumbnails.rendered} thumbnails rendered).")
+    finally:
+        server.server_close()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Integrate image indexing and geotagging using GPX files")
     parser.add_argument("--gpxdir", type=str, default=DEFAULT_GPX_DIR, help="Directory containing GPX files")
     parser.add_argument("--imgdir", type=str, default=DEFAULT_IMAGE_DIR, help="Directory containing images")
+    parser.add_argument("--thumbsdir", type=str, default=DEFAULT_THUMBS_DIR, help="Directory for generated thumbnails")
     parser.add_argument("--jsonpath", type=str, default=DEFAULT_JSON_PATH, help="Path for images.json")
+    parser.add_argument("--shard-size", type=int, default=DEFAULT_SHARD_SIZE, help="Images per shard; writes images.json as an index plus shard files (0 = single file)")
+    parser.add_argument("--shard-dir", type=str, default=DEFAULT_SHARD_DIR, help="Shard directory, relative to images.json")
     parser.add_argument("--test", action="store_true", help="Test mode (dry run; no changes made)")
     parser.add_argument("--debug", action="store_true", help="Debug mode (prints detailed information)")
     parser.add_argument("--window", type=int, default=3600, help="Window in seconds to match photo to GPX point")
     parser.add_argument("--force", action="store_true", help="Force update width, height, taken, location even if already present")
     parser.add_argument("--prune", action="store_true", help="Remove images from JSON that are no longer in the directory")
+    parser.add_argument("--interpolate", action="store_true", help="Geotag with the position interpolated between the GPX points around each photo")
+    parser.add_argument("--max-gap", type=int, default=DEFAULT_INTERP_MAX_GAP, help="Max seconds between GPX points to interpolate across")
+    parser.add_argument("--max-speed", type=float, default=DEFAULT_INTERP_MAX_SPEED, help="Max implied speed (km/h) between GPX points to interpolate across")
+    parser.add_argument("--full", action="store_true", help="Reprocess every image instead of skipping ones unchanged since the last run")
+    parser.add_argument("--manifest", type=str, default=DEFAULT_MANIFEST, help="Incremental indexing manifest (empty string disables)")
+    parser.add_argument("--workers", type=int, default=None, help="Processes for thumbnail generation (default: CPU count)")
+    parser.add_argument("--geotag-mode", choices=GEOTAG_MODES, default="exif", help="Write matched GPS into the image EXIF or an XMP sidecar")
+    parser.add_argument("--sidecar-naming", choices=SIDECAR_NAMINGS, default="file",
+                        help="XMP sidecar name: IMG_0001.jpg.xmp (file) or IMG_0001.xmp (stem); both are read")
+    parser.add_argument("--journal", type=str, default=None, help="JSONL journal of geotag writes (default: a new file per run under .index_cache/journal)")
+    parser.add_argument("--rollback", type=str, default=None, help="Undo the geotag writes recorded in this journal and exit")
+    parser.add_argument("--metrics", type=str, default=DEFAULT_METRICS, help="Append this run's stage timings and counters as a JSON line (empty string disables)")
+    parser.add_argument("--profile", type=str, default=None, help="Write a cProfile dump of the run to this file and print the top functions")
+    parser.add_argument("--tracemalloc", action="store_true", help="Record peak Python memory and the top allocation sites in the metrics")
+    parser.add_argument("--io-workers", type=int, default=DEFAULT_IO_WORKERS, help="Threads reading image files ahead of indexing (1 = serial)")
+    parser.add_argument("--watch", action="store_true", help="Keep running and index new or changed photos and GPX files as they arrive")
+    parser.add_argument("--watch-debounce", type=float, default=DEFAULT_WATCH_DEBOUNCE, help="Seconds without new changes before a batch is indexed")
+    parser.add_argument("--watch-poll", type=float, default=None, help=f"Poll the directories every N seconds instead of using inotify (default without inotify_simple: {DEFAULT_WATCH_POLL})")
+    parser.add_argument("--thumb-widths", type=str, default=",".join(map(str, THUMB_WIDTHS)), help="Comma-separated thumbnail widths for srcset")
+    parser.add_argument("--thumb-formats", type=str, default=",".join(THUMB_EXTENSIONS[fmt] for fmt in THUMB_FORMATS),
+                        help=f"Comma-separated thumbnail formats, best first ({', '.join(THUMB_EXTENSIONS.values())})")
+    parser.add_argument("--defer-thumbs", action="store_true", help="Skip the thumbnail pass; --serve renders missing thumbnails on request")
+    parser.add_argument("--serve", action="store_true", help="Serve the site locally, rendering thumbnails on first request, and exit when stopped")
+    parser.add_argument("--port", type=int, default=DEFAULT_PREVIEW_PORT, help="Port for --serve")
+    parser.add_argument("--bind", type=str, default="127.0.0.1", help="Address for --serve to listen on")
+    parser.add_argument("--max-renders", type=int, default=None, help="Thumbnails --serve renders at once (default: CPU count)")
+    parser.add_argument("--preview-cache-mb", type=float, default=DEFAULT_PREVIEW_CACHE_MB, help="Memory --serve keeps for recently served thumbnails")
+    parser.add_argument("--duplicate-distance", type=int, default=DEFAULT_DUPLICATE_DISTANCE, help="Max differing perceptual-hash bits (of 64) for photos to count as near-duplicates")
+    parser.add_argument("--collapse-duplicates", action="store_true", help="Write each near-duplicate group as one entry, the others nested under it")
+    parser.add_argument("--report", type=str, default=DEFAULT_REPORT, help="JSONL file for the per-image run report (empty string keeps it in a temporary file)")
+    parser.add_argument("--build-city-table", action="store_true", help=f"Compile {WORLDCITIES_CSV} into {DEFAULT_CITY_TABLE} and exit (otherwise done on first lookup)")
+    parser.add_argument("--gpx-cache", type=str, default=DEFAULT_GPX_CACHE_DIR, help="Directory for compiled GPX tracks (empty string disables)")
+    parser.add_argument("--geocache", type=str, default=DEFAULT_GEOCODE_CACHE, help="SQLite reverse-geocode cache (empty string disables)")
+    parser.add_argument("--geocache-precision", type=int, default=DEFAULT_GEOCODE_PRECISION, help="Decimal places of lat/lon used as cache key")
+    parser.add_argument("--geocache-ttl", type=float, default=DEFAULT_GEOCODE_TTL_DAYS, help="Days before a cached place name is looked up again (0 = never expire)")
+    parser.add_argument("--geocode-budget", type=float, default=DEFAULT_GEOCODE_BUDGET, help="Max seconds to wait on rate-limited geopy lookups")
     args = parser.parse_args()
+    by_extension = {ext: fmt for fmt, ext in THUMB_EXTENSIONS.items()}
+    by_extension["jpeg"] = "JPEG"
+    try:
+        args.thumb_widths = sorted({int(w) for w in args.thumb_widths.split(",") if w.strip()})
+        args.thumb_formats = list(dict.fromkeys(by_extension[f.strip().lower()] for f in args.thumb_formats.split(",") if f.strip()))
+    except (ValueError, KeyError) as e:
+        parser.error(f"bad --thumb-widths/--thumb-formats value: {e}")
+    if not args.thumb_widths or min(args.thumb_widths) <= 0 or not args.thumb_formats:
+        parser.error("--thumb-widths and --thumb-formats need at least one positive width and one format")
+
+    if args.rollback:
+        rollback_journal(args.rollback, debug=args.debug, manifest_path=args.manifest)
+        raise SystemExit(0)
 
-    integrate_index_and_geotag(
-        gpx_dir=args.gpxdir,
-        img_dir=args.imgdir,
-        json_path=args.jsonpath,
+    if args.serve:
+        serve_preview(args.bind, args.port, json_path=args.jsonpath, thumbs_dir=args.thumbsdir,
+                      max_renders=args.max_renders, cache_mb=args.preview_cache_mb)
+        raise SystemExit(0)
+
+    if args.build_city_table:
+        if not os.path.exists(WORLDCITIES_CSV):
+            parser.error(f"--build-city-table needs {WORLDCITIES_CSV}")
+        start = time.perf_counter()
+        city_index = build_city_table()
+        print(f"Compiled {len(city_index.labels)} cities into {DEFAULT_CITY_TABLE} in {time.perf_counter() - start:.2f}s")
+        raise SystemExit(0)
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler:
+        profiler.enable()
+
+    options = dict(
         test_mode=args.test,
         debug=args.debug,
         window_seconds=args.window,
         force=args.force,
-        prune=args.prune
-    )
\ No newline at end of file
+        prune=args.prune,
+        geocache_path=args.geocache,
+        geocache_precision=args.geocache_precision,
+        geocache_ttl_days=args.geocache_ttl,
+        geocode_budget=args.geocode_budget,
+        interpolate=args.interpolate,
+        max_gap=args.max_gap,
+        max_speed_kmh=args.max_speed,
+        gpx_cache_dir=args.gpx_cache,
+        manifest_path=args.manifest,
+        full=args.full,
+        workers=args.workers,
+        io_workers=args.io_workers,
+        geotag_mode=args.geotag_mode,
+        sidecar_naming=args.sidecar_naming,
+        journal_path=args.journal,
+        thumbs_dir=args.thumbsdir,
+        shard_size=args.shard_size,
+        shard_dir=args.shard_dir,
+        thumbnails=not args.defer_thumbs,
+        duplicate_distance=args.duplicate_distance,
+        collapse=args.collapse_duplicates,
+        report_path=args.report,
+        thumb_widths=args.thumb_widths,
+        thumb_formats=args.thumb_formats
+    )
+    if args.watch:
+        if not args.manifest:
+            parser.error("--watch needs the manifest to tell new files from ones already indexed")
+        watch_index(
+            args.gpxdir, args.imgdir, args.jsonpath,
+            debounce=args.watch_debounce,
+            polling=args.watch_poll is not None,
+            poll_interval=args.watch_poll or DEFAULT_WATCH_POLL,
+            metrics_path=args.metrics,
+            **options
+        )
+    else:
+        integrate_index_and_geotag(args.gpxdir, args.imgdir, args.jsonpath, **options)
+
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+        print(f"\n--- Profile (top 25 by cumulative time, full dump in {args.profile}) ---")
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(25)
+    if args.tracemalloc:
+        _, peak = tracemalloc.get_traced_memory()
+        top = tracemalloc.take_snapshot().statistics("lineno")[:10]
+        tracemalloc.stop()
+        metrics.extra["memory"] = {
+            "peak_bytes": peak,
+            "top": [{"site": str(stat.traceback), "bytes": stat.size, "count": stat.count} for stat in top]
+        }
+    if args.metrics and not args.watch:
+        metrics.save(args.metrics)
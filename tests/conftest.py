@@ -0,0 +1,38 @@
+import os
+import shutil
+import sys
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+sys.path.insert(0, REPO_ROOT)
+
+import index_and_enrich as ie  # noqa: E402
+
+# Two of the repo's sample photos, both dated (2018-11-24 22:18 and 23:56 UTC)
+# and without GPS, so the fixture track can geotag them
+SAMPLE_IMAGES = (
+    "boule-d-or_2077480944_o.jpg",
+    "a-representation-of-our-cultural-deification-of-sugar_14349347030_o.jpg",
+)
+
+
+@pytest.fixture
+def site(tmp_path, monkeypatch):
+    # Scratch site root laid out like the repo: the sample photos under
+    # images/, the fixture track under gpx/ and a small city table under
+    # assets/. Paths in images.json, the manifest and the journal are relative
+    # to it, as in the real repo, and nothing goes to the network.
+    images_dir = tmp_path / "images"
+    images_dir.mkdir()
+    for name in SAMPLE_IMAGES:
+        shutil.copy(os.path.join(REPO_ROOT, "images", name), images_dir / name)
+    (tmp_path / "gpx").mkdir()
+    shutil.copy(os.path.join(FIXTURES, "track.gpx"), tmp_path / "gpx" / "track.gpx")
+    (tmp_path / "assets").mkdir()
+    shutil.copy(os.path.join(FIXTURES, "worldcities.csv"), tmp_path / "assets" / "worldcities.csv")
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(ie, "_city_index", None)
+    monkeypatch.setattr(ie, "get_geolocator", lambda: None)
+    return tmp_path
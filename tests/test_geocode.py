@@ -0,0 +1,91 @@
+import csv
+import os
+
+import numpy as np
+import pytest
+
+import index_and_enrich as ie
+
+
+def random_cities(path, count, seed=0):
+    # A table dense enough to need many tree levels, with a few exact
+    # duplicate positions (as the real table has)
+    rng = np.random.default_rng(seed)
+    lats = np.degrees(np.arcsin(rng.uniform(-1, 1, count)))
+    lons = rng.uniform(-180, 180, count)
+    lats[-5:], lons[-5:] = lats[:5], lons[:5]
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["city", "country", "lat", "lng"])
+        for i, (lat, lon) in enumerate(zip(lats, lons)):
+            writer.writerow([f"City {i}", f"Country {i % 7}", lat, lon])
+    return lats, lons
+
+
+def brute_force_km(lats, lons, qlat, qlon):
+    return ie.haversine(qlat, qlon, lats, lons).min()
+
+
+def test_tree_lookup_matches_brute_force(tmp_path):
+    csv_path = tmp_path / "cities.csv"
+    lats, lons = random_cities(csv_path, 3000)
+    index = ie.CityIndex.from_csv(str(csv_path))
+    rng = np.random.default_rng(1)
+    qlats = np.degrees(np.arcsin(rng.uniform(-1, 1, 400)))
+    qlons = rng.uniform(-180, 180, 400)
+    # Near the poles and across the antimeridian too
+    qlats = np.concatenate([qlats, [89.9, -89.9, 12.0, -40.0]])
+    qlons = np.concatenate([qlons, [0.0, 135.0, 179.999, -179.999]])
+
+    idx, dist_km = index.query(qlats, qlons)
+
+    for i, (qlat, qlon) in enumerate(zip(qlats, qlons)):
+        expected = brute_force_km(lats, lons, qlat, qlon)
+        assert dist_km[i] == pytest.approx(expected, abs=1e-6)
+        assert ie.haversine(qlat, qlon, lats[idx[i]], lons[idx[i]]) == pytest.approx(expected, abs=1e-6)
+
+
+def test_lookup_labels_and_max_distance(tmp_path):
+    csv_path = tmp_path / "cities.csv"
+    csv_path.write_text("city,country,lat,lng\nBrussels,Belgium,50.8467,4.3525\nParis,France,48.8567,2.3522\n",
+                        encoding="utf-8")
+    index = ie.CityIndex.from_csv(str(csv_path))
+    assert index.lookup([50.85, 48.85, 0.0], [4.35, 2.35, 0.0]) == ["Brussels, Belgium", "Paris, France", None]
+    assert index.nearest(50.85, 4.35)[0] == 0
+
+
+def test_compiled_table_round_trip(tmp_path):
+    csv_path = tmp_path / "cities.csv"
+    random_cities(csv_path, 500)
+    table_dir = str(tmp_path / "table")
+    built = ie.build_city_table(str(csv_path), table_dir)
+    loaded = ie.CityIndex.load(table_dir, ie.city_table_source(str(csv_path)))
+    qlats, qlons = [10.0, -33.9, 64.1], [20.0, 18.4, -21.9]
+    assert loaded.lookup(qlats, qlons, max_km=20000) == built.lookup(qlats, qlons, max_km=20000)
+    np.testing.assert_array_equal(loaded.query(qlats, qlons)[0], built.query(qlats, qlons)[0])
+
+    # A changed CSV makes the compiled table stale
+    with open(csv_path, "a", encoding="utf-8") as f:
+        f.write("Extra,Nowhere,1.0,1.0\n")
+    with pytest.raises(ValueError):
+        ie.CityIndex.load(table_dir, ie.city_table_source(str(csv_path)))
+
+
+def test_city_index_without_table_or_csv(tmp_path, monkeypatch):
+    monkeypatch.setattr(ie, "_city_index", None)
+    missing = str(tmp_path / "missing")
+    assert ie.get_city_index(os.path.join(missing, "table"), os.path.join(missing, "worldcities.csv")) is None
+
+
+def test_resolve_places_offline(site):
+    places = ie.resolve_places([(50.8401, 4.3501), (50.8401, 4.3501), (-45.0, -120.0)])
+    assert places[(50.8401, 4.3501)] == "Brussels, Belgium"
+    # No city nearby and no remote geocoder: an explicit unknown placeholder
+    assert places[(-45.0, -120.0)] == ie.unknown_place(-45.0, -120.0)
+
+
+def test_resolve_places_without_city_table(site):
+    # Left unresolved (None) rather than saved as unknown, so a later run
+    # with the table fills them in
+    os.remove("assets/worldcities.csv")
+    assert ie.resolve_places([(50.8401, 4.3501)]) == {(50.8401, 4.3501): None}
@@ -0,0 +1,62 @@
+import datetime
+
+import numpy as np
+import pytest
+
+import index_and_enrich as ie
+
+
+def utc(*args):
+    return datetime.datetime(*args, tzinfo=datetime.timezone.utc)
+
+
+def test_fixture_track_loads_and_caches(site):
+    track = ie.load_gpx_track("gpx", cache_dir=".gpx_cache")
+    assert len(track) == 12
+    assert track.point(0) == {"lat": 50.84, "lon": 4.35, "time": utc(2018, 11, 24, 22, 0)}
+    # The second load comes from the compiled cache and gives the same arrays
+    cached = ie.load_gpx_track("gpx", cache_dir=".gpx_cache")
+    np.testing.assert_array_equal(cached.epochs, track.epochs)
+    np.testing.assert_array_equal(cached.lats, track.lats)
+
+
+def test_match_batch_picks_closest_point_within_window(site):
+    track = ie.load_gpx_track("gpx", cache_dir="")
+    epochs = [ie.to_epoch(utc(2018, 11, 24, 22, 18, 42)), ie.to_epoch(utc(2018, 11, 24, 23, 56, 56)),
+              ie.to_epoch(utc(2018, 11, 25, 3, 0))]
+    best, before, after = track.match_batch(epochs, window_seconds=3600)
+    assert list(best) == [2, 11, -1]
+    assert list(before) == [1, 11, 11]
+    assert list(after) == [2, -1, -1]
+
+
+def test_interpolation_follows_the_great_circle():
+    # Along the equator, position is linear in time
+    track = ie.TrackStore([0, 1000], [0.0, 0.0], [0.0, 10.0])
+    lats, lons, ok = ie.interpolate_positions(track, [500, 250], [0, 0], [1, 1], max_gap=3600, max_speed_kmh=1e6)
+    assert ok.all()
+    assert lats == pytest.approx([0.0, 0.0], abs=1e-9)
+    assert lons == pytest.approx([5.0, 2.5])
+
+
+def test_interpolation_across_the_antimeridian():
+    # Halfway between two fixes at the same latitude lies on the antimeridian,
+    # slightly poleward (the great circle, not the parallel)
+    track = ie.TrackStore([0, 1000], [10.0, 10.0], [179.0, -179.0])
+    lats, lons, ok = ie.interpolate_positions(track, [500], [0], [1], max_gap=3600, max_speed_kmh=1e6)
+    assert ok[0]
+    assert abs(lons[0]) == pytest.approx(180.0)
+    assert 10.0 < lats[0] < 10.01
+    assert ie.haversine(10.0, 179.0, lats[0], lons[0]) == pytest.approx(ie.haversine(10.0, 179.0, 10.0, -179.0) / 2)
+
+
+def test_interpolation_rejects_gaps_speed_and_unbracketed_photos():
+    # 1.3 km in 10 minutes (7.9 km/h), then a 9400 s gap
+    track = ie.TrackStore([0, 600, 10000], [50.0, 50.01, 50.02], [4.0, 4.01, 4.02])
+    lats, lons, ok = ie.interpolate_positions(
+        track, [300, 5000, 11000], [0, 1, 2], [1, 2, -1], max_gap=3600, max_speed_kmh=20)
+    assert list(ok) == [True, False, False]
+    assert lats[0] == pytest.approx(50.005, abs=1e-4)
+    assert lons[0] == pytest.approx(4.005, abs=1e-4)
+    _, _, ok = ie.interpolate_positions(track, [300], [0], [1], max_gap=3600, max_speed_kmh=5)
+    assert not ok[0]
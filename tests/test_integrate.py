@@ -0,0 +1,127 @@
+import glob
+import json
+import os
+
+import pytest
+
+import index_and_enrich as ie
+from conftest import SAMPLE_IMAGES
+
+PHOTOS = ["images/" + name for name in SAMPLE_IMAGES]
+
+EXISTING_SIDECAR = """<?xpacket begin="\ufeff" id="W5M0MpCehiHzreSzNTczkc9d"?>
+<x:xmpmeta xmlns:x="adobe:ns:meta/">
+ <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
+  <rdf:Description rdf:about="" xmlns:xmp="http://ns.adobe.com/xap/1.0/" xmp:Rating="4"/>
+ </rdf:RDF>
+</x:xmpmeta>
+<?xpacket end="w"?>
+"""
+
+
+@pytest.fixture
+def reads(monkeypatch):
+    # Paths whose image metadata a run actually opened
+    opened = []
+    read_image_record = ie.read_image_record
+
+    def counting(path):
+        opened.append(path)
+        return read_image_record(path)
+
+    monkeypatch.setattr(ie, "read_image_record", counting)
+    return opened
+
+
+def run(**options):
+    # One indexing run over the site fixture; returns its report records
+    ie.integrate_index_and_geotag("gpx", "images", "images.json", thumbnails=False, shard_size=0, **options)
+    with open(ie.DEFAULT_REPORT, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def image_records(records):
+    return {record["path"]: record for record in records if record["type"] == "image"}
+
+
+def gps_of(path):
+    record = ie.read_image_record(path)
+    return ie.get_lat_lon(record["gps"]) if record["gps"] else None
+
+
+def test_geotags_from_the_track_and_skips_unchanged_images(site, reads):
+    records = image_records(run())
+    assert {path: record["status"] for path, record in records.items()} == dict.fromkeys(PHOTOS, "updated")
+    lat, lon = gps_of(PHOTOS[0])
+    assert (lat, lon) == pytest.approx((50.842, 4.352), abs=1e-4)
+    images = {img["path"]: img for img in ie.load_images_json("images.json")}
+    assert [images[path]["location"] for path in PHOTOS] == ["Brussels, Belgium"] * 2
+    manifest = ie.load_manifest(ie.DEFAULT_MANIFEST)
+    # Written photos are final, and the entry has the hash after the write
+    assert manifest["files"][PHOTOS[0]]["match_key"] is None
+    assert manifest["files"][PHOTOS[0]]["hash"] == ie.content_hash(PHOTOS[0])
+
+    reads.clear()
+    assert image_records(run()) == {}
+    assert reads == []
+
+    # Only the edited photo is read again
+    with open(PHOTOS[1], "ab") as f:
+        f.write(b"\0")
+    records = image_records(run())
+    assert reads == [PHOTOS[1]]
+    assert records[PHOTOS[1]]["status"] == "already_geotagged"
+
+
+def test_test_mode_writes_nothing_and_rechecks_next_run(site, reads):
+    before = [ie.content_hash(path) for path in PHOTOS]
+    records = image_records(run(test_mode=True))
+    assert {record["status"] for record in records.values()} == {"would_update"}
+    assert [ie.content_hash(path) for path in PHOTOS] == before
+    assert glob.glob(os.path.join(ie.DEFAULT_JOURNAL_DIR, "*-dry-run.jsonl"))
+    # Planned writes stay pending in the manifest
+    reads.clear()
+    run(test_mode=True)
+    assert sorted(reads) == sorted(PHOTOS)
+
+
+def test_rollback_restores_exif_and_is_not_redone(site):
+    run()
+    journal, = glob.glob(os.path.join(ie.DEFAULT_JOURNAL_DIR, "*.jsonl"))
+    assert ie.rollback_journal(journal, manifest_path=ie.DEFAULT_MANIFEST) == (2, [])
+    assert [gps_of(path) for path in PHOTOS] == [None, None]
+    assert all(entry.get("rolled_back") for entry in ie.load_manifest(ie.DEFAULT_MANIFEST)["files"].values())
+
+    # Not even a full re-index geotags them again while they are unchanged
+    records = image_records(run(full=True))
+    assert {record["status"] for record in records.values()} == {"rolled_back"}
+    assert [gps_of(path) for path in PHOTOS] == [None, None]
+
+    # A second rollback finds nothing to undo
+    assert ie.rollback_journal(journal)[0] == 0
+
+
+def test_xmp_sidecar_merge_and_rollback(site):
+    stem_sidecar = ie.xmp_sidecar_path(PHOTOS[0], "stem")
+    with open(stem_sidecar, "w", encoding="utf-8") as f:
+        f.write(EXISTING_SIDECAR)
+    before = [ie.content_hash(path) for path in PHOTOS]
+
+    run(geotag_mode="xmp", sidecar_naming="stem")
+    assert [ie.content_hash(path) for path in PHOTOS] == before
+    assert ie.read_xmp_gps(stem_sidecar) == pytest.approx((50.842, 4.352), abs=1e-4)
+    with open(stem_sidecar, "r", encoding="utf-8") as f:
+        assert 'Rating="4"' in f.read()
+    assert os.path.exists(ie.xmp_sidecar_path(PHOTOS[1], "stem"))
+    assert not os.path.exists(ie.xmp_sidecar_path(PHOTOS[0], "file"))
+
+    # Sidecars under either name count as a geotag
+    records = image_records(run(geotag_mode="xmp", full=True))
+    assert {record["status"] for record in records.values()} == {"already_geotagged"}
+
+    journal, = glob.glob(os.path.join(ie.DEFAULT_JOURNAL_DIR, "*.jsonl"))
+    assert ie.rollback_journal(journal, manifest_path=ie.DEFAULT_MANIFEST) == (2, [])
+    with open(stem_sidecar, "r", encoding="utf-8") as f:
+        assert f.read() == EXISTING_SIDECAR
+    assert not os.path.exists(ie.xmp_sidecar_path(PHOTOS[1], "stem"))
+    assert not glob.glob("images/*.tmp")
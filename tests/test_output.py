@@ -0,0 +1,72 @@
+import json
+import os
+
+import index_and_enrich as ie
+
+
+def sample_images(count):
+    # Display order (newest first), as integrate_index_and_geotag writes them
+    images = []
+    for i in range(count):
+        images.append(ie.build_image_entry(
+            path=f"images/IMG_{i:04d}.jpg",
+            taken=f"2024-{12 - i // 3:02d}-{28 - i:02d}T12:00:00Z",
+            location="Brussels, Belgium" if i % 2 else "Paris, France",
+            tags=["street"] if i % 3 == 0 else [],
+            width=640, height=480
+        ))
+    return images
+
+
+def read_json(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def test_single_file_round_trip(tmp_path):
+    json_path = str(tmp_path / "images.json")
+    images = sample_images(5)
+    changed, shard_stats = ie.write_images_json(json_path, images, [], shard_size=0)
+    assert changed and shard_stats is None
+    assert ie.load_images_json(json_path) == images
+    assert ie.write_images_json(json_path, images, [], shard_size=0) == (False, None)
+
+
+def test_sharded_output(tmp_path):
+    json_path = str(tmp_path / "images.json")
+    images = sample_images(7)
+    pruned = [ie.build_image_entry("images/gone.jpg")]
+    changed, stats = ie.write_images_json(json_path, images, pruned, shard_size=3)
+    assert changed
+    assert stats == {"written": 3, "unchanged": 0, "removed": 0, "index_written": True}
+
+    index = read_json(json_path)
+    assert index["count"] == 7 and index["shard_size"] == 3
+    assert [shard["count"] for shard in index["shards"]] == [1, 3, 3]
+    assert index["shards"][0]["first"] == images[0]["taken"]
+    assert index["pruned"] == pruned
+    assert index["facets"]["places"] == {"Brussels, Belgium": 3, "Paris, France": 4}
+    assert ie.load_images_json(json_path) == images
+
+    # Shards are numbered from the oldest, so a new photo only rewrites the newest one
+    newer = ie.build_image_entry(path="images/new.jpg", taken="2025-01-01T00:00:00Z")
+    _, stats = ie.write_images_json(json_path, [newer] + images, pruned, shard_size=3)
+    assert stats["written"] == 1 and stats["unchanged"] == 2
+
+    # Shards beyond the new count are removed
+    _, stats = ie.write_images_json(json_path, images[:2], [], shard_size=3)
+    assert stats["removed"] == 2
+    assert len(os.listdir(tmp_path / ie.DEFAULT_SHARD_DIR)) == 1
+
+
+def test_facet_index(tmp_path):
+    json_path = str(tmp_path / "images.json")
+    images = sample_images(6)
+    ie.write_images_json(json_path, images, [], shard_size=0)
+    facets = read_json(ie.facets_path(json_path))
+    assert facets["count"] == 6
+    # Postings are display-order ordinals, ascending
+    assert facets["places"]["Paris, France"] == {"count": 3, "ids": [0, 2, 4]}
+    assert facets["tags"]["street"] == {"count": 2, "ids": [0, 3]}
+    assert list(facets["dates"]) == sorted(facets["dates"], reverse=True)
+    assert sum(posting["count"] for posting in facets["dates"].values()) == 6
@@ -0,0 +1,177 @@
+import http.client
+import json
+import os
+import threading
+import time
+from functools import partial
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+import index_and_enrich as ie
+from conftest import SAMPLE_IMAGES
+
+SAMPLE = "images/" + SAMPLE_IMAGES[0]
+
+
+def write_index(images):
+    with open("images.json", "w", encoding="utf-8") as f:
+        json.dump(images, f)
+
+
+def test_concurrent_requests_render_once(site, monkeypatch):
+    write_index([{"path": SAMPLE}])
+    thumb = ie.norm_path(ie.thumb_path(SAMPLE, "320"))
+    active, overlaps = [], []
+    lock = threading.Lock()
+    render = ie.render_thumbnails
+
+    def slow_render(src_path, outputs):
+        with lock:
+            active.append(src_path)
+            if len(active) > 1:
+                overlaps.append(src_path)
+        time.sleep(0.05)
+        render(src_path, outputs)
+        with lock:
+            active.remove(src_path)
+
+    monkeypatch.setattr(ie, "render_thumbnails", slow_render)
+    previews = ie.PreviewThumbnails(max_renders=4)
+    results = []
+    start = threading.Barrier(16)
+
+    def request():
+        start.wait()
+        results.append(previews.get(thumb))
+
+    threads = [threading.Thread(target=request) for _ in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert previews.rendered == 1
+    assert not overlaps
+    assert previews._rendering == {}
+    assert len({data for data, _, _ in results}) == 1
+    assert not [name for name in os.listdir("thumbs") if name.endswith(".tmp")]
+
+
+def test_renders_of_one_thumbnail_never_overlap(site, monkeypatch):
+    # A source edited between requests makes each one render again; requests
+    # keep arriving while earlier ones hold or wait for the path's lock, and
+    # every render must still run alone
+    write_index([{"path": SAMPLE}])
+    thumb = ie.norm_path(ie.thumb_path(SAMPLE, "1600"))
+    active, overlaps = [], []
+    lock = threading.Lock()
+    render = ie.render_thumbnails
+
+    def slow_render(src_path, outputs):
+        with lock:
+            active.append(src_path)
+            if len(active) > 1:
+                overlaps.append(src_path)
+        time.sleep(0.01)
+        render(src_path, outputs)
+        with lock:
+            active.remove(src_path)
+
+    monkeypatch.setattr(ie, "render_thumbnails", slow_render)
+    previews = ie.PreviewThumbnails(max_renders=4)
+    monkeypatch.setattr(previews, "_is_fresh", lambda path, src_path, keyed: False)
+    threads = []
+    for _ in range(24):
+        threads.append(threading.Thread(target=previews.get, args=(thumb,)))
+        threads[-1].start()
+        time.sleep(0.004)
+    for thread in threads:
+        thread.join()
+
+    assert previews.rendered == 24
+    assert not overlaps
+    assert previews._rendering == {}
+
+
+def test_parse_byte_range():
+    assert ie.parse_byte_range("bytes=0-9", 100) == (0, 10)
+    assert ie.parse_byte_range("bytes=90-", 100) == (90, 100)
+    assert ie.parse_byte_range("bytes=-10", 100) == (90, 100)
+    assert ie.parse_byte_range("bytes=50-500", 100) == (50, 100)
+    assert ie.parse_byte_range("bytes=100-", 100) is None
+    # Malformed or multiple ranges: the whole body
+    for header in ("bytes=9-0", "bytes=0-1,5-6", "items=0-1", "bytes=x-1", "bytes=-", "bytes=5"):
+        assert ie.parse_byte_range(header, 100) == ()
+
+
+@pytest.fixture
+def preview(site):
+    write_index([{"path": SAMPLE}])
+    server = ThreadingHTTPServer(("127.0.0.1", 0), partial(ie.PreviewRequestHandler, directory=str(site)))
+    server.thumbnails = ie.PreviewThumbnails()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    def request(path, method="GET", **headers):
+        conn = http.client.HTTPConnection("127.0.0.1", server.server_address[1], timeout=10)
+        try:
+            conn.request(method, path, headers=headers)
+            response = conn.getresponse()
+            return response.status, dict(response.getheaders()), response.read()
+        finally:
+            conn.close()
+
+    yield request
+    server.shutdown()
+    server.server_close()
+
+
+def test_thumbnail_etag_and_conditional_requests(preview):
+    thumb = "/" + ie.thumb_path(SAMPLE, "320")
+    status, headers, body = preview(thumb)
+    assert status == 200
+    assert headers["Content-Type"] == "image/webp"
+    assert int(headers["Content-Length"]) == len(body) > 0
+    assert headers["Accept-Ranges"] == "bytes"
+    # Legacy names are not content keyed, so they are revalidated
+    assert headers["Cache-Control"] == "no-cache"
+    etag = headers["ETag"]
+
+    status, headers, body = preview(thumb, **{"If-None-Match": etag})
+    assert status == 304 and body == b"" and headers["ETag"] == etag
+    status, _, _ = preview(thumb, **{"If-None-Match": '"other"'})
+    assert status == 200
+    status, _, _ = preview(thumb, **{"If-Modified-Since": headers["Last-Modified"]})
+    assert status == 304
+
+
+def test_byte_ranges(preview):
+    thumb = "/" + ie.thumb_path(SAMPLE, "320")
+    _, headers, full = preview(thumb)
+    size, etag = len(full), headers["ETag"]
+
+    status, headers, body = preview(thumb, Range="bytes=0-9")
+    assert status == 206 and body == full[:10]
+    assert headers["Content-Range"] == f"bytes 0-9/{size}"
+    status, _, body = preview(thumb, Range="bytes=-5")
+    assert status == 206 and body == full[-5:]
+    status, headers, body = preview(thumb, Range=f"bytes={size}-")
+    assert status == 416 and headers["Content-Range"] == f"bytes */{size}"
+    # If-Range with a stale validator gets the whole, current body
+    status, _, body = preview(thumb, Range="bytes=0-9", **{"If-Range": '"stale"'})
+    assert status == 200 and body == full
+    status, _, body = preview(thumb, Range="bytes=0-9", **{"If-Range": etag})
+    assert status == 206 and body == full[:10]
+    status, headers, body = preview(thumb, method="HEAD", Range="bytes=0-9")
+    assert status == 206 and body == b"" and headers["Content-Length"] == "10"
+
+
+def test_static_files_and_missing_paths(preview, site):
+    with open(site / "index.html", "w", encoding="utf-8") as f:
+        f.write("<html></html>")
+    status, headers, body = preview("/index.html", Range="bytes=1-4")
+    assert status == 206 and body == b"html"
+    assert "ETag" in headers
+    status, _, _ = preview("/thumbs/missing_320.webp")
+    assert status == 404